@@ -3,6 +3,8 @@ import requests
 import json
 from google.cloud import bigquery
 
+import record_transform
+
 @functions_framework.http
 def hello_http(request):
     """HTTP Cloud Function to fetch data from See Tickets API and insert it into BigQuery.
@@ -50,41 +52,7 @@ def hello_http(request):
             # Prepare rows for BigQuery
             rows_to_insert = []
             for record in response_json.get('data', []):
-                row = {
-                    "affiliate": record.get("affiliate"),
-                    "currency": record.get("currency"),
-                    "date": record.get("date"),
-                    "deliveryMethod": record.get("deliveryMethod"),
-                    "deviceModel": record.get("deviceModel"),
-                    "deviceType": record.get("deviceType"),
-                    "eventDate": record.get("eventDate"),
-                    "eventId": record.get("eventId"),
-                    "eventName": record.get("eventName"),
-                    "faceValue": record.get("faceValue"),
-                    "grossCost": record.get("grossCost"),
-                    "grossFace": record.get("grossFace"),
-                    "grossSales": record.get("grossSales"),
-                    "isInternetOrder": record.get("isInternetOrder"),
-                    "isPending": record.get("isPending"),
-                    "country": record.get("location", {}).get("country"),
-                    "countryIso": record.get("location", {}).get("countryIso"),
-                    "postCode": record.get("location", {}).get("postCode"),
-                    "region1": record.get("location", {}).get("region1"),
-                    "region2": record.get("location", {}).get("region2"),
-                    "region3": record.get("location", {}).get("region3"),
-                    "region4": record.get("location", {}).get("region4"),
-                    "offerCode": record.get("offerCode"),
-                    "partnerSite": record.get("partnerSite"),
-                    "paymentMethod": record.get("paymentMethod"),
-                    "priceId": record.get("priceId"),
-                    "priceName": record.get("priceName"),
-                    "salesChannel": record.get("salesChannel"),
-                    "sold": record.get("sold"),
-                    "source": record.get("source"),
-                    "taxTotal": record.get("taxTotal"),
-                    "ticketPrice": record.get("ticketPrice"),
-                    "uniqueCode": record.get("uniqueCode")
-                }
+                row = record_transform.transform_sale(record)
                 rows_to_insert.append(row)
             
             # Insert data into BigQuery
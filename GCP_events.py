@@ -1,17 +1,53 @@
 # Cloud Funtion Name events
 
 import functions_framework
-import requests
-import json
-from google.cloud import bigquery
-from google.cloud import secretmanager
-from datetime import datetime
+import os
+
+import bigquery_sink
+import column_batch
+import event_fingerprints
+import gcp_resources
+import instrumentation
+import pipeline
+import record_transform
+import response_cache
+import see_tickets_api
+import table_layout
+
+# "scan" reads every existing id before inserting, "merge" deduplicates server-side
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "scan")
+
+# "insert" only adds events with a new id, "upsert" also rewrites events whose content changed
+EVENTS_SYNC_MODE = os.environ.get("EVENTS_SYNC_MODE", "insert")
+
+# Streaming inserts are split into chunks bounded by rows and bytes and sent concurrently
+INSERT_CHUNK_ROWS = int(os.environ.get("INSERT_CHUNK_ROWS", bigquery_sink.DEFAULT_CHUNK_ROWS))
+INSERT_CHUNK_BYTES = int(os.environ.get("INSERT_CHUNK_BYTES", bigquery_sink.DEFAULT_CHUNK_BYTES))
+INSERT_WORKERS = int(os.environ.get("INSERT_WORKERS", bigquery_sink.DEFAULT_INSERT_WORKERS))
+
+# "buffered" parses the response with response.json(), "stream" parses the data array incrementally
+PARSE_MODE = os.environ.get("PARSE_MODE", "buffered")
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", see_tickets_api.DEFAULT_BATCH_SIZE))
+
+# "dicts" builds a dict per row, "columns" keeps each batch in a compact column_batch.ColumnBatch
+ROW_FORMAT = os.environ.get("ROW_FORMAT", "dicts")
+
+# "on" sends a conditional request and skips the run when the events are unchanged since a
+# previous invocation of this instance wrote them
+HTTP_CACHE = os.environ.get("HTTP_CACHE", "off")
+
+# "on" runs parse, transform and insert in overlapping threads, connected by queues holding
+# at most PIPELINE_DEPTH batches each; only stream mode has more than one batch to overlap
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "off")
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", pipeline.DEFAULT_DEPTH))
 
 @functions_framework.http
-def events(request):
+@instrumentation.instrumented("events")
+def events(request, stats):
     """HTTP Cloud Function to fetch event data from See Tickets API and insert it into BigQuery.
     Args:
         request (flask.Request): The request object.
+        stats (instrumentation.Invocation): Per-stage counters, logged when the invocation ends.
     Returns:
         The response text indicating success or failure.
     """
@@ -20,43 +56,61 @@ def events(request):
     project_id = "otis-media"
     dataset_id = "seetickets_data"
     table_id = f"{project_id}.{dataset_id}.events"
+    fingerprint_table_id = f"{project_id}.{dataset_id}.{event_fingerprints.FINGERPRINT_TABLE}"
 
-    # Initialize BigQuery client with explicit project ID
-    client = bigquery.Client(project=project_id)
+    # Shared BigQuery client, created once per instance
+    client = gcp_resources.bigquery_client(project_id)
 
-    # Fetch unique identifiers from the table (e.g., id)
-    fetch_existing_ids_query = f"SELECT id FROM `{table_id}`"
-    
+    # Create the table, partitioned on the event start, if it does not exist. Existing ids are
+    # still looked up in every partition because an event's start can be moved.
     try:
-        query_job = client.query(fetch_existing_ids_query)  # Make an API request.
-        results = query_job.result()  # Wait for the job to complete.
-
-        # Store existing IDs in a set for fast lookup
-        existing_ids = {row.id for row in results}
-        
-        # Log the number of existing records for debugging
-        print(f"Number of existing records in {table_id}: {len(existing_ids)}")
-    
+        with stats.stage("table"):
+            table_layout.create_events_table_if_not_exists(client, table_id)
     except Exception as e:
-        print(f"Error fetching existing records: {e}")
-        return f"Error fetching existing records: {e}", 500
+        print(f"Error creating table: {e}")
+        return f"Error creating table: {e}", 500
 
-    # Initialize Secret Manager client
-    secret_client = secretmanager.SecretManagerServiceClient()
+    # Fetch unique identifiers from the table (e.g., id)
+    existing_ids = set()
+    if DEDUP_MODE == "scan" and EVENTS_SYNC_MODE != "upsert":
+        fetch_existing_ids_query = f"SELECT id FROM `{table_id}`"
+
+        try:
+            with stats.stage("existing_keys"):
+                query_job = client.query(fetch_existing_ids_query)  # Make an API request.
+                results = query_job.result()  # Wait for the job to complete.
+
+                # Store existing IDs in a set for fast lookup
+                existing_ids = {row.id for row in results}
+            stats.add("existing_keys", rows=len(existing_ids))
+
+            # Log the number of existing records for debugging
+            print(f"Number of existing records in {table_id}: {len(existing_ids)}")
+
+        except Exception as e:
+            print(f"Error fetching existing records: {e}")
+            return f"Error fetching existing records: {e}", 500
+
+    # In upsert mode compare every event with the fingerprint of its stored row instead
+    if EVENTS_SYNC_MODE == "upsert":
+        try:
+            with stats.stage("fingerprints"):
+                event_fingerprints.create_fingerprint_table_if_not_exists(client, project_id, dataset_id)
+        except Exception as e:
+            print(f"Error creating fingerprint table: {e}")
+            return f"Error creating fingerprint table: {e}", 500
 
-    # Build the resource name of the secret
-    secret_name = f"projects/{project_id}/secrets/SEE_TICKETS_API_KEY/versions/latest"
-    
     try:
-        # Access the secret version
-        response = secret_client.access_secret_version(name=secret_name)
-        api_key = response.payload.data.decode("UTF-8")
+        # Access the secret version, cached across warm invocations
+        with stats.stage("secret"):
+            api_key = gcp_resources.api_key(project_id)
     except Exception as e:
         print(f"Error accessing secret: {e}")
         return f"Error accessing secret: {e}", 500
 
-    # URL and headers for the API request
-    url = "https://clients-api.seetickets.com/v1/events/search"
+    # URL, headers and pooled keep-alive session for the API request
+    url = see_tickets_api.EVENTS_URL
+    session = gcp_resources.see_tickets_session(project_id)
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -68,47 +122,105 @@ def events(request):
         # "limit": 100 
     }
     
-    # Make the API request with GET method
-    response = requests.get(url, headers=headers, params=payload)
+    # Ask for the events only if they changed since the last stored response
+    cache = None
+    if HTTP_CACHE == "on":
+        cache = response_cache.CachedRequests(gcp_resources.http_cache())
+        cache_key = response_cache.request_key("GET", url, payload)
+        headers.update(cache.request_headers(cache_key))
+
+    # Make the API request with GET method, streaming the body in stream mode
+    with stats.stage("fetch"):
+        response = session.get(url, headers=headers, params=payload, stream=PARSE_MODE == "stream")
+
+    # A streamed body is not read twice, so it is only skipped on a 304
+    if cache is not None and cache.check(cache_key, response, digest=PARSE_MODE != "stream") is not None:
+        print("Events unchanged since the last run.")
+        print("No new data to insert.")
+        return "No new data to insert.", 200
     
     # Handle the response
     if response.status_code == 200:
         try:
-            response_json = response.json()  # Attempt to parse the JSON response
-            
-            # Logging the response for debugging
-            print(f"API Response: {json.dumps(response_json, indent=4)}")
-            
-            # Prepare rows for BigQuery, only add new records
-            rows_to_insert = []
-            for record in response_json.get('data', []):
-                event_id = record.get("id")
-                
-                # Check if the record already exists
-                if event_id not in existing_ids:
-                    row = {
-                        "doorsOpen": record.get("doorsOpen"),
-                        "id": event_id,
-                        "name": record.get("name"),
-                        "promoterName": record.get("promoterName"),
-                        "starts": record.get("starts"),
-                        "timeslotEnabled": record.get("timeslotEnabled"),
-                        "tourId": record.get("tourId"),
-                        "tourName": record.get("tourName"),
-                        "venueName": record.get("venueName")
-                    }
-                    rows_to_insert.append(row)
-            
-            # Insert new data into BigQuery
-            if rows_to_insert:
-                errors = client.insert_rows_json(table_id, rows_to_insert)
-                
-                if errors:
-                    print(f"BigQuery Insertion Errors: {errors}")
-                    return f"Encountered errors while inserting rows: {errors}", 500
-                
-                print(f"Successfully inserted {len(rows_to_insert)} new rows.")
-                return f"Successfully inserted {len(rows_to_insert)} new rows.", 200
+            if PARSE_MODE == "stream":
+                # Parse the data array incrementally and hand over fixed-size batches
+                records = see_tickets_api.iter_response_array(response, stats=stats)
+                batches = stats.timed_iter(see_tickets_api.iter_batches(records, STREAM_BATCH_SIZE), "fetch", rows=len)
+            else:
+                with stats.stage("parse"):
+                    response_json = response.json()  # Attempt to parse the JSON response
+                stats.add("fetch", rows=len(response_json.get('data', [])))
+                stats.add("parse", bytes_in=len(response.content))
+
+                # Log a capped sample of the response for debugging, the full payload can be megabytes
+                print(f"API Response sample: {instrumentation.sample_payload(response_json)}")
+                batches = [response_json.get('data', [])]
+
+            # Prepare rows for BigQuery, only add new records; in pipeline mode the response is
+            # parsed, transformed and inserted in overlapping threads
+            with pipeline.Pipeline(PIPELINE_DEPTH, PIPELINE_MODE == "on", stats) as stages:
+                batches = stages.stage(batches, "fetch")
+                row_batches = stages.stage(_new_row_batches(batches, existing_ids, stats), "transform")
+
+                with stats.stage("insert"):
+                    # Upsert only the new and changed events, then record their fingerprints
+                    if EVENTS_SYNC_MODE == "upsert":
+                        rows = list(column_batch.iter_row_dicts(row_batches))
+                        try:
+                            # Only the fingerprints of the fetched events are read, not the whole table
+                            with stats.stage("fingerprints"):
+                                fingerprints = event_fingerprints.load_fingerprints(
+                                    client, fingerprint_table_id, {row["id"] for row in rows}
+                                )
+                            stats.add("fingerprints", rows=len(fingerprints))
+                            print(f"Loaded fingerprints for {len(fingerprints)} events.")
+                        except Exception as e:
+                            print(f"Error loading fingerprints: {e}")
+                            return f"Error loading fingerprints: {e}", 500
+
+                        with stats.stage("fingerprints"):
+                            changed, new_fingerprints = event_fingerprints.changed_rows(rows, fingerprints)
+                        print(f"{len(changed)} events are new or changed.")
+                        inserted = bigquery_sink.merge_rows(client, table_id, changed, "id", stats=stats, update=True)
+                        bigquery_sink.merge_rows(
+                            client, fingerprint_table_id,
+                            [{"id": event_id, "fingerprint": value} for event_id, value in new_fingerprints.items()],
+                            "id", update=True
+                        )
+
+                    # Merge the rows through a staging table, the MERGE skips existing ids
+                    elif DEDUP_MODE == "merge":
+                        inserted = bigquery_sink.merge_rows(
+                            client, table_id, column_batch.iter_row_dicts(row_batches), "id", stats=stats
+                        )
+
+                    # Insert new data into BigQuery
+                    else:
+                        inserted = 0
+                        errors = []
+                        for rows_to_insert in row_batches:
+                            batch_errors = bigquery_sink.insert_rows_chunked(
+                                client, table_id, rows_to_insert,
+                                max_rows=INSERT_CHUNK_ROWS, max_bytes=INSERT_CHUNK_BYTES, max_workers=INSERT_WORKERS, stats=stats
+                            )
+                            inserted += len(rows_to_insert) - len(batch_errors)
+                            errors.extend(batch_errors)
+
+                        if errors:
+                            print(f"BigQuery Insertion Errors: {errors}")
+                            return f"Encountered errors while inserting rows: {errors}", 500
+
+            # The events are stored, so an unchanged response can be skipped from now on
+            if cache is not None:
+                cache.remember(cache_key, stats.stages.get("fetch", {}).get("rows", 0))
+                cache.commit()
+
+            if inserted and EVENTS_SYNC_MODE == "upsert":
+                print(f"Successfully upserted {inserted} new or changed rows.")
+                return f"Successfully upserted {inserted} new or changed rows.", 200
+            elif inserted:
+                print(f"Successfully inserted {inserted} new rows.")
+                return f"Successfully inserted {inserted} new rows.", 200
             else:
                 print("No new data to insert.")
                 return "No new data to insert.", 200
@@ -121,6 +233,20 @@ def events(request):
             # Catch-all for any other exceptions
             print(f"An unexpected error occurred: {e}")
             return f"An unexpected error occurred: {e}", 500
+        finally:
+            response.close()
     else:
         print(f"Request failed: {response.status_code} {response.text}")
         return f"Request failed: {response.status_code} {response.text}", response.status_code
+
+
+def _new_row_batches(batches, existing_ids, stats):
+    """Yields the BigQuery rows of every batch, skipping events that already exist."""
+    for batch in batches:
+        with stats.stage("transform"):
+            if ROW_FORMAT == "columns":
+                rows = column_batch.events_batch(record for record in batch if record.get("id") not in existing_ids)
+            else:
+                rows = [record_transform.transform_event(record) for record in batch if record.get("id") not in existing_ids]
+        stats.add("transform", rows=len(rows))
+        yield rows
@@ -1,17 +1,112 @@
 # Cloud Funtion Name see_tickets_to_bigquery
 
 import functions_framework
-import requests
-import json
-from google.cloud import bigquery
-from google.cloud import secretmanager
-from datetime import datetime
+import itertools
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import bigquery_sink
+import column_batch
+import dedup_index
+import event_selection
+import gcp_resources
+import instrumentation
+import lazy_imports
+import pipeline
+import record_transform
+import response_cache
+import sales_rollup
+import sales_shards
+import sales_watermark
+import see_tickets_api
+import sync_checkpoint
+import table_layout
+
+requests = lazy_imports.module("requests")
+
+# "static" syncs the event codes listed in hello_http, "events_table" the events in the events table
+# whose start falls inside the active window
+EVENT_SELECTION_MODE = os.environ.get("EVENT_SELECTION_MODE", "static")
+ACTIVE_WINDOW_PAST = timedelta(days=int(os.environ.get("ACTIVE_WINDOW_PAST_DAYS", "14")))
+ACTIVE_WINDOW_FUTURE = timedelta(days=int(os.environ.get("ACTIVE_WINDOW_FUTURE_DAYS", "365")))
+
+# Event codes sent per sales report request
+EVENT_CODE_BATCH_SIZE = int(os.environ.get("EVENT_CODE_BATCH_SIZE", event_selection.DEFAULT_BATCH_SIZE))
+
+# Page size and number of concurrent page requests for the sales report
+SALES_PAGE_SIZE = int(os.environ.get("SALES_PAGE_SIZE", see_tickets_api.DEFAULT_PAGE_SIZE))
+SALES_FETCH_WORKERS = int(os.environ.get("SALES_FETCH_WORKERS", see_tickets_api.DEFAULT_MAX_WORKERS))
+
+# "full" re-fetches the whole report, "incremental" only fetches sales after each event's watermark
+SALES_SYNC_MODE = os.environ.get("SALES_SYNC_MODE", "full")
+SALES_WATERMARK_OVERLAP = timedelta(minutes=int(os.environ.get("SALES_WATERMARK_OVERLAP_MINUTES", "60")))
+
+# "scan" reads every existing uniqueCode before inserting, "merge" deduplicates server-side,
+# "index" looks uniqueCodes up in a persistent file of their 64-bit hashes
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "scan")
+
+# Where the dedup index is kept, an optional Cloud Storage bucket shared by every instance, and
+# how often it is rebuilt from the sales table to correct any drift
+DEDUP_INDEX_PATH = os.environ.get("DEDUP_INDEX_PATH", "/tmp/sales_dedup.idx")
+DEDUP_INDEX_BUCKET = os.environ.get("DEDUP_INDEX_BUCKET", "")
+DEDUP_INDEX_RECONCILE_SECONDS = float(os.environ.get("DEDUP_INDEX_RECONCILE_HOURS", "24")) * 3600
+
+# Streaming inserts are split into chunks bounded by rows and bytes and sent concurrently
+INSERT_CHUNK_ROWS = int(os.environ.get("INSERT_CHUNK_ROWS", bigquery_sink.DEFAULT_CHUNK_ROWS))
+INSERT_CHUNK_BYTES = int(os.environ.get("INSERT_CHUNK_BYTES", bigquery_sink.DEFAULT_CHUNK_BYTES))
+INSERT_WORKERS = int(os.environ.get("INSERT_WORKERS", bigquery_sink.DEFAULT_INSERT_WORKERS))
+
+# "stream" uses streaming inserts, "load" writes a compressed file and submits one load job
+WRITE_MODE = os.environ.get("WRITE_MODE", "stream")
+LOAD_FORMAT = os.environ.get("LOAD_FORMAT", "ndjson")
+
+# "on" writes the report in windows of SALES_FETCH_WORKERS pages and checkpoints the offset after each
+# one, so a run that times out is resumed by the next invocation; 0 disables the time budget
+CHECKPOINT_MODE = os.environ.get("CHECKPOINT_MODE", "off")
+CHECKPOINT_TIME_BUDGET_SECONDS = float(os.environ.get("CHECKPOINT_TIME_BUDGET_SECONDS", "0"))
+
+# "on" adds the new rows to daily totals per event, price and channel in sales_daily_summary
+SALES_ROLLUP = os.environ.get("SALES_ROLLUP", "off")
+
+# "buffered" parses whole pages with response.json(), "stream" parses the data array incrementally
+PARSE_MODE = os.environ.get("PARSE_MODE", "buffered")
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", see_tickets_api.DEFAULT_BATCH_SIZE))
+
+# "dicts" builds a dict per row, "columns" keeps each batch in a compact column_batch.ColumnBatch
+ROW_FORMAT = os.environ.get("ROW_FORMAT", "dicts")
+
+# "on" runs fetch, transform and insert in overlapping threads, connected by queues holding
+# at most PIPELINE_DEPTH batches each
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "off")
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", pipeline.DEFAULT_DEPTH))
+
+# "on" sends conditional requests and skips report pages that are unchanged since a previous
+# invocation of this instance wrote them; needs PARSE_MODE buffered
+HTTP_CACHE = os.environ.get("HTTP_CACHE", "off")
+
+# "coordinator" splits the selected events into SALES_SHARDS shards and sends each one to a worker:
+# an invocation of this function at SALES_SHARD_URL ("http") or a forked process ("local")
+SALES_SHARD_MODE = os.environ.get("SALES_SHARD_MODE", "off")
+SALES_SHARDS = int(os.environ.get("SALES_SHARDS", "8"))
+SALES_SHARD_BACKEND = os.environ.get("SALES_SHARD_BACKEND", "http")
+SALES_SHARD_URL = os.environ.get("SALES_SHARD_URL", "")
+SALES_SHARD_WORKERS = int(os.environ.get("SALES_SHARD_WORKERS", sales_shards.DEFAULT_WORKERS))
+SALES_SHARD_RETRIES = int(os.environ.get("SALES_SHARD_RETRIES", sales_shards.DEFAULT_RETRIES))
+
+# With a start date (YYYY-MM-DD), every shard is also split into sale date ranges of
+# SALES_SHARD_DAYS days up to today, e.g. for a backfill
+SALES_SHARD_START = os.environ.get("SALES_SHARD_START", "")
+SALES_SHARD_DAYS = int(os.environ.get("SALES_SHARD_DAYS", "30"))
+
 
 @functions_framework.http
-def hello_http(request):
+@instrumentation.instrumented("hello_http")
+def hello_http(request, stats):
     """HTTP Cloud Function to fetch data from See Tickets API and insert it into BigQuery.
     Args:
         request (flask.Request): The request object.
+        stats (instrumentation.Invocation): Per-stage counters, logged when the invocation ends.
     Returns:
         The response text indicating success or failure.
     """
@@ -24,138 +119,527 @@ def hello_http(request):
     project_id = "otis-media"  
     dataset_id = "seetickets_data"  
     table_id = f"{project_id}.{dataset_id}.sales"
+    events_table_id = f"{project_id}.{dataset_id}.events"
+    watermark_table_id = f"{project_id}.{dataset_id}.{sales_watermark.WATERMARK_TABLE}"
+    summary_table_id = f"{project_id}.{dataset_id}.{sales_rollup.SUMMARY_TABLE}"
 
-    # Initialize BigQuery client with explicit project ID
-    client = bigquery.Client(project=project_id)
+    # Events whose sales are synced
+    event_codes = ['DF-2974218', 'DF-2974224', 'DF-2974228', 'DF-2974229', 'DF-2974230', 'DF-2974231', 'DF-2974360', 'DF-2974361', 'DF-2974362', 'DF-2974363']
 
-    # Fetch unique identifiers from the table (e.g., uniqueCode)
-    fetch_existing_ids_query = f"SELECT uniqueCode FROM `{table_id}`"
-    
+    # Shared BigQuery client, created once per instance
+    client = gcp_resources.bigquery_client(project_id)
+
+    # A worker invocation syncs the events (and sale dates) of the shard a coordinator sent it
+    shard = sales_shards.request_shard(request)
+    if shard is not None:
+        event_codes = shard.codes
+        print(f"Syncing shard {shard.id} of {len(event_codes)} events.")
+
+    # In events_table mode sync the events that can still have new sales instead
+    if shard is None and EVENT_SELECTION_MODE == "events_table":
+        try:
+            with stats.stage("events"):
+                event_codes = event_selection.load_active_event_codes(
+                    client, events_table_id, ACTIVE_WINDOW_PAST, ACTIVE_WINDOW_FUTURE
+                )
+            stats.add("events", rows=len(event_codes))
+            print(f"Selected {len(event_codes)} active events from {events_table_id}.")
+        except Exception as e:
+            print(f"Error selecting active events: {e}")
+            return f"Error selecting active events: {e}", 500
+
+        if not event_codes:
+            print("No active events to sync.")
+            return "No active events to sync.", 200
+
+    # A coordinator only plans the shards and leaves the sync to the workers
+    if shard is None and SALES_SHARD_MODE == "coordinator":
+        return _coordinate_shards(client, project_id, dataset_id, event_codes)
+
+    # Create the table, partitioned on the sale date, if it does not exist
     try:
-        query_job = client.query(fetch_existing_ids_query)  # Make an API request.
-        results = query_job.result()  # Wait for the job to complete.
-
-        # Store existing unique codes in a set for fast lookup
-        existing_unique_codes = {row.uniqueCode for row in results}
-        
-        # Log the number of existing records for debugging
-        print(f"Number of existing records in {table_id}: {len(existing_unique_codes)}")
-    
+        with stats.stage("table"):
+            table_layout.create_sales_table_if_not_exists(client, table_id)
+            partitioned = table_layout.is_partitioned_on(client.get_table(table_id), table_layout.SALES_PARTITION_FIELD)
     except Exception as e:
-        print(f"Error fetching existing records: {e}")
-        return f"Error fetching existing records: {e}", 500
+        print(f"Error creating table: {e}")
+        return f"Error creating table: {e}", 500
 
-    # Initialize Secret Manager client
-    secret_client = secretmanager.SecretManagerServiceClient()
+    # Totals of the new rows, merged into the summary once they are written. A MERGE drops existing
+    # uniqueCodes server-side, so the rows it is given are not known to be new.
+    rollup = None
+    if SALES_ROLLUP == "on" and DEDUP_MODE == "merge":
+        print("SALES_ROLLUP needs DEDUP_MODE scan or index, the summary is not updated.")
+    elif SALES_ROLLUP == "on":
+        try:
+            with stats.stage("rollup"):
+                sales_rollup.create_summary_table_if_not_exists(client, project_id, dataset_id)
+                rollup = sales_rollup.DailyRollup()
+                # A run that could not rebuild the summary left it marked, this run rebuilds it instead
+                rollup.dirty = sales_rollup.needs_rebuild(client, summary_table_id)
+            if rollup.dirty:
+                print("The daily summary is marked as missing totals, it is rebuilt after this run.")
+        except Exception as e:
+            print(f"Error creating summary table: {e}")
+            return f"Error creating summary table: {e}", 500
+
+    # Fetch unique identifiers from the table (e.g., uniqueCode)
+    existing_unique_codes = set()
+    if DEDUP_MODE == "scan" and partitioned:
+        # Only read the uniqueCodes of the synced events on the days each batch covers
+        existing_unique_codes = table_layout.PartitionedKeys(
+            client, table_id, "uniqueCode", table_layout.SALES_PARTITION_FIELD, "eventId", event_codes
+        )
+        print(f"Reading existing records of {table_id} per partition.")
+    elif DEDUP_MODE == "scan":
+        fetch_existing_ids_query = f"SELECT uniqueCode FROM `{table_id}`"
+
+        try:
+            with stats.stage("existing_keys"):
+                query_job = client.query(fetch_existing_ids_query)  # Make an API request.
+                results = query_job.result()  # Wait for the job to complete.
+
+                # Store existing unique codes in a set for fast lookup
+                existing_unique_codes = {row.uniqueCode for row in results}
+            stats.add("existing_keys", rows=len(existing_unique_codes))
+
+            # Log the number of existing records for debugging
+            print(f"Number of existing records in {table_id}: {len(existing_unique_codes)}")
+
+        except Exception as e:
+            print(f"Error fetching existing records: {e}")
+            return f"Error fetching existing records: {e}", 500
 
-    # Build the resource name of the secret
-    secret_name = f"projects/{project_id}/secrets/SEE_TICKETS_API_KEY/versions/latest"
-    
     try:
-        # Access the secret version
-        response = secret_client.access_secret_version(name=secret_name)
-        api_key = response.payload.data.decode("UTF-8")
+        # Access the secret version, cached across warm invocations
+        with stats.stage("secret"):
+            api_key = gcp_resources.api_key(project_id)
     except Exception as e:
         print(f"Error accessing secret: {e}")
         return f"Error accessing secret: {e}", 500
 
-    # URL and headers for the API request
-    url = "https://clients-api.seetickets.com/v1/reports/sales"
+    # URL, headers and pooled keep-alive session for the API requests
+    url = see_tickets_api.SALES_URL
+    session = gcp_resources.see_tickets_session(project_id)
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
     
-    # Payload for the API request
-    payload = {
-        "offset": 0,
-        "search": {
-            "forSearchItemType": "EVENT",
-            "searchItemCodes": ['DF-2974218', 'DF-2974224', 'DF-2974228', 'DF-2974229', 'DF-2974230', 'DF-2974231', 'DF-2974360', 'DF-2974361', 'DF-2974362', 'DF-2974363']
-        }
-    }
-    
-    # Make the API request
+    # In incremental mode only ask for sales after each event's high-water mark. A shard with
+    # its own sale date range leaves the watermarks alone.
+    watermarks = {}
+    incremental = SALES_SYNC_MODE == "incremental" and (shard is None or shard.filtered_by is None)
+    if shard is not None and shard.filtered_by is not None:
+        request_plan = [(event_codes, shard.filtered_by)]
+    elif incremental:
+        try:
+            with stats.stage("watermarks"):
+                sales_watermark.create_watermark_table_if_not_exists(client, project_id, dataset_id)
+                watermarks = sales_watermark.load_watermarks(client, watermark_table_id, event_codes)
+                request_plan = sales_watermark.plan_requests(event_codes, watermarks, SALES_WATERMARK_OVERLAP)
+            print(f"Loaded watermarks for {len(watermarks)} of {len(event_codes)} events.")
+        except Exception as e:
+            print(f"Error loading watermarks: {e}")
+            return f"Error loading watermarks: {e}", 500
+    else:
+        request_plan = [(event_codes, None)]
+
+    # Send at most EVENT_CODE_BATCH_SIZE event codes per report
+    request_plan = [
+        (codes, filtered_by)
+        for group, filtered_by in request_plan
+        for codes in event_selection.batch_codes(group, EVENT_CODE_BATCH_SIZE)
+    ]
+
+    # Remember the pages of this run, so later runs on this instance can skip the unchanged ones
+    cache = None
+    if HTTP_CACHE == "on" and PARSE_MODE == "stream":
+        print("HTTP_CACHE needs PARSE_MODE buffered, pages are fetched unconditionally.")
+    elif HTTP_CACHE == "on":
+        cache = response_cache.CachedRequests(gcp_resources.http_cache())
+
+    # In index mode the uniqueCodes are looked up in the memory-mapped hash index instead. It is
+    # opened last, right before the try whose finally saves and closes it, so that no earlier
+    # return leaves the mapping open.
+    dedup = None
+    if DEDUP_MODE == "index":
+        try:
+            with stats.stage("existing_keys"):
+                dedup, rebuilt = dedup_index.open_index(
+                    client, table_id, "uniqueCode", DEDUP_INDEX_PATH, DEDUP_INDEX_RECONCILE_SECONDS,
+                    DEDUP_INDEX_BUCKET or None
+                )
+            stats.add("existing_keys", rows=len(dedup))
+            print(f"{'Rebuilt' if rebuilt else 'Loaded'} dedup index of {table_id} with {len(dedup)} keys.")
+            existing_unique_codes = dedup
+        except Exception as e:
+            print(f"Error loading dedup index: {e}")
+            return f"Error loading dedup index: {e}", 500
+
+    # Fetch, transform and write the sales, one report per group of codes
+    tracker = sales_watermark.WatermarkTracker()
+    function_name = "hello_http" if shard is None else f"hello_http/{shard.id}"
+    finished = True
+    written = False
+
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
+        if CHECKPOINT_MODE == "on":
+            checkpoint_table_id = f"{project_id}.{dataset_id}.{sync_checkpoint.CHECKPOINT_TABLE}"
+            with stats.stage("checkpoints"):
+                sync_checkpoint.create_checkpoint_table_if_not_exists(client, project_id, dataset_id)
+                pending = sync_checkpoint.load_pending(client, checkpoint_table_id, function_name)
+            checkpoints = sync_checkpoint.resume_plan(request_plan, pending)
+            # Resumed reports may cover events that are no longer selected
+            if isinstance(existing_unique_codes, table_layout.PartitionedKeys):
+                existing_unique_codes.cluster_values = sorted(
+                    {code for checkpoint in checkpoints for code in checkpoint.codes} | set(event_codes)
+                )
+            inserted, errors, finished = _checkpointed_sync(
+                client, table_id, checkpoint_table_id, summary_table_id, function_name, session, url, headers,
+                checkpoints, existing_unique_codes, tracker, rollup, cache, stats
+            )
+        else:
+            with pipeline.Pipeline(PIPELINE_DEPTH, PIPELINE_MODE == "on", stats) as stages:
+                batches = stages.stage(
+                    _fetch_batches(session, url, headers, request_plan, tracker, cache, stats), "fetch"
+                )
+                row_batches = stages.stage(_new_row_batches(batches, existing_unique_codes, stats), "transform")
+                inserted, errors = _write_rows(client, table_id, row_batches, rollup, stats)
+
+        if errors:
+            print(f"BigQuery Insertion Errors: {errors}")
+            return f"Encountered errors while inserting rows: {errors}", 500
+        written = True
+
+        # The rows of the fetched pages are stored, so those pages can be skipped from now on
+        if cache is not None:
+            cache.commit()
+            print(f"Skipped {cache.unchanged_pages} unchanged pages.")
+
+        # The time budget ran out; the next invocation resumes from the checkpoints. 202 tells a
+        # shard coordinator that this worker has not synced all of its shard yet.
+        if not finished:
+            message = f"Inserted {inserted} new rows, stopped at a checkpoint before the time budget ran out."
+            print(message)
+            return message, sales_shards.PARTIAL_STATUS
+
+        if inserted:
+            message = f"Successfully inserted {inserted} new rows."
+        else:
+            message = "No new data to insert."
+
+        # Only move the watermarks once the sales before them are stored
+        if incremental:
+            if tracker.unmatched:
+                print(f"{tracker.unmatched} sales had an eventId that was not a requested event code, "
+                      f"the watermarks of their events are not advanced.")
+            new_marks = tracker.advance(watermarks)
+            selected = set(event_codes)
+            new_marks = {code: mark for code, mark in new_marks.items() if code in selected}
+            with stats.stage("watermarks"):
+                sales_watermark.save_watermarks(client, watermark_table_id, new_marks)
+            print(f"Advanced watermarks for {len(new_marks)} events.")
+
+        print(message)
+        return message, 200
+
+    except see_tickets_api.SeeTicketsAPIError as e:
+        print(f"Request failed: {e.status_code} {e.text}")
+        return f"Request failed: {e.status_code} {e.text}", e.status_code
     except requests.exceptions.RequestException as e:
         print(f"Error making API request: {e}")
         return f"Error making API request: {e}", 500
-    
-    # Handle the response
-    if response.status_code == 200:
+    except ValueError as e:
+        # Handle JSON parsing error
+        print(f"Error parsing JSON response: {e}")
+        return f"Error parsing JSON response: {e}", 500
+    except Exception as e:
+        # Catch-all for any other exceptions
+        print(f"An unexpected error occurred: {e}")
+        return f"An unexpected error occurred: {e}", 500
+    finally:
+        # Add the rows written so far to the daily summary, also when the run failed part way
+        if rollup is not None:
+            _update_summary(client, summary_table_id, table_id, rollup, stats)
+        # Keep the uniqueCodes written by this run; after a failure the next run rebuilds the index
+        if dedup is not None:
+            _save_dedup_index(dedup, written, stats)
+
+
+def _coordinate_shards(client, project_id, dataset_id, event_codes):
+    """Sends the shards of the selected events to the workers and sums up their results."""
+    start = end = None
+    if SALES_SHARD_START:
+        start = datetime.strptime(SALES_SHARD_START, "%Y-%m-%d").date()
+        end = datetime.now(timezone.utc).date() + timedelta(days=1)
+    shards = sales_shards.plan_shards(event_codes, SALES_SHARDS, start, end, SALES_SHARD_DAYS)
+    print(f"Sending {len(event_codes)} events to {len(shards)} shards.")
+
+    # Checkpoints are kept per shard id, so those of shards this plan no longer has are dropped
+    if CHECKPOINT_MODE == "on":
         try:
-            response_json = response.json()  # Attempt to parse the JSON response
-            
-            # Logging the response for debugging
-            print(f"API Response: {json.dumps(response_json, indent=4)}")
-            
-            # Prepare rows for BigQuery, only add new records
-            rows_to_insert = []
-            for record in response_json.get('data', []):
-                unique_code = record.get("uniqueCode")
-                
-                # Check if the record already exists
-                if unique_code not in existing_unique_codes:
-                    row = {
-                        "affiliate": record.get("affiliate"),
-                        "currency": record.get("currency"),
-                        "date": record.get("date"),
-                        "deliveryMethod": record.get("deliveryMethod"),
-                        "deviceModel": record.get("deviceModel"),
-                        "deviceType": record.get("deviceType"),
-                        "eventDate": record.get("eventDate"),
-                        "eventId": record.get("eventId"),
-                        "eventName": record.get("eventName"),
-                        "faceValue": record.get("faceValue"),
-                        "grossCost": record.get("grossCost"),
-                        "grossFace": record.get("grossFace"),
-                        "grossSales": record.get("grossSales"),
-                        "isInternetOrder": record.get("isInternetOrder"),
-                        "isPending": record.get("isPending"),
-                        "country": record.get("location", {}).get("country"),
-                        "countryIso": record.get("location", {}).get("countryIso"),
-                        "postCode": record.get("location", {}).get("postCode"),
-                        "region1": record.get("location", {}).get("region1"),
-                        "region2": record.get("location", {}).get("region2"),
-                        "region3": record.get("location", {}).get("region3"),
-                        "region4": record.get("location", {}).get("region4"),
-                        "offerCode": record.get("offerCode"),
-                        "partnerSite": record.get("partnerSite"),
-                        "paymentMethod": record.get("paymentMethod"),
-                        "priceId": record.get("priceId"),
-                        "priceName": record.get("priceName"),
-                        "salesChannel": record.get("salesChannel"),
-                        "sold": record.get("sold"),
-                        "source": record.get("source"),
-                        "taxTotal": record.get("taxTotal"),
-                        "ticketPrice": record.get("ticketPrice"),
-                        "uniqueCode": unique_code
-                    }
-                    rows_to_insert.append(row)
-            
-            # Insert new data into BigQuery
-            if rows_to_insert:
-                errors = client.insert_rows_json(table_id, rows_to_insert)
-                
+            checkpoint_table_id = f"{project_id}.{dataset_id}.{sync_checkpoint.CHECKPOINT_TABLE}"
+            sync_checkpoint.create_checkpoint_table_if_not_exists(client, project_id, dataset_id)
+            deleted = sync_checkpoint.delete_pending(
+                client, checkpoint_table_id, "hello_http/", [f"hello_http/{shard.id}" for shard in shards]
+            )
+            if deleted:
+                print(f"Deleted {deleted} unfinished checkpoints of shards that are no longer planned.")
+        except Exception as e:
+            print(f"Error deleting checkpoints of unplanned shards: {e}")
+
+    try:
+        if SALES_SHARD_BACKEND == "local":
+            backend = sales_shards.LocalBackend(hello_http, SALES_SHARD_WORKERS)
+        else:
+            backend = sales_shards.HttpBackend(SALES_SHARD_URL, SALES_SHARD_WORKERS)
+        results = sales_shards.dispatch(shards, backend, SALES_SHARD_RETRIES)
+    except Exception as e:
+        print(f"Error dispatching shards: {e}")
+        return f"Error dispatching shards: {e}", 500
+
+    message, status = sales_shards.summarize(results)
+    print(message)
+    return message, status
+
+
+def _fetch_batches(session, url, headers, request_plan, tracker, cache, stats):
+    """Yields the API records of every planned report in batches, observing their sale dates."""
+    for codes, filtered_by in request_plan:
+        # Payload for the API request, offset and limit are set per page
+        payload = {
+            "search": {
+                "forSearchItemType": "EVENT",
+                "searchItemCodes": codes
+            }
+        }
+        if filtered_by:
+            payload["filteredBy"] = filtered_by
+
+        if PARSE_MODE == "stream":
+            # Parse each page incrementally and hand over fixed-size batches
+            records = see_tickets_api.iter_records(
+                url, headers, payload, page_size=SALES_PAGE_SIZE, http=session, stats=stats
+            )
+            batches = stats.timed_iter(see_tickets_api.iter_batches(records, STREAM_BATCH_SIZE), "fetch", rows=len)
+        elif PIPELINE_MODE == "on":
+            # Hand over pages as they arrive, while the pages after them are still being fetched.
+            # They are regrouped into batches big enough to keep every insert worker busy.
+            pages = see_tickets_api.iter_pages(
+                url, headers, payload, page_size=SALES_PAGE_SIZE, max_workers=SALES_FETCH_WORKERS,
+                http=session, stats=stats, cache=cache
+            )
+            batches = see_tickets_api.iter_batches(itertools.chain.from_iterable(pages), STREAM_BATCH_SIZE)
+            batches = stats.timed_iter(batches, "fetch", rows=len)
+        else:
+            # Fetch every page of the report concurrently
+            with stats.stage("fetch"):
+                records, pages = see_tickets_api.fetch_all_pages(
+                    url, headers, payload, page_size=SALES_PAGE_SIZE, max_workers=SALES_FETCH_WORKERS,
+                    http=session, stats=stats, cache=cache
+                )
+            stats.add("fetch", rows=len(records))
+            print(f"Fetched {len(records)} records in {pages} pages for {len(codes)} events.")
+            batches = [records]
+
+        # Watermarks are kept per requested code, so the batch is observed with its report's codes
+        for batch in batches:
+            tracker.observe(batch, codes)
+            yield batch
+
+
+def _checkpointed_sync(client, table_id, checkpoint_table_id, summary_table_id, function_name, session, url, headers,
+                       checkpoints, existing_unique_codes, tracker, rollup, cache, stats):
+    """Writes every report window by window, saving the offset to resume from after each one.
+    Returns:
+        A tuple (inserted, errors, finished); finished is False when the time budget ran out
+        or a window failed, leaving the remaining pages to the next invocation.
+    """
+    deadline = time.monotonic() + CHECKPOINT_TIME_BUDGET_SECONDS if CHECKPOINT_TIME_BUDGET_SECONDS else None
+    inserted = 0
+    for checkpoint in checkpoints:
+        payload = {
+            "search": {
+                "forSearchItemType": "EVENT",
+                "searchItemCodes": checkpoint.codes
+            }
+        }
+        if checkpoint.filtered_by:
+            payload["filteredBy"] = checkpoint.filtered_by
+        if checkpoint.next_offset:
+            print(f"Resuming {len(checkpoint.codes)} events at offset {checkpoint.next_offset}.")
+
+        windows = see_tickets_api.iter_page_windows(
+            url, headers, payload, checkpoint.next_offset, page_size=SALES_PAGE_SIZE,
+            max_workers=SALES_FETCH_WORKERS, http=session, stats=stats, cache=cache
+        )
+        # The next window is fetched while this one is written; the checkpoint still follows the write.
+        # Not with the HTTP cache, whose commit after a window would also cover the prefetched one.
+        with pipeline.Pipeline(PIPELINE_DEPTH, PIPELINE_MODE == "on" and cache is None, stats) as stages:
+            windows = stages.stage(
+                stats.timed_iter(windows, "fetch", rows=lambda window: len(window[1])), "fetch"
+            )
+            for next_offset, records, done in windows:
+                tracker.observe(records, checkpoint.codes)
+                row_batches = _new_row_batches([records], existing_unique_codes, stats)
+                window_inserted, errors = _write_rows(client, table_id, row_batches, rollup, stats)
+                inserted += window_inserted
                 if errors:
-                    print(f"BigQuery Insertion Errors: {errors}")
-                    return f"Encountered errors while inserting rows: {errors}", 500
-                
-                print(f"Successfully inserted {len(rows_to_insert)} new rows.")
-                return f"Successfully inserted {len(rows_to_insert)} new rows.", 200
+                    return inserted, errors, False
+                if rollup is not None:
+                    _update_summary(client, summary_table_id, table_id, rollup, stats)
+
+                # The window is stored, so the next run can start after it
+                checkpoint.advance(next_offset)
+                checkpoint.completed = done
+                with stats.stage("checkpoints"):
+                    sync_checkpoint.save_checkpoint(client, checkpoint_table_id, function_name, checkpoint)
+                if cache is not None:
+                    cache.commit()
+
+                if not done and deadline and time.monotonic() > deadline:
+                    print(f"Time budget spent, checkpointed {len(checkpoint.codes)} events at offset {next_offset}.")
+                    return inserted, [], False
+    return inserted, [], True
+
+
+def _write_rows(client, table_id, row_batches, rollup, stats):
+    """Writes batches of rows with the configured sink.
+
+    The rows that are written are added to the rollup, if there is one. A streaming insert
+    that fails part way marks it dirty, as it is not known which of the rows were stored.
+    Returns:
+        A tuple (inserted, errors) with the number of rows written and the rows that failed.
+    """
+    # Time spent pulling rows from the fetch and transform stages is counted there
+    with stats.stage("insert"):
+        # Merge the rows through a staging table, the MERGE skips existing uniqueCodes
+        if DEDUP_MODE == "merge":
+            inserted = bigquery_sink.merge_rows(
+                client, table_id, column_batch.iter_row_dicts(row_batches), "uniqueCode", stats=stats,
+                partition_field=table_layout.SALES_PARTITION_FIELD
+            )
+            return inserted, []
+
+        # Append the new rows with a single load job instead of streaming them. The job stores
+        # all of its rows or none, so their totals are only kept once it succeeded.
+        if WRITE_MODE == "load":
+            loaded = sales_rollup.DailyRollup() if rollup is not None else None
+            inserted = bigquery_sink.load_rows(
+                client, table_id, column_batch.iter_row_dicts(_rolled_up(row_batches, loaded, stats)),
+                source_format=LOAD_FORMAT, stats=stats
+            )
+            if rollup is not None:
+                rollup.update(loaded)
+            return inserted, []
+
+        # Insert new data into BigQuery, with the uniqueCode as insertId so resent rows are dropped
+        inserted = 0
+        errors = []
+        for rows_to_insert in row_batches:
+            try:
+                batch_errors = bigquery_sink.insert_rows_chunked(
+                    client, table_id, rows_to_insert,
+                    max_rows=INSERT_CHUNK_ROWS, max_bytes=INSERT_CHUNK_BYTES, max_workers=INSERT_WORKERS,
+                    stats=stats, row_ids=column_batch.column_values(rows_to_insert, "uniqueCode")
+                )
+            except Exception:
+                if rollup is not None:
+                    rollup.dirty = True
+                raise
+            inserted += len(rows_to_insert) - len(batch_errors)
+            errors.extend(batch_errors)
+            if rollup is not None and batch_errors:
+                rollup.dirty = True
+            elif rollup is not None:
+                with stats.stage("rollup"):
+                    rollup.add(rows_to_insert)
+        return inserted, errors
+
+
+def _rolled_up(row_batches, rollup, stats):
+    """Passes the batches through, adding each one to the rollup if there is one."""
+    for rows in row_batches:
+        if rollup is not None:
+            with stats.stage("rollup"):
+                rollup.add(rows)
+        yield rows
+
+
+def _save_dedup_index(dedup, written, stats):
+    """Saves the keys added to the dedup index, or marks it for a rebuild if the write failed."""
+    try:
+        with stats.stage("existing_keys"):
+            # Keys are added before their rows are sent, so no added keys means nothing was written
+            if not dedup.added:
+                dedup.close()
+                return
+            dedup.save(DEDUP_INDEX_PATH, reconciled_at=None if written else 0)
+            if DEDUP_INDEX_BUCKET:
+                dedup_index.publish(DEDUP_INDEX_BUCKET, dedup, DEDUP_INDEX_PATH)
+            keys = len(dedup)
+            dedup.close()
+        if written:
+            print(f"Saved dedup index with {keys} keys.")
+        else:
+            print("Marked the dedup index for a rebuild after the failed write.")
+    except Exception as e:
+        print(f"Error saving dedup index: {e}")
+
+
+def _update_summary(client, summary_table_id, table_id, rollup, stats):
+    """Adds the totals collected so far to the summary table and starts new ones.
+
+    A dirty rollup, or one whose merge fails, is dropped and the summary is rebuilt from the
+    sales table instead. If the rebuild fails too, the summary stays marked for the next run.
+    """
+    try:
+        if not rollup.dirty:
+            if not rollup.rows:
+                return
+            try:
+                with stats.stage("rollup"):
+                    merged = sales_rollup.merge_summary(client, summary_table_id, rollup)
+                stats.add("rollup", rows=rollup.rows)
+                print(f"Merged {rollup.rows} rows into {merged} daily summary rows.")
+                return
+            except Exception as e:
+                print(f"Error merging the daily summary, rebuilding it: {e}")
+        with stats.stage("rollup"):
+            sales_rollup.rebuild_summary(client, summary_table_id, table_id)
+        print(f"Rebuilt the daily summary from {table_id}.")
+    except Exception as e:
+        print(f"Error rebuilding the daily summary, the next run retries: {e}")
+    finally:
+        rollup.clear()
+
+
+def _new_row_batches(batches, existing_unique_codes, stats):
+    """Yields the BigQuery rows of every batch, skipping records that already exist."""
+    for batch in batches:
+        # Read the existing uniqueCodes of the partitions this batch can fall in
+        if isinstance(existing_unique_codes, table_layout.PartitionedKeys):
+            with stats.stage("existing_keys"):
+                existing_unique_codes.check_cluster_values(record.get("eventId") for record in batch)
+                loaded = existing_unique_codes.load(
+                    table_layout.partition_days(record.get("date") for record in batch)
+                )
+            stats.add("existing_keys", rows=loaded)
+
+        with stats.stage("transform"):
+            if ROW_FORMAT == "columns":
+                rows = column_batch.sales_batch(
+                    record for record in batch if record.get("uniqueCode") not in existing_unique_codes
+                )
             else:
-                print("No new data to insert.")
-                return "No new data to insert.", 200
-        
-        except ValueError as e:
-            # Handle JSON parsing error
-            print(f"Error parsing JSON response: {e}")
-            return f"Error parsing JSON response: {e}", 500
-        except Exception as e:
-            # Catch-all for any other exceptions
-            print(f"An unexpected error occurred: {e}")
-            return f"An unexpected error occurred: {e}", 500
-    else:
-        print(f"Request failed: {response.status_code} {response.text}")
-        return f"Request failed: {response.status_code} {response.text}", response.status_code
\ No newline at end of file
+                rows = [
+                    record_transform.transform_sale(record)
+                    for record in batch
+                    if record.get("uniqueCode") not in existing_unique_codes
+                ]
+            # The index only keeps these keys if the whole run is written without errors
+            if DEDUP_MODE == "index":
+                existing_unique_codes.add(column_batch.column_values(rows, "uniqueCode"))
+        stats.add("transform", rows=len(rows))
+        yield rows
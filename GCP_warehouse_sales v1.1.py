@@ -1,64 +1,66 @@
 import functions_framework
-import requests
-import json
-from google.cloud import bigquery
-from google.cloud import secretmanager
-from datetime import datetime
-
-def create_table_if_not_exists(client, project_id, dataset_id, table_id):
-    """Creates a new BigQuery table with a specified schema if it does not exist."""
-    schema = [
-        bigquery.SchemaField("affiliate", "STRING"),
-        bigquery.SchemaField("currency", "STRING"),
-        bigquery.SchemaField("date", "STRING"),
-        bigquery.SchemaField("deliveryMethod", "STRING"),
-        bigquery.SchemaField("deviceModel", "STRING"),
-        bigquery.SchemaField("deviceType", "STRING"),
-        bigquery.SchemaField("eventDate", "STRING"),
-        bigquery.SchemaField("eventId", "STRING"),
-        bigquery.SchemaField("eventName", "STRING"),
-        bigquery.SchemaField("faceValue", "FLOAT"),
-        bigquery.SchemaField("grossCost", "FLOAT"),
-        bigquery.SchemaField("grossFace", "FLOAT"),
-        bigquery.SchemaField("grossSales", "FLOAT"),
-        bigquery.SchemaField("isInternetOrder", "BOOL"),
-        bigquery.SchemaField("isPending", "BOOL"),
-        bigquery.SchemaField("country", "STRING"),
-        bigquery.SchemaField("countryIso", "STRING"),
-        bigquery.SchemaField("postCode", "STRING"),
-        bigquery.SchemaField("region1", "STRING"),
-        bigquery.SchemaField("region2", "STRING"),
-        bigquery.SchemaField("region3", "STRING"),
-        bigquery.SchemaField("region4", "STRING"),
-        bigquery.SchemaField("offerCode", "STRING"),
-        bigquery.SchemaField("partnerSite", "STRING"),
-        bigquery.SchemaField("paymentMethod", "STRING"),
-        bigquery.SchemaField("priceId", "STRING"),
-        bigquery.SchemaField("priceName", "STRING"),
-        bigquery.SchemaField("salesChannel", "STRING"),
-        bigquery.SchemaField("sold", "INTEGER"),
-        bigquery.SchemaField("source", "STRING"),
-        bigquery.SchemaField("taxTotal", "FLOAT"),
-        bigquery.SchemaField("ticketPrice", "FLOAT"),
-        bigquery.SchemaField("uniqueCode", "STRING")
-    ]
-
-    # Set table reference with the full project, dataset, and table name
-    table_ref = bigquery.Table(f"{project_id}.{dataset_id}.{table_id}", schema=schema)
-    try:
-        client.create_table(table_ref)
-        print(f"Created table {table_id}")
-    except Exception as e:
-        if "Already Exists" in str(e):
-            print(f"Table {table_id} already exists.")
-        else:
-            raise e
+import itertools
+import os
+import time
+
+import bigquery_sink
+import column_batch
+import gcp_resources
+import instrumentation
+import lazy_imports
+import pipeline
+import record_transform
+import see_tickets_api
+import sync_checkpoint
+import table_layout
+import warehouse_snapshot
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+requests = lazy_imports.module("requests")
+
+# Page size and number of concurrent page requests for the sales report
+SALES_PAGE_SIZE = int(os.environ.get("SALES_PAGE_SIZE", see_tickets_api.DEFAULT_PAGE_SIZE))
+SALES_FETCH_WORKERS = int(os.environ.get("SALES_FETCH_WORKERS", see_tickets_api.DEFAULT_MAX_WORKERS))
+
+# Streaming inserts are split into chunks bounded by rows and bytes and sent concurrently
+INSERT_CHUNK_ROWS = int(os.environ.get("INSERT_CHUNK_ROWS", bigquery_sink.DEFAULT_CHUNK_ROWS))
+INSERT_CHUNK_BYTES = int(os.environ.get("INSERT_CHUNK_BYTES", bigquery_sink.DEFAULT_CHUNK_BYTES))
+INSERT_WORKERS = int(os.environ.get("INSERT_WORKERS", bigquery_sink.DEFAULT_INSERT_WORKERS))
+
+# "stream" uses streaming inserts, "load" writes a compressed file and submits one load job
+WRITE_MODE = os.environ.get("WRITE_MODE", "stream")
+LOAD_FORMAT = os.environ.get("LOAD_FORMAT", "ndjson")
+
+# "on" writes the report in windows of SALES_FETCH_WORKERS pages and checkpoints the offset after each
+# one, so a run that times out is resumed by the next invocation; 0 disables the time budget
+CHECKPOINT_MODE = os.environ.get("CHECKPOINT_MODE", "off")
+CHECKPOINT_TIME_BUDGET_SECONDS = float(os.environ.get("CHECKPOINT_TIME_BUDGET_SECONDS", "0"))
+
+# "buffered" parses whole pages with response.json(), "stream" parses the data array incrementally
+PARSE_MODE = os.environ.get("PARSE_MODE", "buffered")
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", see_tickets_api.DEFAULT_BATCH_SIZE))
+
+# "dicts" builds a dict per row, "columns" keeps each batch in a compact column_batch.ColumnBatch
+ROW_FORMAT = os.environ.get("ROW_FORMAT", "dicts")
+
+# "on" runs fetch, transform and insert in overlapping threads, connected by queues holding
+# at most PIPELINE_DEPTH batches each
+PIPELINE_MODE = os.environ.get("PIPELINE_MODE", "off")
+PIPELINE_DEPTH = int(os.environ.get("PIPELINE_DEPTH", pipeline.DEFAULT_DEPTH))
+
+# "replace" truncates and reloads the table on every run, "diff" compares the fetch with a snapshot
+# of the previous load and only writes the rows that were inserted, updated or deleted since
+WAREHOUSE_SYNC_MODE = os.environ.get("WAREHOUSE_SYNC_MODE", "replace")
+WAREHOUSE_SNAPSHOT_PATH = os.environ.get("WAREHOUSE_SNAPSHOT_PATH", "/tmp/warehouse_sales.snap")
+
 
 @functions_framework.http
-def warehousesales(request):
+@instrumentation.instrumented("warehousesales")
+def warehousesales(request, stats):
     """HTTP Cloud Function to fetch data from See Tickets API and insert it into BigQuery.
     Args:
         request (flask.Request): The request object.
+        stats (instrumentation.Invocation): Per-stage counters, logged when the invocation ends.
     Returns:
         The response text indicating success or failure.
     """
@@ -71,139 +73,288 @@ def warehousesales(request):
     project_id = "see-tickets-433213"
     dataset_id = "seetickets_data"
     table_name = "warehouse_sales"  # Fixed table name
+    checkpoint_table_id = f"{project_id}.{dataset_id}.{sync_checkpoint.CHECKPOINT_TABLE}"
 
-    # Initialize BigQuery client with explicit project ID
-    client = bigquery.Client(project=project_id)
+    # Events whose sales are synced
+    event_codes = ['DF-2974218', 'DF-2974224', 'DF-2974228', 'DF-2974229', 'DF-2974230', 'DF-2974231', 'DF-2974360', 'DF-2974361', 'DF-2974362', 'DF-2974363']
 
-    # Create the table if it does not exist
+    # Shared BigQuery client, created once per instance
+    client = gcp_resources.bigquery_client(project_id)
+
+    # Create the table, partitioned on the sale date, if it does not exist
     try:
-        create_table_if_not_exists(client, project_id, dataset_id, table_name)
+        with stats.stage("table"):
+            table_layout.create_sales_table_if_not_exists(client, f"{project_id}.{dataset_id}.{table_name}")
     except Exception as e:
         print(f"Error creating table: {e}")
         return f"Error creating table: {e}", 500
 
-    # Delete existing data from the table
-    try:
-        query = f"TRUNCATE TABLE `{project_id}.{dataset_id}.{table_name}`"
-        query_job = client.query(query)
-        query_job.result()  # Waits for job to complete
-        print(f"Cleared data from table {table_name}")
-    except Exception as e:
-        print(f"Error clearing data from table: {e}")
-        return f"Error clearing data from table: {e}", 500
+    # In checkpoint mode pick up the run a previous invocation left unfinished
+    checkpoint = None
+    if CHECKPOINT_MODE == "on":
+        try:
+            with stats.stage("checkpoints"):
+                sync_checkpoint.create_checkpoint_table_if_not_exists(client, project_id, dataset_id)
+                pending = sync_checkpoint.load_pending(client, checkpoint_table_id, "warehousesales")
+            checkpoint = pending.get(sync_checkpoint.report_key(event_codes)) or sync_checkpoint.Checkpoint(event_codes)
+        except Exception as e:
+            print(f"Error loading checkpoints: {e}")
+            return f"Error loading checkpoints: {e}", 500
+    resuming = checkpoint is not None and checkpoint.next_offset > 0
 
-    # Initialize Secret Manager client
-    secret_client = secretmanager.SecretManagerServiceClient()
+    # A diff needs the whole report in one run, checkpointed runs reload the table instead
+    diff_mode = WAREHOUSE_SYNC_MODE == "diff"
+    if diff_mode and checkpoint is not None:
+        print("WAREHOUSE_SYNC_MODE diff needs CHECKPOINT_MODE off, the table is reloaded.")
+        diff_mode = False
 
-    # Build the resource name of the secret
-    secret_name = f"projects/{project_id}/secrets/SEE_TICKETS_API_KEY/versions/latest"
+    # Delete existing data from the table, load mode replaces it in the load job instead.
+    # Checkpointed runs append window by window and keep the rows of the run they resume,
+    # diff mode only touches the rows that changed.
+    if (WRITE_MODE != "load" or checkpoint is not None) and not resuming and not diff_mode:
+        try:
+            with stats.stage("table"):
+                query = f"TRUNCATE TABLE `{project_id}.{dataset_id}.{table_name}`"
+                query_job = client.query(query)
+                query_job.result()  # Waits for job to complete
+            print(f"Cleared data from table {table_name}")
+        except Exception as e:
+            print(f"Error clearing data from table: {e}")
+            return f"Error clearing data from table: {e}", 500
+
+    # In diff mode compare the fetch with the snapshot of the table's current contents
+    snapshot = None
+    if diff_mode:
+        try:
+            with stats.stage("snapshot"):
+                table_ref = f"{project_id}.{dataset_id}.{table_name}"
+                snapshot = warehouse_snapshot.open_snapshot(WAREHOUSE_SNAPSHOT_PATH, client.get_table(table_ref))
+            if snapshot is not None:
+                stats.add("snapshot", rows=len(snapshot))
+                print(f"Loaded a snapshot of {len(snapshot)} rows.")
+        except Exception as e:
+            print(f"Error loading snapshot: {e}")
+            return f"Error loading snapshot: {e}", 500
 
     try:
-        # Access the secret version
-        response = secret_client.access_secret_version(name=secret_name)
-        api_key = response.payload.data.decode("UTF-8")
+        # Access the secret version, cached across warm invocations
+        with stats.stage("secret"):
+            api_key = gcp_resources.api_key(project_id)
         print("Successfully accessed the API key from Secret Manager.")
     except Exception as e:
         print(f"Error accessing secret: {e}")
         return f"Error accessing secret: {e}", 500
 
-    # URL and headers for the API request
-    url = "https://clients-api.seetickets.com/v1/reports/sales"
+    # URL, headers and pooled keep-alive session for the API requests
+    url = see_tickets_api.SALES_URL
+    session = gcp_resources.see_tickets_session(project_id)
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
 
-    # Payload for the API request
+    # Payload for the API request, offset and limit are set per page
     payload = {
-        "offset": 0,
         "search": {
             "forSearchItemType": "EVENT",
-            "searchItemCodes": ['DF-2974218', 'DF-2974224', 'DF-2974228', 'DF-2974229', 'DF-2974230', 'DF-2974231', 'DF-2974360', 'DF-2974361', 'DF-2974362', 'DF-2974363']
+            "searchItemCodes": event_codes
         }
     }
 
-    # Make the API request
     try:
-        print("Sending request to See Tickets API...")
-        response = requests.post(url, headers=headers, data=json.dumps(payload))
-        print(f"Received response with status code {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error making API request: {e}")
-        return f"Error making API request: {e}", 500
+        print("Sending requests to See Tickets API...")
+        if checkpoint is not None:
+            if resuming:
+                print(f"Resuming at offset {checkpoint.next_offset}.")
+            inserted, errors, finished = _checkpointed_sync(
+                client, f"{project_id}.{dataset_id}.{table_name}", checkpoint_table_id, session, url, headers,
+                payload, checkpoint, stats
+            )
+            if errors:
+                print(f"BigQuery Insertion Errors: {errors}")
+                return f"Encountered errors while inserting rows: {errors}", 500
+            if not finished:
+                message = f"Inserted {inserted} rows, stopped at a checkpoint before the time budget ran out."
+                print(message)
+                return message, 200
+            print(f"Successfully inserted {inserted} rows.")
+            return f"Successfully inserted {inserted} rows.", 200
 
-    # Handle the response
-    if response.status_code == 200:
-        try:
-            response_json = response.json()  # Attempt to parse the JSON response
-
-            # Logging the response for debugging
-            print(f"API Response: {json.dumps(response_json, indent=4)}")
-
-            # Prepare rows for BigQuery
-            rows_to_insert = []
-            for record in response_json.get('data', []):
-                row = {
-                    "affiliate": record.get("affiliate"),
-                    "currency": record.get("currency"),
-                    "date": record.get("date"),
-                    "deliveryMethod": record.get("deliveryMethod"),
-                    "deviceModel": record.get("deviceModel"),
-                    "deviceType": record.get("deviceType"),
-                    "eventDate": record.get("eventDate"),
-                    "eventId": record.get("eventId"),
-                    "eventName": record.get("eventName"),
-                    "faceValue": record.get("faceValue"),
-                    "grossCost": record.get("grossCost"),
-                    "grossFace": record.get("grossFace"),
-                    "grossSales": record.get("grossSales"),
-                    "isInternetOrder": record.get("isInternetOrder"),
-                    "isPending": record.get("isPending"),
-                    "country": record.get("location", {}).get("country"),
-                    "countryIso": record.get("location", {}).get("countryIso"),
-                    "postCode": record.get("location", {}).get("postCode"),
-                    "region1": record.get("location", {}).get("region1"),
-                    "region2": record.get("location", {}).get("region2"),
-                    "region3": record.get("location", {}).get("region3"),
-                    "region4": record.get("location", {}).get("region4"),
-                    "offerCode": record.get("offerCode"),
-                    "partnerSite": record.get("partnerSite"),
-                    "paymentMethod": record.get("paymentMethod"),
-                    "priceId": record.get("priceId"),
-                    "priceName": record.get("priceName"),
-                    "salesChannel": record.get("salesChannel"),
-                    "sold": record.get("sold"),
-                    "source": record.get("source"),
-                    "taxTotal": record.get("taxTotal"),
-                    "ticketPrice": record.get("ticketPrice"),
-                    "uniqueCode": record.get("uniqueCode")
-                }
-                rows_to_insert.append(row)
+        if PARSE_MODE == "stream":
+            # Parse each page incrementally and hand over fixed-size batches
+            records = see_tickets_api.iter_records(
+                url, headers, payload, page_size=SALES_PAGE_SIZE, http=session, stats=stats
+            )
+            batches = stats.timed_iter(see_tickets_api.iter_batches(records, STREAM_BATCH_SIZE), "fetch", rows=len)
+        elif PIPELINE_MODE == "on":
+            # Hand over pages as they arrive, regrouped into batches big enough for every insert worker
+            pages = see_tickets_api.iter_pages(
+                url, headers, payload, page_size=SALES_PAGE_SIZE, max_workers=SALES_FETCH_WORKERS,
+                http=session, stats=stats
+            )
+            records = itertools.chain.from_iterable(pages)
+            batches = stats.timed_iter(see_tickets_api.iter_batches(records, STREAM_BATCH_SIZE), "fetch", rows=len)
+        else:
+            # Fetch every page of the report concurrently
+            with stats.stage("fetch"):
+                records, pages = see_tickets_api.fetch_all_pages(
+                    url, headers, payload, page_size=SALES_PAGE_SIZE, max_workers=SALES_FETCH_WORKERS,
+                    http=session, stats=stats
+                )
+            stats.add("fetch", rows=len(records))
+            print(f"Fetched {len(records)} records in {pages} pages.")
+            batches = [records]
+
+        # Prepare rows for BigQuery; in pipeline mode fetch, transform and insert overlap
+        with pipeline.Pipeline(PIPELINE_DEPTH, PIPELINE_MODE == "on", stats) as stages:
+            batches = stages.stage(batches, "fetch")
+            row_batches = stages.stage(_row_batches(batches, stats), "transform")
+
+            # Write only the difference with the previous load
+            if diff_mode:
+                return _diff_sync(client, f"{project_id}.{dataset_id}.{table_name}", row_batches, snapshot, stats)
+
+            # Replace the table contents atomically with a single WRITE_TRUNCATE load job
+            if WRITE_MODE == "load":
+                print(f"Loading rows into BigQuery table {table_name}...")
+                with stats.stage("insert"):
+                    loaded = bigquery_sink.load_rows(
+                        client, f"{project_id}.{dataset_id}.{table_name}", column_batch.iter_row_dicts(row_batches),
+                        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE, source_format=LOAD_FORMAT,
+                        stats=stats
+                    )
+                print(f"Successfully loaded {loaded} rows.")
+                return f"Successfully loaded {loaded} rows.", 200
 
             # Insert new data into BigQuery
-            if rows_to_insert:
+            inserted = 0
+            errors = []
+            for rows_to_insert in row_batches:
                 print(f"Inserting {len(rows_to_insert)} rows into BigQuery table {table_name}...")
                 # Use the fully qualified table ID, including project, dataset, and table name
-                errors = client.insert_rows_json(f"{project_id}.{dataset_id}.{table_name}", rows_to_insert)
+                with stats.stage("insert"):
+                    batch_errors = bigquery_sink.insert_rows_chunked(
+                        client, f"{project_id}.{dataset_id}.{table_name}", rows_to_insert,
+                        max_rows=INSERT_CHUNK_ROWS, max_bytes=INSERT_CHUNK_BYTES, max_workers=INSERT_WORKERS,
+                        stats=stats, row_ids=column_batch.column_values(rows_to_insert, "uniqueCode")
+                    )
+                inserted += len(rows_to_insert) - len(batch_errors)
+                errors.extend(batch_errors)
 
-                if errors:
-                    print(f"BigQuery Insertion Errors: {errors}")
-                    return f"Encountered errors while inserting rows: {errors}", 500
+        if errors:
+            print(f"BigQuery Insertion Errors: {errors}")
+            return f"Encountered errors while inserting rows: {errors}", 500
 
-                print(f"Successfully inserted {len(rows_to_insert)} new rows.")
-                return f"Successfully inserted {len(rows_to_insert)} new rows.", 200
-            else:
-                print("No new data to insert.")
-                return "No new data to insert.", 200
+        if inserted:
+            print(f"Successfully inserted {inserted} new rows.")
+            return f"Successfully inserted {inserted} new rows.", 200
+        else:
+            print("No new data to insert.")
+            return "No new data to insert.", 200
 
-        except ValueError as e:
-            # Handle JSON parsing error
-            print(f"Error parsing JSON response: {e}")
-            return f"Error parsing JSON response: {e}", 500
-        except Exception as e:
-            # Catch-all for any other exceptions
-            print(f"An unexpected error occurred: {e}")
-            return f"An unexpected error occurred: {e}", 500
+    except see_tickets_api.SeeTicketsAPIError as e:
+        print(f"Request failed: {e.status_code} {e.text}")
+        return f"Request failed: {e.status_code} {e.text}", e.status_code
+    except requests.exceptions.RequestException as e:
+        print(f"Error making API request: {e}")
+        return f"Error making API request: {e}", 500
+    except ValueError as e:
+        # Handle JSON parsing error
+        print(f"Error parsing JSON response: {e}")
+        return f"Error parsing JSON response: {e}", 500
+    except Exception as e:
+        # Catch-all for any other exceptions
+        print(f"An unexpected error occurred: {e}")
+        return f"An unexpected error occurred: {e}", 500
+
+
+def _checkpointed_sync(client, table_id, checkpoint_table_id, session, url, headers, payload, checkpoint, stats):
+    """Appends the report window by window, saving the offset to resume from after each one.
+    Returns:
+        A tuple (inserted, errors, finished); finished is False when the time budget ran out
+        or a window failed, leaving the remaining pages to the next invocation.
+    """
+    deadline = time.monotonic() + CHECKPOINT_TIME_BUDGET_SECONDS if CHECKPOINT_TIME_BUDGET_SECONDS else None
+    inserted = 0
+    windows = see_tickets_api.iter_page_windows(
+        url, headers, payload, checkpoint.next_offset, page_size=SALES_PAGE_SIZE,
+        max_workers=SALES_FETCH_WORKERS, http=session, stats=stats
+    )
+    # The next window is fetched while this one is written; the checkpoint still follows the write
+    with pipeline.Pipeline(PIPELINE_DEPTH, PIPELINE_MODE == "on", stats) as stages:
+        windows = stages.stage(
+            stats.timed_iter(windows, "fetch", rows=lambda window: len(window[1])), "fetch"
+        )
+        for next_offset, records, done in windows:
+            rows_to_insert = next(_row_batches([records], stats))
+            with stats.stage("insert"):
+                if WRITE_MODE == "load":
+                    inserted += bigquery_sink.load_rows(
+                        client, table_id, rows_to_insert, source_format=LOAD_FORMAT, stats=stats
+                    )
+                else:
+                    # The uniqueCode is the insertId, so rows resent after a failed window are dropped
+                    errors = bigquery_sink.insert_rows_chunked(
+                        client, table_id, rows_to_insert,
+                        max_rows=INSERT_CHUNK_ROWS, max_bytes=INSERT_CHUNK_BYTES, max_workers=INSERT_WORKERS,
+                        stats=stats, row_ids=column_batch.column_values(rows_to_insert, "uniqueCode")
+                    )
+                    inserted += len(rows_to_insert) - len(errors)
+                    if errors:
+                        return inserted, errors, False
+
+            # The window is stored, so the next run can start after it
+            checkpoint.advance(next_offset)
+            checkpoint.completed = done
+            with stats.stage("checkpoints"):
+                sync_checkpoint.save_checkpoint(client, checkpoint_table_id, "warehousesales", checkpoint)
+
+            if not done and deadline and time.monotonic() > deadline:
+                print(f"Time budget spent, checkpointed at offset {next_offset}.")
+                return inserted, [], False
+    return inserted, [], True
+
+
+def _diff_sync(client, table_id, row_batches, snapshot, stats):
+    """Applies the rows inserted, updated and deleted since the snapshot, then snapshots the table again.
+
+    Without a snapshot of the table's current version the table is replaced with a
+    WRITE_TRUNCATE load job, which is never seen empty, and the loaded rows are snapshotted.
+    Returns:
+        The response text and status.
+    """
+    diff = warehouse_snapshot.SnapshotDiff(snapshot)
+    if snapshot is None:
+        print(f"Reloading BigQuery table {table_id}...")
+        with stats.stage("insert"):
+            loaded = bigquery_sink.load_rows(
+                client, table_id, diff.tracked(column_batch.iter_row_dicts(row_batches)),
+                write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE, source_format=LOAD_FORMAT, stats=stats
+            )
+        message = f"Successfully loaded {loaded} rows."
     else:
-        print(f"Request failed: {response.status_code} {response.text}")
-        return f"Request failed: {response.status_code} {response.text}", response.status_code
+        with stats.stage("snapshot"):
+            for rows_to_diff in row_batches:
+                diff.add(rows_to_diff)
+        stats.add("snapshot", rows=len(diff.seen))
+        with stats.stage("insert"):
+            deleted = warehouse_snapshot.apply(client, table_id, diff, stats=stats)
+        message = f"Applied {diff.inserts} inserts, {diff.updates} updates and {deleted} deletes."
+
+    # The snapshot records the table version right after the write, a later write elsewhere invalidates it
+    with stats.stage("snapshot"):
+        diff.new_snapshot(warehouse_snapshot.table_version(client.get_table(table_id))).save(WAREHOUSE_SNAPSHOT_PATH)
+    print(message)
+    return message, 200
+
+
+def _row_batches(batches, stats):
+    """Yields the BigQuery rows of every batch of API records."""
+    for batch in batches:
+        with stats.stage("transform"):
+            if ROW_FORMAT == "columns":
+                rows = column_batch.sales_batch(batch)
+            else:
+                rows = [record_transform.transform_sale(record) for record in batch]
+        stats.add("transform", rows=len(rows))
+        yield rows
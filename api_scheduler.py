@@ -0,0 +1,193 @@
+# Rate limiting, retries and adaptive concurrency for See Tickets API calls
+
+import email.utils
+import os
+import random
+import threading
+import time
+
+import lazy_imports
+
+requests = lazy_imports.module("requests")
+
+# Requests per second allowed by the API quota (0 = no limit) and how many may be sent in a burst
+API_RATE_LIMIT = float(os.environ.get("API_RATE_LIMIT", "0"))
+API_BURST = int(os.environ.get("API_BURST", "10"))
+
+# Bounds of the concurrency limit the AIMD controller moves between
+API_MIN_CONCURRENCY = int(os.environ.get("API_MIN_CONCURRENCY", "1"))
+API_MAX_CONCURRENCY = int(os.environ.get("API_MAX_CONCURRENCY", "8"))
+
+# Responses slower than this count as congestion, like a 429
+API_LATENCY_TARGET_SECONDS = float(os.environ.get("API_LATENCY_TARGET_SECONDS", "10"))
+
+# Attempts per request after the first, and the exponential backoff between them
+API_MAX_RETRIES = int(os.environ.get("API_MAX_RETRIES", "5"))
+API_RETRY_BASE_DELAY = float(os.environ.get("API_RETRY_BASE_DELAY", "0.5"))
+API_RETRY_MAX_DELAY = float(os.environ.get("API_RETRY_MAX_DELAY", "30"))
+
+# Status codes worth sending again; 429 also lowers the concurrency limit
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to capacity."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AIMDLimiter:
+    """Concurrency limit with additive increase and multiplicative decrease.
+
+    Every successful request raises the limit by increase / limit, so a full window of
+    requests raises it by about increase. A throttled or slow request multiplies it by
+    decrease, at most once per round trip so that one burst of 429s counts once.
+    """
+
+    def __init__(self, initial, minimum, maximum, increase=1.0, decrease=0.5, latency_target=None):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self._hold_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Blocks until fewer requests than the current limit are in flight."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, congested=False):
+        """Frees a slot and adjusts the limit from the outcome of the request."""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if congested or (self.latency_target and latency > self.latency_target):
+                if now >= self._hold_until:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._hold_until = now + latency
+            else:
+                self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+
+def retry_after_seconds(response):
+    """Returns the delay requested by a Retry-After header (seconds or HTTP date), or None."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler:
+    """Sends API requests through a token bucket and an AIMD concurrency limit, with retries.
+
+    429 and 5xx responses and connection errors are retried with jittered exponential
+    backoff. A Retry-After header pauses every request sent through the scheduler, not
+    only the one that was throttled, since the quota is shared.
+    """
+
+    def __init__(self, rate=API_RATE_LIMIT, burst=API_BURST, min_concurrency=API_MIN_CONCURRENCY,
+                 max_concurrency=API_MAX_CONCURRENCY, latency_target=API_LATENCY_TARGET_SECONDS,
+                 max_retries=API_MAX_RETRIES, base_delay=API_RETRY_BASE_DELAY, max_delay=API_RETRY_MAX_DELAY):
+        self.bucket = TokenBucket(rate, burst)
+        self.limiter = AIMDLimiter(max_concurrency, min_concurrency, max_concurrency, latency_target=latency_target)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.paused_until = 0.0
+        self.counters = {"requests": 0, "retries": 0, "throttled": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff for the given retry attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def send(self, send):
+        """Calls send() under the rate and concurrency limits and returns its response.
+
+        The last response is returned as it is once the retries are used up, so callers
+        still see the status code; the last connection error is raised.
+        """
+        for attempt in range(self.max_retries + 1):
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            self.bucket.acquire()
+            self.limiter.acquire()
+            self._count("requests")
+            start = time.monotonic()
+            try:
+                response = send()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.limiter.release(time.monotonic() - start, congested=True)
+                self._count("errors")
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(f"API request failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                self._count("retries")
+                continue
+            except BaseException:
+                self.limiter.release(time.monotonic() - start)
+                raise
+
+            throttled = response.status_code == 429
+            self.limiter.release(time.monotonic() - start, congested=throttled)
+            if response.status_code not in RETRYABLE_STATUSES or attempt == self.max_retries:
+                return response
+
+            delay = retry_after_seconds(response)
+            if throttled:
+                self._count("throttled")
+                if delay is not None:
+                    with self._lock:
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            delay = self.backoff(attempt) if delay is None else delay + random.uniform(0, self.base_delay)
+            print(f"API answered {response.status_code}, retrying in {delay:.1f}s "
+                  f"(concurrency limit {int(self.limiter.limit)})")
+            response.close()
+            time.sleep(delay)
+            self._count("retries")
+
+    def snapshot(self):
+        """Returns the current limits and counters."""
+        with self._lock:
+            return dict(self.counters, concurrency_limit=round(self.limiter.limit, 2), rate=self.bucket.rate)
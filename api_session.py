@@ -0,0 +1,43 @@
+# Pooled keep-alive HTTP session for See Tickets API calls
+#
+# Kept apart from gcp_resources so that requests is only imported once an invocation
+# actually calls the API, not when the function module is loaded.
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class SeeTicketsSession(requests.Session):
+    """Keep-alive session that authenticates with the cached API key and refreshes it once on 401.
+
+    Requests go through the shared RequestScheduler, which rate limits them and retries
+    429 and 5xx responses.
+    """
+
+    def __init__(self, api_key, scheduler, pool_size):
+        """
+        Args:
+            api_key (callable): Returns the API key; called with refresh=True after a 401.
+            scheduler (api_scheduler.RequestScheduler): Rate limiter and retry policy.
+            pool_size (int): Keep-alive connections kept open per host.
+        """
+        super().__init__()
+        self.api_key = api_key
+        self.scheduler = scheduler
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, headers=None, **kwargs):
+        headers = dict(headers or {})
+        headers["Authorization"] = f"Bearer {self.api_key()}"
+        send = super().request
+        response = self.scheduler.send(lambda: send(method, url, headers=headers, **kwargs))
+
+        if response.status_code == 401:
+            # The key was rotated since it was cached; fetch the latest version and retry once
+            response.close()
+            headers["Authorization"] = f"Bearer {self.api_key(refresh=True)}"
+            response = self.scheduler.send(lambda: send(method, url, headers=headers, **kwargs))
+
+        return response
@@ -0,0 +1,118 @@
+# Cold-start benchmark: import time of each function module and of the GET -> 405 path
+#
+# Every sample runs in a fresh interpreter, like a new function instance. functions_framework
+# is imported first, as the runtime has already loaded it before it loads the function's
+# module (--include-framework counts it too). The benchmark fails when the median import
+# plus GET time of a function exceeds the budget, or when the GET path imports any of the
+# heavy client libraries, so a module-level import that creeps back in is caught.
+#
+# Usage: python benchmarks/bench_cold_start.py [--function sales|events|warehouse] [--samples 5]
+#            [--budget-ms 75] [--include-framework]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry point and module file of each function, and whether it answers GET with 405 (events
+# accepts any method, so only its import is measured)
+FUNCTIONS = {
+    "sales": ("hello_http", "GCP_sales.py", True),
+    "events": ("events", "GCP_events.py", False),
+    "warehouse": ("warehousesales", "GCP_warehouse_sales v1.1.py", True),
+}
+
+# Libraries neither the module import nor a GET request may import
+HEAVY_MODULES = ("google.cloud.bigquery", "google.cloud.secretmanager", "requests")
+
+# Runs in the child interpreter; prints one JSON line with its timings
+CHILD = """
+import contextlib, importlib.util, io, json, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import functions_framework
+if not {include_framework!r}:
+    started = time.perf_counter()
+
+class Request:
+    method = "GET"
+    args = {{}}
+    headers = {{}}
+
+spec = importlib.util.spec_from_file_location("cold_start_function", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+imported = time.perf_counter()
+status = None
+if {rejects_get!r}:
+    with contextlib.redirect_stdout(io.StringIO()):
+        body, status = getattr(module, {entry_point!r})(Request())
+answered = time.perf_counter()
+loaded = [name for name in {heavy!r} if name in sys.modules]
+
+# What the lazy imports defer to the first request that needs them
+deferred_start = time.perf_counter()
+for name in {heavy!r}:
+    importlib.import_module(name)
+deferred = time.perf_counter() - deferred_start
+
+print(json.dumps({{
+    "import": imported - started, "get": answered - imported, "status": status,
+    "heavy_loaded": loaded, "deferred": deferred,
+}}))
+"""
+
+
+def sample(name, include_framework):
+    entry_point, filename, rejects_get = FUNCTIONS[name]
+    code = CHILD.format(
+        root=ROOT, path=os.path.join(ROOT, filename), entry_point=entry_point, rejects_get=rejects_get,
+        heavy=HEAVY_MODULES, include_framework=include_framework
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=ROOT)
+    if result.returncode:
+        raise RuntimeError(f"{name} failed to start:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start import time of the Cloud Functions")
+    parser.add_argument("--function", choices=sorted(FUNCTIONS), action="append",
+                        help="Function to measure, repeatable (default all)")
+    parser.add_argument("--samples", type=int, default=5, help="Fresh interpreters per function")
+    parser.add_argument("--budget-ms", type=float, default=75.0,
+                        help="Maximum median import + GET time per function; raise it with --include-framework")
+    parser.add_argument("--include-framework", action="store_true",
+                        help="Count the functions_framework import as part of the cold start")
+    args = parser.parse_args()
+
+    failures = []
+    for name in args.function or sorted(FUNCTIONS):
+        samples = [sample(name, args.include_framework) for _ in range(args.samples)]
+        total = statistics.median((s["import"] + s["get"]) * 1000 for s in samples)
+        imported = statistics.median(s["import"] * 1000 for s in samples)
+        get = statistics.median(s["get"] * 1000 for s in samples)
+        deferred = statistics.median(s["deferred"] * 1000 for s in samples)
+        loaded = sorted({module for s in samples for module in s["heavy_loaded"]})
+        statuses = sorted({s["status"] for s in samples if s["status"] is not None})
+
+        print(f"{name:<10} import {imported:7.1f} ms  GET {get:6.1f} ms  total {total:7.1f} ms "
+              f"(budget {args.budget_ms:.0f} ms)  status {statuses}  deferred to first use {deferred:7.1f} ms")
+        if total > args.budget_ms:
+            failures.append(f"{name}: cold start {total:.1f} ms is over the {args.budget_ms:.0f} ms budget")
+        if loaded:
+            failures.append(f"{name}: the module or its GET path imported {', '.join(loaded)}")
+        if FUNCTIONS[name][2] and statuses != [405]:
+            failures.append(f"{name}: GET answered {statuses}, expected 405")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# End-to-end benchmark of the Cloud Functions against the mock API and the fake BigQuery
+#
+# Runs the real hello_http, events or warehousesales entry point in this process. The mock
+# See Tickets API runs in a child process so that its work is not measured. Reports
+# rows/sec, peak RSS and the per-stage times collected by instrumentation.py. The
+# functions read their modes at import, so set them with --env (or in the environment).
+#
+# Usage: python benchmarks/bench_pipeline.py [--function sales|events|warehouse] [--rows 100000]
+#            [--latency 0.05] [--rate-429 0.01] [--max-limit 500] [--repeat 3] [--profile 1|full] [--env PARSE_MODE=stream ...]
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fake_bigquery
+import gcp_resources
+import mock_see_tickets
+
+# Entry point, module file and destination table of each function
+FUNCTIONS = {
+    "sales": ("hello_http", "GCP_sales.py", "otis-media.seetickets_data.sales"),
+    "events": ("events", "GCP_events.py", "otis-media.seetickets_data.events"),
+    "warehouse": ("warehousesales", "GCP_warehouse_sales v1.1.py", "see-tickets-433213.seetickets_data.warehouse_sales"),
+}
+
+# Event codes the sales functions request in static mode; --rows is spread evenly over them
+SALES_EVENT_CODES = 10
+
+
+class BenchRequest:
+    """The parts of flask.Request the entry points use."""
+
+    def __init__(self, method="POST", args=None, headers=None, body=None):
+        self.method = method
+        self.args = args or {}
+        self.headers = headers or {}
+        self._body = body or {}
+
+    def get_json(self, silent=False, force=False):
+        return self._body
+
+
+def load_function(name):
+    entry_point, filename, table_id = FUNCTIONS[name]
+    spec = importlib.util.spec_from_file_location(f"bench_{name}", os.path.join(ROOT, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return getattr(module, entry_point), table_id
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_once(handler, table_id, quiet, profile=None):
+    output = io.StringIO()
+    args = {"stats": "1", "profile": profile} if profile else {"stats": "1"}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext():
+        body, status = handler(BenchRequest(args=args))
+    elapsed = time.perf_counter() - start
+
+    message, _, summary = body.rpartition("\n")
+    profile_report = None
+    if profile:
+        message, _, profile_report = message.rpartition("\n")
+        profile_report = json.loads(profile_report)
+    table = fake_bigquery.STORE.tables.get(table_id)
+    return {
+        "profile": profile_report,
+        "status": status,
+        "message": message,
+        "seconds": elapsed,
+        "rows_written": table.num_rows if table else 0,
+        "stages": json.loads(summary)["stages"],
+    }
+
+
+def report(name, run, index):
+    stages = run["stages"]
+    fetched = stages.get("fetch", {}).get("rows", 0) or stages.get("transform", {}).get("rows", 0)
+    print(f"[{name} #{index}] status {run['status']}: {run['message']}")
+    print(f"  wall {run['seconds']:.3f}s, {fetched / run['seconds']:,.0f} rows/sec fetched, "
+          f"{run['rows_written']:,} rows in table, peak RSS {peak_rss_mb():.1f} MB")
+    print(f"  API scheduler: {gcp_resources.request_scheduler().snapshot()}")
+    for stage, counters in stages.items():
+        rate = f", {counters['rows'] / counters['seconds']:,.0f} rows/sec" if counters["rows"] and counters["seconds"] else ""
+        print(f"  {stage:<14} {counters['seconds']:9.3f}s  calls {counters['calls']:<6} rows {counters['rows']:<10,} "
+              f"in {counters['bytes_in'] / 1e6:8.2f} MB  out {counters['bytes_out'] / 1e6:8.2f} MB{rate}")
+    if run["profile"]:
+        # Imported here, profiling reads its settings at import and --env is applied in main
+        import profiling
+        print(profiling.format_report(run["profile"]), end="")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against a local mock API and fake BigQuery")
+    parser.add_argument("--function", choices=sorted(FUNCTIONS), default="sales")
+    parser.add_argument("--rows", type=int, default=100000, help="Rows in the report (events for --function events)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every API response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra API latency, up to this many seconds")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of API requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-limit", type=int, help="Largest page the mock API serves, whatever limit is requested")
+    parser.add_argument("--active-events", type=int, default=100,
+                        help="Events seeded into the events table for EVENT_SELECTION_MODE=events_table")
+    parser.add_argument("--bq-latency", type=float, default=0.0, help="Seconds added to every BigQuery call")
+    parser.add_argument("--sink-dir", help="Also write the rows to <dir>/<table>.ndjson")
+    parser.add_argument("--repeat", type=int, default=1, help="Invocations; later ones run warm")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="Set before importing")
+    parser.add_argument("--profile", choices=("1", "full"), help="Profile each invocation (?profile=1 or full)")
+    parser.add_argument("--verbose", action="store_true", help="Show the function's own log output")
+    args = parser.parse_args()
+
+    for assignment in args.env:
+        key, _, value = assignment.partition("=")
+        os.environ[key] = value
+
+    selected_events = args.active_events if os.environ.get("EVENT_SELECTION_MODE") == "events_table" else SALES_EVENT_CODES
+    config = mock_see_tickets.MockConfig(
+        rows_per_event=-(-args.rows // selected_events), events=args.rows, latency=args.latency,
+        jitter=args.jitter, rate_429=args.rate_429, retry_after=args.retry_after, max_limit=args.max_limit
+    )
+    server, base_url = mock_see_tickets.start_in_process(config)
+    try:
+        store = fake_bigquery.install(args.sink_dir, args.bq_latency)
+        if os.environ.get("EVENT_SELECTION_MODE") == "events_table":
+            store.write(store.table(FUNCTIONS["events"][2]),
+                        (mock_see_tickets.event_record(i) for i in range(args.active_events)))
+        import see_tickets_api
+        see_tickets_api.SALES_URL = base_url + mock_see_tickets.SALES_PATH
+        see_tickets_api.EVENTS_URL = base_url + mock_see_tickets.EVENTS_PATH
+
+        handler, table_id = load_function(args.function)
+        print(f"{args.function}: {args.rows:,} rows, settings {' '.join(args.env) or 'default'}")
+        print(f"peak RSS before the first invocation {peak_rss_mb():.1f} MB")
+        for index in range(1, args.repeat + 1):
+            report(args.function, run_once(handler, table_id, not args.verbose, args.profile), index)
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
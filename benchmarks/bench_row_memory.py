@@ -0,0 +1,71 @@
+# Memory benchmark: transformed sales held as a list of row dicts vs a column_batch.ColumnBatch
+#
+# Measures the bytes allocated to hold the rows (tracemalloc), the transform rate and the
+# rate of the sinks reading them back (chunking for streaming inserts and NDJSON writing).
+#
+# Usage: python benchmarks/bench_row_memory.py [rows] [repeats]
+
+import gc
+import io
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bigquery_sink
+import column_batch
+import record_transform
+from bench_transform import synthetic_sales
+
+
+def dict_rows(records):
+    transform = record_transform.transform_sale
+    return [transform(record) for record in records]
+
+
+def held_bytes(build, records):
+    """Returns the object built from records and the bytes still allocated for it."""
+    gc.collect()
+    tracemalloc.start()
+    rows = build(records)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return rows, size
+
+
+def best_seconds(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    records = synthetic_sales(count)
+
+    # Both representations must give the sinks the same rows
+    sample = records[:1000]
+    assert list(column_batch.sales_batch(sample).iter_dicts()) == dict_rows(sample)
+
+    print(f"rows: {count}, best of {repeats}")
+    for name, build in (("row dicts", dict_rows), ("column batch", column_batch.sales_batch)):
+        rows, size = held_bytes(build, records)
+        transform = best_seconds(lambda: build(records), repeats)
+        chunk = best_seconds(lambda: bigquery_sink.chunk_rows(rows), repeats)
+        ndjson = best_seconds(lambda: bigquery_sink.write_ndjson(rows, io.BytesIO()), 1)
+        print(f"{name:13} {size / 1e6:8.1f} MB held, {size / count:6.0f} B/row | "
+              f"transform {count / transform:10,.0f} rows/sec | chunk {count / chunk:10,.0f} rows/sec | "
+              f"ndjson {count / ndjson:9,.0f} rows/sec")
+        del rows
+
+
+if __name__ == "__main__":
+    main()
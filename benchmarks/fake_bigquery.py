@@ -0,0 +1,331 @@
+# In-memory (optionally file-backed) stand-in for the parts of bigquery.Client the functions use
+#
+# Tables keep their key column (uniqueCode or id) in a set and a row count. With a
+# directory, every row written is also appended to <dir>/<table>.ndjson so the output can
+# be inspected. Understands the statements the functions issue: key scans, TRUNCATE,
+# the staging MERGEs of bigquery_sink.merge_rows (with or without WHEN MATCHED) and of the
+# daily summary, the fingerprint SELECT, the watermark and checkpoint SELECT/MERGE and
+# DELETEs by key.
+
+import gzip
+import io
+import json
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+import record_transform
+
+KEY_COLUMNS = ("uniqueCode", "id")
+
+
+class FakeJob:
+    def __init__(self, rows=(), affected=0):
+        self._rows = list(rows)
+        self.output_rows = affected
+        self.num_dml_affected_rows = affected
+
+    def result(self, *args, **kwargs):
+        return self._rows
+
+
+class FakeTable:
+    def __init__(self, table_id, schema, time_partitioning=None, clustering_fields=None):
+        self.table_id = table_id
+        self.schema = list(schema)
+        self.time_partitioning = time_partitioning
+        self.clustering_fields = clustering_fields
+        self.expires = None
+        self.labels = {}
+        self.keys = set()
+        self.num_rows = 0
+        self.modified = datetime.now(timezone.utc)
+        # key -> fingerprint, only kept for tables with a fingerprint column
+        self.fingerprints = {}
+
+
+class FakeStore:
+    """Tables shared by every FakeBigQuery client, like a real project."""
+
+    def __init__(self, directory=None, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        self.tables = {}
+        self.watermarks = {}
+        self.checkpoints = {}
+        self.queries = []
+        self.insert_calls = 0
+        self.load_jobs = 0
+        self.lock = threading.Lock()
+
+    def default_schema(self, table_id):
+        name = table_id.rsplit(".", 1)[-1]
+        if "events" in name:
+            fields = record_transform.EVENTS_SCHEMA
+        elif "sales" in name:
+            fields = record_transform.SALES_SCHEMA
+        else:
+            return None
+        return [bigquery.SchemaField(f["name"], f["type"], mode=f.get("mode", "NULLABLE")) for f in fields]
+
+    def table(self, table_id, create=False, schema=None, time_partitioning=None, clustering_fields=None):
+        table_id = str(table_id)
+        with self.lock:
+            if table_id not in self.tables:
+                schema = schema or self.default_schema(table_id)
+                if not create and schema is None:
+                    raise exceptions.NotFound(f"Not found: Table {table_id}")
+                self.tables[table_id] = FakeTable(table_id, schema or [], time_partitioning, clustering_fields)
+            return self.tables[table_id]
+
+    def path(self, table_id):
+        return os.path.join(self.directory, f"{table_id}.ndjson") if self.directory else None
+
+    def write(self, table, rows, truncate=False):
+        """Adds rows to a table and returns how many were written."""
+        key = next((k for k in KEY_COLUMNS if any(f.name == k for f in table.schema)), None)
+        path = self.path(table.table_id)
+        with self.lock:
+            if truncate:
+                table.keys.clear()
+                table.fingerprints.clear()
+                table.num_rows = 0
+            handle = open(path, "w" if truncate else "a") if path else None
+            try:
+                count = 0
+                fingerprinted = key and any(f.name == "fingerprint" for f in table.schema)
+                for row in rows:
+                    count += 1
+                    if key:
+                        table.keys.add(row.get(key))
+                    if fingerprinted:
+                        table.fingerprints[row.get(key)] = row.get("fingerprint")
+                    if handle:
+                        handle.write(json.dumps(row) + "\n")
+            finally:
+                if handle:
+                    handle.close()
+            table.num_rows += count
+            table.modified = datetime.now(timezone.utc)
+        return count
+
+    def read(self, table_id):
+        """Yields the rows of a file-backed table."""
+        path = self.path(table_id)
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    yield json.loads(line)
+
+
+class FakeBigQuery:
+    """Drop-in for bigquery.Client(project=...) backed by the module-level STORE."""
+
+    def __init__(self, project=None, **kwargs):
+        self.project = project
+
+    def _wait(self):
+        if STORE.latency:
+            time.sleep(STORE.latency)
+
+    def get_table(self, table_id):
+        return STORE.table(table_id)
+
+    def create_table(self, table, exists_ok=False):
+        table_id = getattr(table, "table_id", None) and f"{table.project}.{table.dataset_id}.{table.table_id}"
+        table_id = table_id or str(table)
+        if table_id in STORE.tables and not exists_ok:
+            raise exceptions.Conflict(f"Already Exists: Table {table_id}")
+        return STORE.table(
+            table_id, create=True, schema=getattr(table, "schema", None),
+            time_partitioning=getattr(table, "time_partitioning", None),
+            clustering_fields=getattr(table, "clustering_fields", None)
+        )
+
+    def update_table(self, table, fields):
+        if "labels" in fields:
+            # Like BigQuery, a label set to None is removed
+            table.labels = {key: value for key, value in table.labels.items() if value is not None}
+        return table
+
+    def delete_table(self, table_id, not_found_ok=False):
+        with STORE.lock:
+            removed = STORE.tables.pop(str(table_id), None)
+        path = STORE.path(str(table_id))
+        if path and os.path.exists(path):
+            os.remove(path)
+        if removed is None and not not_found_ok:
+            raise exceptions.NotFound(f"Not found: Table {table_id}")
+
+    def insert_rows_json(self, table_id, rows, row_ids=None, **kwargs):
+        self._wait()
+        STORE.insert_calls += 1
+        STORE.write(STORE.table(table_id), rows)
+        return []
+
+    def load_table_from_file(self, file, table_id, job_config=None, **kwargs):
+        self._wait()
+        STORE.load_jobs += 1
+        data = file.read()
+        if job_config.source_format == bigquery.SourceFormat.PARQUET:
+            import pyarrow.parquet as pq
+            rows = pq.read_table(io.BytesIO(data)).to_pylist()
+        else:
+            rows = (json.loads(line) for line in gzip.decompress(data).splitlines())
+        table = STORE.table(table_id, create=True, schema=job_config.schema)
+        truncate = job_config.write_disposition == bigquery.WriteDisposition.WRITE_TRUNCATE
+        return FakeJob(affected=STORE.write(table, rows, truncate=truncate))
+
+    def query(self, query, job_config=None, **kwargs):
+        self._wait()
+        STORE.queries.append(query)
+        statement = " ".join(query.split())
+        tables = re.findall(r"`([^`]+)`", statement)
+
+        if statement.startswith("TRUNCATE TABLE"):
+            STORE.write(STORE.table(tables[0]), [], truncate=True)
+            return FakeJob()
+
+        scan = re.match(r"SELECT (\w+) FROM `[^`]+`$", statement)
+        if scan and scan.group(1) in KEY_COLUMNS:
+            column = scan.group(1)
+            return FakeJob([SimpleNamespace(**{column: key}) for key in STORE.table(tables[0]).keys])
+
+        if statement.startswith("SELECT id, fingerprint FROM"):
+            ids = set(job_config.query_parameters[0].values)
+            return FakeJob([
+                SimpleNamespace(id=key, fingerprint=value)
+                for key, value in STORE.table(tables[0]).fingerprints.items() if key in ids
+            ])
+
+        # Partition-pruned key lookups; the fake keeps no dates, so every key is returned
+        pruned = re.match(r"SELECT (\w+) FROM `[^`]+` WHERE", statement)
+        if pruned and pruned.group(1) in KEY_COLUMNS:
+            column = pruned.group(1)
+            return FakeJob([SimpleNamespace(**{column: key}) for key in STORE.table(tables[0]).keys])
+
+        # Active event selection; the fake keeps no start dates, so every event counts as active
+        active = re.match(r"SELECT DISTINCT (\w+) FROM `[^`]+` WHERE", statement)
+        if active and active.group(1) in KEY_COLUMNS:
+            column = active.group(1)
+            return FakeJob([SimpleNamespace(**{column: key}) for key in STORE.table(tables[0]).keys])
+
+        if statement.startswith("SELECT eventCode, highWaterMark"):
+            codes = set(job_config.query_parameters[0].values)
+            return FakeJob([
+                SimpleNamespace(eventCode=code, highWaterMark=mark)
+                for code, mark in STORE.watermarks.items() if code in codes
+            ])
+
+        if statement.startswith("MERGE") and "UNNEST(@marks)" in statement:
+            for mark in job_config.query_parameters[0].values:
+                STORE.watermarks[mark.struct_values["eventCode"]] = mark.struct_values["highWaterMark"]
+            return FakeJob(affected=len(job_config.query_parameters[0].values))
+
+        if statement.startswith("SELECT reportKey"):
+            function_name = job_config.query_parameters[0].value
+            return FakeJob([
+                checkpoint for (name, _), checkpoint in STORE.checkpoints.items()
+                if name == function_name and not checkpoint.completed
+            ])
+
+        if statement.startswith("MERGE") and "@report_key" in statement:
+            values = {parameter.name: getattr(parameter, "value", getattr(parameter, "values", None))
+                      for parameter in job_config.query_parameters}
+            STORE.checkpoints[(values["function_name"], values["report_key"])] = SimpleNamespace(
+                reportKey=values["report_key"], eventCodes=values["event_codes"], filteredBy=values["filtered_by"],
+                nextOffset=values["next_offset"], batchId=values["batch_id"], completed=values["completed"]
+            )
+            return FakeJob(affected=1)
+
+        if statement.startswith("DELETE FROM") and "@function_prefix" in statement:
+            values = {parameter.name: getattr(parameter, "value", getattr(parameter, "values", None))
+                      for parameter in job_config.query_parameters}
+            orphaned = [
+                (name, key) for (name, key), checkpoint in STORE.checkpoints.items()
+                if name.startswith(values["function_prefix"]) and name not in values["keep"]
+                and not checkpoint.completed
+            ]
+            for name_and_key in orphaned:
+                del STORE.checkpoints[name_and_key]
+            return FakeJob(affected=len(orphaned))
+
+        if statement.startswith("DELETE FROM") and "UNNEST(@codes)" in statement:
+            table = STORE.table(tables[0])
+            codes = set(job_config.query_parameters[0].values)
+            with STORE.lock:
+                deleted = len(table.keys & codes)
+                table.keys -= codes
+                table.num_rows -= deleted
+                table.modified = datetime.now(timezone.utc)
+            return FakeJob(affected=deleted)
+
+        staging = re.search(r"FROM `([^`]+_staging_[^`]+)`", statement)
+        if statement.startswith("MERGE") and staging:
+            key = re.search(r"PARTITION BY `(\w+)`", statement).group(1)
+            return self._merge_staging(tables[0], staging.group(1), key, "WHEN MATCHED" in statement)
+
+        # Additive MERGE of a staging table, e.g. the daily summary; every staged row counts as affected
+        staging = re.search(r"USING `([^`]+_staging_[^`]+)`", statement)
+        if statement.startswith("MERGE") and staging:
+            return FakeJob(affected=STORE.table(staging.group(1)).num_rows)
+
+        return FakeJob()
+
+    def _merge_staging(self, target_id, staging_id, key, update=False):
+        target = STORE.table(target_id)
+        staging = STORE.table(staging_id)
+        new_keys = staging.keys - target.keys
+        if update:
+            # Matched rows are overwritten in place: the row count only grows by the new keys
+            with STORE.lock:
+                target.keys |= new_keys
+                target.num_rows += len(new_keys)
+                target.fingerprints.update(staging.fingerprints)
+                target.modified = datetime.now(timezone.utc)
+            return FakeJob(affected=len(staging.keys))
+        if STORE.directory:
+            seen = set()
+            rows = []
+            for row in STORE.read(staging_id):
+                if row.get(key) in new_keys and row.get(key) not in seen:
+                    seen.add(row.get(key))
+                    rows.append(row)
+            return FakeJob(affected=STORE.write(target, rows))
+        with STORE.lock:
+            target.keys |= new_keys
+            target.num_rows += len(new_keys)
+            target.modified = datetime.now(timezone.utc)
+        return FakeJob(affected=len(new_keys))
+
+
+class FakeSecretManager:
+    """Drop-in for secretmanager.SecretManagerServiceClient returning a fixed key."""
+
+    def __init__(self, **kwargs):
+        pass
+
+    def access_secret_version(self, name=None, request=None, **kwargs):
+        return SimpleNamespace(payload=SimpleNamespace(data=b"benchmark-api-key"))
+
+
+STORE = FakeStore()
+
+
+def install(directory=None, latency=0.0):
+    """Replaces the BigQuery and Secret Manager clients with the fakes and resets the store."""
+    from google.cloud import secretmanager
+
+    global STORE
+    STORE = FakeStore(directory, latency)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    bigquery.Client = FakeBigQuery
+    secretmanager.SecretManagerServiceClient = FakeSecretManager
+    return STORE
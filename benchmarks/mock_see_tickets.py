@@ -0,0 +1,286 @@
+# Local stand-in for the See Tickets clients API, serving synthetic sales and events
+#
+# Serves POST /v1/reports/sales and GET /v1/events/search with offset/limit paging,
+# a meta.total, an optional cap on limit, injected latency and 429 responses. Pages carry an ETag and a matching
+# If-None-Match is answered with 304 Not Modified. Records are generated on the fly
+# from their index, so a 5M row report costs no memory on the server side.
+#
+# Usage: python benchmarks/mock_see_tickets.py [--port 8765] [--rows-per-event 10000] [--events 1000]
+#                                              [--latency 0.05] [--rate-429 0.01] [--max-limit 500]
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+SALES_PATH = "/v1/reports/sales"
+EVENTS_PATH = "/v1/events/search"
+
+# Sale dates start here and advance by SALE_INTERVAL per sale of an event
+SALES_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+SALE_INTERVAL = timedelta(seconds=30)
+
+# Records serialized per write of a chunked response
+WRITE_BATCH = 1000
+
+CHANNELS = ["Web", "Mobile", "Box Office", "Partner"]
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class MockConfig:
+    """Scale and failure settings of the mock API."""
+
+    def __init__(self, rows_per_event=10000, events=1000, latency=0.0, jitter=0.0, rate_429=0.0,
+                 retry_after=1, default_limit=None, max_limit=None, seed=42):
+        self.rows_per_event = rows_per_event
+        self.events = events
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.default_limit = default_limit
+        # Largest page served whatever limit is asked for, like an API capping its page size
+        self.max_limit = max_limit
+        self.seed = seed
+
+
+def sale_record(code, index):
+    """Builds the index-th sale of an event, with the shape of a /v1/reports/sales record."""
+    quantity = 1 + index % 4
+    price = 20.0 + (index % 5) * 5
+    return {
+        "affiliate": None,
+        "currency": "GBP",
+        "date": (SALES_EPOCH + SALE_INTERVAL * index).strftime(DATE_FORMAT),
+        "deliveryMethod": "PAH",
+        "deviceModel": "iPhone" if index % 2 else None,
+        "deviceType": "Mobile" if index % 2 else "Desktop",
+        "eventDate": "2024-08-01T18:00:00Z",
+        "eventId": code,
+        "eventName": f"Benchmark Event {code}",
+        "faceValue": price,
+        "grossCost": price * quantity * 1.1,
+        "grossFace": price * quantity,
+        "grossSales": price * quantity * 1.1,
+        "isInternetOrder": index % 3 != 0,
+        "isPending": False,
+        "location": {
+            "country": "United Kingdom",
+            "countryIso": "GBR",
+            "iso2": "GB",
+            "postCode": f"AB{index % 100} 1CD",
+            "region1": "England",
+            "region2": "London",
+            "region3": None,
+            "region4": None
+        },
+        "offerCode": None,
+        "partnerSite": None,
+        "paymentMethod": "Card",
+        "priceId": f"P{index % 20}",
+        "priceName": "GENERAL ADMISSION",
+        "salesChannel": CHANNELS[index % len(CHANNELS)],
+        "sold": quantity,
+        "source": "API",
+        "taxTotal": round(price * quantity * 0.1, 2),
+        "ticketPrice": price,
+        "uniqueCode": f"{code}-{index:09d}"
+    }
+
+
+def event_record(index):
+    """Builds the index-th event, with the shape of a /v1/events/search record."""
+    starts = SALES_EPOCH + timedelta(days=index % 730, hours=18)
+    return {
+        "doorsOpen": (starts - timedelta(hours=1)).strftime(DATE_FORMAT),
+        "id": f"DF-{3000000 + index}",
+        "name": f"Benchmark Event {index}",
+        "promoterName": "Benchmark Promotions",
+        "starts": starts.strftime(DATE_FORMAT),
+        "timeslotEnabled": index % 7 == 0,
+        "tourId": index % 50,
+        "tourName": f"Tour {index % 50}",
+        "venueName": f"Venue {index % 120}"
+    }
+
+
+def _first_sale_index(filtered_by):
+    # Index of the first sale on or after filteredBy.salesStartDate
+    start = (filtered_by or {}).get("salesStartDate")
+    if not start:
+        return 0
+    start = datetime.strptime(start, DATE_FORMAT).replace(tzinfo=timezone.utc)
+    return max(0, -(-int((start - SALES_EPOCH).total_seconds()) // int(SALE_INTERVAL.total_seconds())))
+
+
+def _end_sale_index(filtered_by, rows_per_event):
+    # Index after the last sale on or before filteredBy.salesEndDate
+    end = (filtered_by or {}).get("salesEndDate")
+    if not end:
+        return rows_per_event
+    end = datetime.strptime(end, DATE_FORMAT).replace(tzinfo=timezone.utc)
+    return min(rows_per_event, max(0, int((end - SALES_EPOCH).total_seconds()) // int(SALE_INTERVAL.total_seconds()) + 1))
+
+
+class MockSeeTicketsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = MockConfig()
+    rng = random.Random(42)
+    rng_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if urlparse(self.path).path != SALES_PATH:
+            return self._send_error(404, "Not Found")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return self._send_error(400, "Invalid JSON body")
+        if self._reject():
+            return
+
+        codes = (payload.get("search") or {}).get("searchItemCodes") or []
+        first = _first_sale_index(payload.get("filteredBy"))
+        per_event = max(0, _end_sale_index(payload.get("filteredBy"), self.config.rows_per_event) - first)
+
+        # Sales of the requested events are interleaved: record k is sale k // n of event k % n
+        def record(k):
+            return sale_record(codes[k % len(codes)], first + k // len(codes))
+
+        self._send_page(record, per_event * len(codes), payload.get("offset"), payload.get("limit"), body)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path != EVENTS_PATH:
+            return self._send_error(404, "Not Found")
+        if self._reject():
+            return
+        params = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        self._send_page(event_record, self.config.events, params.get("offset"), params.get("limit"),
+                        self.path.encode())
+
+    def _reject(self):
+        # Authentication, injected latency and injected rate limiting, in that order
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            self._send_error(401, "Unauthorized")
+            return True
+        delay = self.config.latency
+        with self.rng_lock:
+            if self.config.jitter:
+                delay += self.rng.uniform(0, self.config.jitter)
+            throttled = self.rng.random() < self.config.rate_429
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            self._send_error(429, "Too Many Requests", {"Retry-After": str(self.config.retry_after)})
+            return True
+        return False
+
+    def _send_page(self, record, total, offset, limit, request):
+        offset = int(offset or 0)
+        limit = int(limit) if limit is not None else self.config.default_limit
+        if self.config.max_limit:
+            limit = min(limit or self.config.max_limit, self.config.max_limit)
+        end = total if limit is None else min(total, offset + limit)
+
+        # Records only depend on the request and the report size, so those identify the page
+        etag = '"%s"' % hashlib.sha1(request + f" {total} {limit}".encode()).hexdigest()[:20]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        self._write_chunk(b'{"data": [')
+        for start in range(offset, end, WRITE_BATCH):
+            records = [record(k) for k in range(start, min(end, start + WRITE_BATCH))]
+            text = json.dumps(records)[1:-1]
+            self._write_chunk(("," if start > offset else "").encode() + text.encode())
+        meta = json.dumps({"total": total, "offset": offset, "limit": limit})
+        self._write_chunk(b'], "meta": ' + meta.encode() + b"}")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+    def _send_error(self, status, message, headers=None):
+        body = json.dumps({"error": message}).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def make_server(config, host="127.0.0.1", port=0):
+    """Returns a threading HTTP server for the mock API; port 0 picks a free port."""
+    handler = type("ConfiguredHandler", (MockSeeTicketsHandler,), {
+        "config": config, "rng": random.Random(config.seed), "rng_lock": threading.Lock()
+    })
+    # Sharded runs connect from several processes at once; the default backlog of 5 resets them
+    server = ThreadingHTTPServer((host, port), handler, bind_and_activate=False)
+    server.request_queue_size = 128
+    server.server_bind()
+    server.server_activate()
+    server.daemon_threads = True
+    return server
+
+
+def _serve(config, ready):
+    server = make_server(config)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_in_process(config):
+    """Runs the mock API in a child process, so its CPU and memory stay out of the measurements.
+    Returns:
+        A tuple (process, base_url); terminate the process when done.
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(config, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, f"http://127.0.0.1:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rows-per-event", type=int, default=10000)
+    parser.add_argument("--events", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency, up to this many seconds")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--max-limit", type=int, help="Largest page served, whatever limit is requested")
+    args = parser.parse_args()
+
+    config = MockConfig(args.rows_per_event, args.events, args.latency, args.jitter, args.rate_429, args.retry_after,
+                        max_limit=args.max_limit)
+    server = make_server(config, port=args.port)
+    print(f"Mock See Tickets API on http://127.0.0.1:{args.port}{SALES_PATH} and {EVENTS_PATH}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
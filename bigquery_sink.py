@@ -0,0 +1,363 @@
+# Helpers for writing rows into BigQuery tables
+
+import gzip
+import itertools
+import json
+import random
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import column_batch
+import lazy_imports
+import table_layout
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+# Staging tables expire on their own if a run dies before dropping them
+STAGING_TABLE_EXPIRATION = timedelta(hours=1)
+
+# Streaming insert requests are capped at 10 MB and 50,000 rows; stay well below both
+DEFAULT_CHUNK_ROWS = 500
+DEFAULT_CHUNK_BYTES = 5 * 1024 * 1024
+DEFAULT_INSERT_WORKERS = 4
+DEFAULT_INSERT_RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+
+# Row error reasons that are worth sending again; anything else (e.g. "invalid") is permanent
+RETRYABLE_REASONS = {"backendError", "internalError", "rateLimitExceeded", "stopped", "timeout"}
+
+# File formats accepted by load_rows and rows per Parquet row group
+LOAD_FORMATS = ("ndjson", "parquet")
+PARQUET_ROW_GROUP_SIZE = 10000
+
+
+def merge_rows(client, table_id, rows, key, stats=None, update=False, partition_field=None):
+    """Loads rows into a staging table and merges the ones with a new key into table_id.
+
+    The deduplication happens server-side with a single MERGE, so the client never has
+    to download the existing keys. Duplicate keys inside the batch are collapsed to one row.
+    Args:
+        client (bigquery.Client): The BigQuery client.
+        table_id (str): Fully qualified destination table.
+        rows (iterable): JSON-serializable rows matching the destination schema, or a ColumnBatch.
+        key (str): Column identifying a row, e.g. uniqueCode or id.
+        stats (instrumentation.Invocation): Optional collector for the bytes uploaded.
+        update (bool): Also overwrite the rows whose key already exists (an upsert).
+        partition_field (str): Timestamp column a key never changes, e.g. the sale date. If
+            table_id is partitioned on it, the MERGE only reads the partitions of the batch.
+            Ignored with update, since an updated row may have moved to another partition.
+    Returns:
+        The number of rows inserted (or, with update, inserted or updated) in table_id.
+    """
+    rows = iter(_row_dicts(rows))
+    first = next(rows, None)
+    if first is None:
+        return 0
+
+    destination = client.get_table(table_id)
+    staging_id = f"{table_id}_staging_{uuid.uuid4().hex}"
+
+    # Collect the days of the batch while it is loaded, to bound the partitions the MERGE reads
+    values = []
+    rows = itertools.chain([first], rows)
+    if partition_field and not update and table_layout.is_partitioned_on(destination, partition_field):
+        rows = _collect(rows, partition_field, values)
+
+    try:
+        # Load the batch into a staging table with the destination schema
+        load_rows(
+            client, staging_id, rows,
+            write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE, schema=destination.schema, stats=stats
+        )
+
+        staging = client.get_table(staging_id)
+        staging.expires = datetime.now(timezone.utc) + STAGING_TABLE_EXPIRATION
+        client.update_table(staging, ["expires"])
+
+        # With update, rows whose key exists get every other column from the staging row
+        when_matched = ""
+        if update:
+            assignments = ", ".join(
+                f"`{field.name}` = S.`{field.name}`" for field in destination.schema if field.name != key
+            )
+            when_matched = f"WHEN MATCHED THEN UPDATE SET {assignments}"
+
+        # A constant filter on the target's partitioning column in the ON clause prunes partitions
+        prune = ""
+        condition = table_layout.partition_filter(f"T.`{partition_field}`", table_layout.partition_days(values))
+        if values and condition:
+            prune = f"AND {condition}"
+
+        merge_query = f"""
+            MERGE `{table_id}` T
+            USING (
+                SELECT * EXCEPT(_row_number) FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY `{key}`) AS _row_number
+                    FROM `{staging_id}`
+                )
+                WHERE _row_number = 1
+            ) S
+            ON T.`{key}` = S.`{key}` {prune}
+            {when_matched}
+            WHEN NOT MATCHED THEN
+                INSERT ROW
+        """
+        query_job = client.query(merge_query)
+        query_job.result()
+        return query_job.num_dml_affected_rows or 0
+    finally:
+        client.delete_table(staging_id, not_found_ok=True)
+
+
+def _row_dicts(rows):
+    # Column batches are turned into row dicts a chunk of rows at a time
+    if isinstance(rows, column_batch.ColumnBatch):
+        return rows.iter_dicts()
+    return rows
+
+
+def _collect(rows, field, values):
+    # Passes rows through while appending their field to values
+    for row in rows:
+        values.append(row.get(field))
+        yield row
+
+
+def chunk_rows(rows, max_rows=DEFAULT_CHUNK_ROWS, max_bytes=DEFAULT_CHUNK_BYTES, sizes=None):
+    """Splits rows into chunks bounded by row count and serialized size.
+    Args:
+        sizes (list): If given, the serialized size of each chunk is appended to it.
+    Returns:
+        A list of chunks, each a list of indexes into rows.
+    """
+    chunks = []
+    current = []
+    current_bytes = 0
+    for index, row in enumerate(_row_dicts(rows)):
+        row_bytes = len(json.dumps(row, default=str))
+        if current and (len(current) >= max_rows or current_bytes + row_bytes > max_bytes):
+            chunks.append(current)
+            if sizes is not None:
+                sizes.append(current_bytes)
+            current = []
+            current_bytes = 0
+        current.append(index)
+        current_bytes += row_bytes
+    if current:
+        chunks.append(current)
+        if sizes is not None:
+            sizes.append(current_bytes)
+    return chunks
+
+
+def _is_retryable(row_errors):
+    return all(error.get("reason") in RETRYABLE_REASONS for error in row_errors)
+
+
+def _insert_chunk(client, table_id, rows, indexes, max_retries, row_ids=None):
+    """Streams one chunk, resending only the rows BigQuery rejected with a retryable reason.
+
+    Resent rows keep their insertId, so BigQuery can drop copies of rows that were in fact
+    stored by a request that looked failed.
+    Returns:
+        A list of insert_rows_json style errors indexed into the full rows list.
+    """
+    pending = indexes
+    failed = []
+    if isinstance(rows, column_batch.ColumnBatch):
+        # Only the rows of this chunk are turned into dicts
+        rows = dict(zip(indexes, rows.dicts(indexes)))
+    for attempt in range(max_retries + 1):
+        if attempt:
+            time.sleep(RETRY_BASE_DELAY * 2 ** (attempt - 1) * (1 + random.random()))
+
+        try:
+            if row_ids is None:
+                errors = client.insert_rows_json(table_id, [rows[i] for i in pending])
+            else:
+                errors = client.insert_rows_json(
+                    table_id, [rows[i] for i in pending], row_ids=[row_ids[i] for i in pending]
+                )
+        except Exception as e:
+            # The whole request failed (e.g. 5xx after the client's own retries); resend it
+            if attempt == max_retries:
+                return failed + [{"index": i, "errors": [{"reason": "requestFailed", "message": str(e)}]} for i in pending]
+            continue
+
+        retry = []
+        for error in errors:
+            index = pending[error["index"]]
+            if _is_retryable(error["errors"]) and attempt < max_retries:
+                retry.append(index)
+            else:
+                failed.append(dict(error, index=index))
+        if not retry:
+            return failed
+        pending = retry
+    return failed
+
+
+def insert_rows_chunked(client, table_id, rows, max_rows=DEFAULT_CHUNK_ROWS, max_bytes=DEFAULT_CHUNK_BYTES,
+                        max_workers=DEFAULT_INSERT_WORKERS, max_retries=DEFAULT_INSERT_RETRIES, stats=None,
+                        row_ids=None):
+    """Streams rows into table_id in size-bounded chunks sent concurrently.
+
+    Rows rejected with a transient reason are retried on their own with jittered
+    exponential backoff, so one bad row or one throttled request does not force the
+    whole batch to be sent again.
+    Args:
+        rows (list): Row dicts, or a ColumnBatch.
+        row_ids (list): Optional insertId per row (e.g. its uniqueCode), which lets BigQuery
+            deduplicate rows that are sent more than once.
+    Returns:
+        A list of errors in the insert_rows_json format, with "index" pointing into rows.
+        The list is empty when every row was inserted.
+    """
+    sizes = []
+    chunks = chunk_rows(rows, max_rows, max_bytes, sizes)
+    if not chunks:
+        return []
+    if stats is not None:
+        stats.add("insert", rows=len(rows), bytes_out=sum(sizes))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda indexes: _insert_chunk(client, table_id, rows, indexes, max_retries, row_ids), chunks)
+        errors = [error for chunk_errors in results for error in chunk_errors]
+
+    return sorted(errors, key=lambda error: error["index"])
+
+
+def write_ndjson(rows, file):
+    """Writes rows to a binary file as gzip-compressed NDJSON and returns how many were written."""
+    count = 0
+    with gzip.GzipFile(fileobj=file, mode="wb") as gz:
+        for row in _row_dicts(rows):
+            gz.write(json.dumps(row, default=str).encode("utf-8"))
+            gz.write(b"\n")
+            count += 1
+    return count
+
+
+def write_parquet(rows, schema, file):
+    """Writes rows to a binary file as snappy-compressed Parquet with the given BigQuery schema
+    and returns how many were written. The columns of a ColumnBatch are converted without
+    building row dicts."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Parquet loads need the pyarrow package, use the ndjson format instead") from e
+
+    arrow_types = {
+        "STRING": pyarrow.string(),
+        "FLOAT": pyarrow.float64(),
+        "FLOAT64": pyarrow.float64(),
+        "INTEGER": pyarrow.int64(),
+        "INT64": pyarrow.int64(),
+        "BOOL": pyarrow.bool_(),
+        "BOOLEAN": pyarrow.bool_(),
+        "TIMESTAMP": pyarrow.timestamp("us", tz="UTC"),
+    }
+    arrow_schema = pyarrow.schema(
+        [(field.name, arrow_types.get(field.field_type, pyarrow.string())) for field in schema]
+    )
+
+    # Convert and write one row group at a time so rows can be a generator
+    if isinstance(rows, column_batch.ColumnBatch):
+        groups = _column_groups(rows, schema)
+    else:
+        groups = _row_groups(rows, schema)
+    count = 0
+    with pyarrow.parquet.ParquetWriter(file, arrow_schema, compression="snappy") as writer:
+        for size, group in groups:
+            count += size
+            columns = []
+            for field in schema:
+                values = group[field.name]
+                if field.field_type == "TIMESTAMP":
+                    values = [_parse_timestamp(value) for value in values]
+                columns.append(pyarrow.array(values, type=arrow_schema.field(field.name).type))
+            writer.write_table(pyarrow.Table.from_arrays(columns, schema=arrow_schema))
+    return count
+
+
+def _row_groups(rows, schema):
+    # Yields (rows, {field: values}) for each row group of an iterable of row dicts
+    rows = iter(rows)
+    while True:
+        group = list(itertools.islice(rows, PARQUET_ROW_GROUP_SIZE))
+        if not group:
+            return
+        yield len(group), {field.name: [row.get(field.name) for row in group] for field in schema}
+
+
+def _column_groups(batch, schema):
+    # Yields (rows, {field: values}) for each row group of a ColumnBatch, missing fields as None
+    for start in range(0, len(batch), PARQUET_ROW_GROUP_SIZE):
+        end = min(len(batch), start + PARQUET_ROW_GROUP_SIZE)
+        yield end - start, {
+            field.name: batch.column(field.name, start, end) if field.name in batch.positions else [None] * (end - start)
+            for field in schema
+        }
+
+
+def _parse_timestamp(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def load_rows(client, table_id, rows, write_disposition="WRITE_APPEND",
+              source_format="ndjson", schema=None, stats=None):
+    """Writes rows to a compressed file and loads it into table_id with a single load job.
+
+    Unlike streaming inserts, the rows are committed atomically when the job finishes and
+    never sit in the streaming buffer. With WRITE_TRUNCATE the table contents are replaced
+    in the same job, so readers never see an empty table.
+    Args:
+        client (bigquery.Client): The BigQuery client.
+        table_id (str): Fully qualified destination table.
+        rows (iterable): JSON-serializable rows matching the destination schema. A generator
+            is consumed while the file is written, so rows never need to be in memory at once.
+            A ColumnBatch is written column by column.
+        write_disposition (str): WRITE_APPEND or WRITE_TRUNCATE.
+        source_format (str): "ndjson" (gzip-compressed) or "parquet" (snappy, needs pyarrow).
+        schema (list): Schema of the load; defaults to the schema of the existing table_id.
+        stats (instrumentation.Invocation): Optional collector for the rows and bytes uploaded.
+    Returns:
+        The number of rows written by the load job. An empty WRITE_APPEND load is skipped.
+    """
+    if source_format not in LOAD_FORMATS:
+        raise ValueError(f"Unknown load format {source_format!r}, expected one of {LOAD_FORMATS}")
+
+    job_config = bigquery.LoadJobConfig(schema=schema, write_disposition=write_disposition)
+    if schema is None:
+        # Keep the partitioning and clustering of the existing table, which WRITE_TRUNCATE would otherwise reject
+        destination = client.get_table(table_id)
+        job_config.schema = schema = destination.schema
+        job_config.time_partitioning = getattr(destination, "time_partitioning", None)
+        job_config.clustering_fields = getattr(destination, "clustering_fields", None)
+
+    with tempfile.TemporaryFile() as file:
+        if source_format == "parquet":
+            count = write_parquet(rows, schema, file)
+            job_config.source_format = bigquery.SourceFormat.PARQUET
+        else:
+            count = write_ndjson(rows, file)
+            job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        file_bytes = file.tell()
+        file.seek(0)
+
+        if count == 0 and write_disposition == bigquery.WriteDisposition.WRITE_APPEND:
+            return 0
+        if stats is not None:
+            stats.add("insert", rows=count, bytes_out=file_bytes)
+
+        load_job = client.load_table_from_file(file, table_id, job_config=job_config)
+        load_job.result()
+
+    return load_job.output_rows or 0
@@ -0,0 +1,272 @@
+# Column-oriented batches of transformed rows, a compact alternative to lists of row dicts
+#
+# A row dict costs a hash table plus a boxed value per field, several KB per sale once its
+# strings are counted. A ColumnBatch keeps one column per schema field instead: typed arrays
+# for FLOAT, INTEGER and BOOLEAN fields, dictionary-encoded strings for low-cardinality
+# fields and a plain list for the rest. Rows are read back through RowView, a two-slot
+# mapping onto the columns, and sinks turn a batch into dicts one chunk at a time.
+
+import array
+import itertools
+from collections.abc import Mapping
+
+import record_transform
+
+# STRING and TIMESTAMP fields with few distinct values, stored as codes into a list of those values
+SALES_DICTIONARY_FIELDS = (
+    "affiliate", "currency", "deliveryMethod", "deviceModel", "deviceType", "eventDate", "eventId", "eventName",
+    "country", "countryIso", "region1", "region2", "region3", "region4", "offerCode", "partnerSite",
+    "paymentMethod", "priceId", "priceName", "salesChannel", "source"
+)
+EVENTS_DICTIONARY_FIELDS = ("promoterName", "tourName", "venueName")
+
+# Array type code and Python type of the numeric BigQuery types
+NUMBER_TYPES = {
+    "FLOAT": ("d", float),
+    "FLOAT64": ("d", float),
+    "INTEGER": ("q", int),
+    "INT64": ("q", int),
+    "BOOLEAN": ("b", bool),
+    "BOOL": ("b", bool),
+}
+
+# Rows appended to the columns, or turned back into dicts, at once
+CHUNK_ROWS = 5000
+
+
+class NumberColumn:
+    """FLOAT, INTEGER or BOOLEAN values in a typed array.
+
+    None and values the transformer could not coerce (kept so BigQuery reports them) do not
+    fit the array. They are stored as 0 and kept by index in a dict of exceptions.
+    """
+
+    __slots__ = ("values", "kind", "others")
+
+    def __init__(self, typecode, kind):
+        self.values = array.array(typecode)
+        self.kind = kind
+        self.others = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        if value.__class__ is self.kind:
+            try:
+                self.values.append(value)
+                return
+            except OverflowError:
+                pass
+        self.others[len(self.values)] = value
+        self.values.append(0)
+
+    def extend(self, values):
+        start = len(self.values)
+        # A bool would be stored as 1 in an INTEGER array and read back as an int
+        if self.kind is not int or not any(value.__class__ is bool for value in values):
+            try:
+                self.values.extend(values)
+                return
+            except (TypeError, OverflowError):
+                # array.extend stops at the first value that does not fit, undo the part it appended
+                del self.values[start:]
+        for value in values:
+            self.append(value)
+
+    def __getitem__(self, index):
+        if self.others and index in self.others:
+            return self.others[index]
+        value = self.values[index]
+        return value == 1 if self.kind is bool else value
+
+    def to_list(self, start=0, end=None):
+        end = len(self.values) if end is None else end
+        values = self.values[start:end].tolist()
+        if self.kind is bool:
+            values = [value == 1 for value in values]
+        for index, value in self.others.items():
+            if start <= index < end:
+                values[index - start] = value
+        return values
+
+
+class DictionaryColumn:
+    """String values stored once each, with an array of codes pointing at them."""
+
+    __slots__ = ("codes", "values", "lookup")
+
+    def __init__(self):
+        self.codes = array.array("I")
+        self.values = []
+        self.lookup = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, value):
+        code = self.lookup.get(value)
+        if code is None:
+            code = self.lookup[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def extend(self, values):
+        lookup = self.lookup
+        distinct = self.values
+        codes = []
+        for value in values:
+            code = lookup.get(value)
+            if code is None:
+                code = lookup[value] = len(distinct)
+                distinct.append(value)
+            codes.append(code)
+        self.codes.extend(codes)
+
+    def __getitem__(self, index):
+        return self.values[self.codes[index]]
+
+    def to_list(self, start=0, end=None):
+        values = self.values
+        return [values[code] for code in self.codes[start:end]]
+
+
+class ValueColumn(list):
+    """High-cardinality values (uniqueCode, date, ...) kept as they are."""
+
+    __slots__ = ()
+
+    def to_list(self, start=0, end=None):
+        return self[start:end]
+
+
+def _column(field, dictionary_fields):
+    if field["type"] in NUMBER_TYPES:
+        return NumberColumn(*NUMBER_TYPES[field["type"]])
+    if field["name"] in dictionary_fields:
+        return DictionaryColumn()
+    return ValueColumn()
+
+
+class RowView(Mapping):
+    """Read-only mapping onto one row of a ColumnBatch, so row.get and row[name] keep working."""
+
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getitem__(self, name):
+        return self.batch.columns[self.batch.positions[name]][self.index]
+
+    def __iter__(self):
+        return iter(self.batch.names)
+
+    def __len__(self):
+        return len(self.batch.names)
+
+
+class ColumnBatch:
+    """Rows of one schema stored column by column.
+
+    Iterating or indexing a batch gives RowView objects. Sinks read whole columns with
+    column() or build row dicts a chunk at a time with iter_dicts() and dicts().
+    """
+
+    def __init__(self, schema, dictionary_fields=()):
+        self.names = [field["name"] for field in schema]
+        self.positions = {name: position for position, name in enumerate(self.names)}
+        self.columns = [_column(field, dictionary_fields) for field in schema]
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not -self.length <= index < self.length:
+            raise IndexError("row index out of range")
+        return RowView(self, index % self.length)
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield RowView(self, index)
+
+    def extend(self, value_tuples, chunk_rows=CHUNK_ROWS):
+        """Appends rows given as tuples of values in schema order (see record_transform.compile_transformer).
+
+        The tuples are transposed a chunk at a time, so each column is extended with a
+        whole run of values instead of one append per field of every row.
+        """
+        value_tuples = iter(value_tuples)
+        while True:
+            chunk = list(itertools.islice(value_tuples, chunk_rows))
+            if not chunk:
+                return
+            for column, values in zip(self.columns, zip(*chunk)):
+                column.extend(values)
+            self.length += len(chunk)
+
+    def column(self, name, start=0, end=None):
+        """Returns the values of one field as a list, optionally of the rows start to end only."""
+        return self.columns[self.positions[name]].to_list(start, end)
+
+    def numbers(self, name):
+        """Returns the typed array of a FLOAT, INTEGER or BOOLEAN field as stored.
+
+        None and values that did not fit the array are 0 in it, so a sum over the array
+        leaves them out. Raises TypeError for a field of another type.
+        """
+        column = self.columns[self.positions[name]]
+        if not isinstance(column, NumberColumn):
+            raise TypeError(f"{name} is not a FLOAT, INTEGER or BOOLEAN field")
+        return column.values
+
+    def dicts(self, indexes):
+        """Returns the rows at the given indexes as dicts."""
+        names = self.names
+        indexes = list(indexes)
+        # Chunks of streaming inserts are runs of consecutive rows, decoded as column slices
+        if indexes and indexes == list(range(indexes[0], indexes[-1] + 1)):
+            columns = [column.to_list(indexes[0], indexes[-1] + 1) for column in self.columns]
+            return [dict(zip(names, values)) for values in zip(*columns)]
+        columns = self.columns
+        return [dict(zip(names, [column[index] for column in columns])) for index in indexes]
+
+    def iter_dicts(self, chunk_rows=CHUNK_ROWS):
+        """Yields every row as a dict, decoding the columns a chunk of rows at a time."""
+        names = self.names
+        for start in range(0, self.length, chunk_rows):
+            end = min(self.length, start + chunk_rows)
+            for values in zip(*[column.to_list(start, end) for column in self.columns]):
+                yield dict(zip(names, values))
+
+
+def sales_batch(records):
+    """Transforms API sales records into a ColumnBatch of the sales schema."""
+    batch = ColumnBatch(record_transform.SALES_SCHEMA, SALES_DICTIONARY_FIELDS)
+    batch.extend(map(record_transform.transform_sale_values, records))
+    return batch
+
+
+def events_batch(records):
+    """Transforms API event records into a ColumnBatch of the events schema."""
+    batch = ColumnBatch(record_transform.EVENTS_SCHEMA, EVENTS_DICTIONARY_FIELDS)
+    batch.extend(map(record_transform.transform_event_values, records))
+    return batch
+
+
+def column_values(rows, name):
+    """Returns one field of every row, for a ColumnBatch or a list of row dicts."""
+    if isinstance(rows, ColumnBatch):
+        return rows.column(name)
+    return [row[name] for row in rows]
+
+
+def iter_row_dicts(row_batches):
+    """Yields the rows of a sequence of batches as dicts, whether the batches are lists or ColumnBatches."""
+    for rows in row_batches:
+        if isinstance(rows, ColumnBatch):
+            yield from rows.iter_dicts()
+        else:
+            yield from rows
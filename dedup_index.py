@@ -0,0 +1,226 @@
+# Persistent index of 64-bit key hashes used to skip rows that are already in a table
+#
+# The index file is a 16-byte header (magic, time of the last reconciliation with BigQuery)
+# followed by the sorted hashes as native int64. It is memory-mapped, so opening it costs
+# the same whatever its size and lookups are a binary search over the mapped pages.
+
+import array
+import bisect
+import hashlib
+import heapq
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+from types import SimpleNamespace
+
+MAGIC = b"SDIDX001"
+HEADER = struct.Struct("=8sq")
+
+# Hashes written per chunk when the merged index is saved
+WRITE_CHUNK = 65536
+
+# Rows per page read from BigQuery when the index is rebuilt
+REBUILD_PAGE_SIZE = 100000
+
+# Generation of the bucket copy each local index file was downloaded from or uploaded as
+_generations = {}
+_storage_client = None
+_lock = threading.Lock()
+
+
+def key_hash(key):
+    """Returns a signed 64-bit hash of a key, stable across runs and instances."""
+    return int.from_bytes(hashlib.blake2b(str(key).encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+
+class DedupIndex:
+    """Sorted 64-bit hashes of the keys in a table, plus the keys added since it was loaded.
+
+    Two keys sharing a hash are reported as the same key. With 64-bit hashes the chance
+    of any collision stays below one in a million up to about 6 million keys.
+    """
+
+    def __init__(self, hashes=(), reconciled_at=0):
+        self._file = None
+        self._map = None
+        self._hashes = hashes
+        self._added = set()
+        self.reconciled_at = reconciled_at
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps an index file. Raises ValueError if the file is not an index."""
+        file = open(path, "rb")
+        try:
+            size = os.fstat(file.fileno()).st_size
+            if size < HEADER.size or (size - HEADER.size) % 8:
+                raise ValueError(f"{path} is not a dedup index")
+            index_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            file.close()
+            raise
+        magic, reconciled_at = HEADER.unpack_from(index_map)
+        if magic != MAGIC:
+            index_map.close()
+            file.close()
+            raise ValueError(f"{path} is not a dedup index")
+        index = cls(memoryview(index_map)[HEADER.size:].cast("q"), reconciled_at)
+        index._file = file
+        index._map = index_map
+        return index
+
+    def __len__(self):
+        return len(self._hashes) + len(self._added)
+
+    def __contains__(self, key):
+        return self._contains_hash(key_hash(key))
+
+    def _contains_hash(self, value):
+        if value in self._added:
+            return True
+        position = bisect.bisect_left(self._hashes, value)
+        return position < len(self._hashes) and self._hashes[position] == value
+
+    @property
+    def added(self):
+        """Number of keys added since the index was loaded."""
+        return len(self._added)
+
+    def add(self, keys):
+        """Adds keys that were written to the table; they are kept in memory until save()."""
+        for key in keys:
+            value = key_hash(key)
+            if not self._contains_hash(value):
+                self._added.add(value)
+
+    def is_stale(self, max_age_seconds, now=None):
+        """True when the index was last reconciled with BigQuery more than max_age_seconds ago."""
+        return (now or time.time()) - self.reconciled_at > max_age_seconds
+
+    def save(self, path, reconciled_at=None):
+        """Writes the merged index to path atomically and maps the new file.
+        Args:
+            path (str): Destination file; written next to it first, then renamed over it.
+            reconciled_at (int): Time of the last reconciliation to record; 0 forces the
+                next run to rebuild the index from BigQuery.
+        """
+        if reconciled_at is not None:
+            self.reconciled_at = reconciled_at
+
+        _write(path, self.reconciled_at, heapq.merge(self._hashes, sorted(self._added)))
+        self.close()
+        loaded = DedupIndex.load(path)
+        self._file, self._map, self._hashes = loaded._file, loaded._map, loaded._hashes
+        self._added = set()
+
+    def close(self):
+        """Releases the mapped file, if any."""
+        if self._map is not None:
+            self._hashes.release()
+            self._hashes = ()
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+
+
+def _write(path, reconciled_at, hashes):
+    # Writes sorted hashes next to path, dropping repeats, then renames the file over path
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(MAGIC, reconciled_at))
+        chunk = array.array("q")
+        previous = None
+        for value in hashes:
+            if value == previous:
+                continue
+            previous = value
+            chunk.append(value)
+            if len(chunk) >= WRITE_CHUNK:
+                chunk.tofile(file)
+                chunk = array.array("q")
+        chunk.tofile(file)
+    os.replace(temporary, path)
+
+
+def rebuild(client, table_id, key, path):
+    """Rebuilds the index of table_id from BigQuery and saves it to path.
+
+    The keys are hashed and sorted page by page as they are read, then the sorted pages
+    are merged into the file, so only the 8-byte hashes are held in memory.
+    Returns:
+        The new DedupIndex, reconciled now.
+    """
+    started = int(time.time())
+    rows = iter(client.query(f"SELECT {key} FROM `{table_id}`").result(page_size=REBUILD_PAGE_SIZE))
+    runs = []
+    while True:
+        page = [getattr(row, key) for row in itertools.islice(rows, REBUILD_PAGE_SIZE)]
+        if not page:
+            break
+        runs.append(array.array("q", sorted(key_hash(value) for value in page if value is not None)))
+    _write(path, started, heapq.merge(*runs))
+    return DedupIndex.load(path)
+
+
+def open_index(client, table_id, key, path, reconcile_seconds, bucket=None):
+    """Returns the dedup index of table_id, rebuilding it from BigQuery when needed.
+
+    With a Cloud Storage bucket, the local file is replaced by the bucket copy whenever
+    another instance has published a newer one. An index that is missing, unreadable or
+    older than reconcile_seconds is rebuilt from the table.
+    Returns:
+        A tuple (index, rebuilt).
+    """
+    if bucket:
+        generation = _blob(bucket, path, reload=True).generation
+        if generation is not None and generation != _generations.get(path):
+            _blob(bucket, path).download_to_filename(path, if_generation_match=generation)
+            _generations[path] = generation
+
+    try:
+        index = DedupIndex.load(path)
+        if not index.is_stale(reconcile_seconds):
+            return index, False
+        index.close()
+    except (OSError, ValueError) as e:
+        print(f"Dedup index {path} not usable: {e}")
+
+    return rebuild(client, table_id, key, path), True
+
+
+def publish(bucket, index, path):
+    """Uploads the saved index to the bucket, unless another instance published in between.
+
+    If it did, each copy misses the keys the other one added, so the index is uploaded
+    marked as stale instead and the next run rebuilds it from BigQuery.
+    """
+    from google.api_core import exceptions
+
+    blob = _blob(bucket, path)
+    try:
+        blob.upload_from_filename(path, if_generation_match=_generations.get(path, 0))
+    except exceptions.PreconditionFailed:
+        print("Dedup index was published by another instance, marking it for a rebuild.")
+        index.save(path, reconciled_at=0)
+        blob.upload_from_filename(path)
+    _generations[path] = blob.generation
+
+
+def _blob(bucket, path, reload=False):
+    # Imported here so that google-cloud-storage is only needed when a bucket is configured
+    try:
+        from google.cloud import storage
+    except ImportError as e:
+        raise RuntimeError("DEDUP_INDEX_BUCKET needs the google-cloud-storage package") from e
+
+    with _lock:
+        global _storage_client
+        if _storage_client is None:
+            _storage_client = storage.Client()
+    if reload:
+        return _storage_client.bucket(bucket).get_blob(os.path.basename(path)) or SimpleNamespace(generation=None)
+    return _storage_client.bucket(bucket).blob(os.path.basename(path))
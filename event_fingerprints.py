@@ -0,0 +1,60 @@
+# Per-event content fingerprints used to upsert only the events that changed
+
+import hashlib
+import json
+
+import lazy_imports
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+FINGERPRINT_TABLE = "event_fingerprints"
+
+
+def create_fingerprint_table_if_not_exists(client, project_id, dataset_id, table_name=FINGERPRINT_TABLE):
+    """Creates the table holding one fingerprint per event id if it does not exist."""
+    schema = [
+        bigquery.SchemaField("id", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("fingerprint", "INTEGER", mode="REQUIRED")
+    ]
+
+    table_ref = bigquery.Table(f"{project_id}.{dataset_id}.{table_name}", schema=schema)
+    try:
+        client.create_table(table_ref)
+        print(f"Created table {table_name}")
+    except Exception as e:
+        if "Already Exists" in str(e):
+            print(f"Table {table_name} already exists.")
+        else:
+            raise e
+
+
+def fingerprint(row):
+    """Returns a signed 64-bit hash of every column of a row, stable across runs and key order."""
+    payload = json.dumps(row, sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(payload, digest_size=8).digest(), "big", signed=True)
+
+
+def load_fingerprints(client, table_id, ids):
+    """Returns a dict of event id -> fingerprint of the row last written for it, for the given ids."""
+    query = f"SELECT id, fingerprint FROM `{table_id}` WHERE id IN UNNEST(@ids)"
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("ids", "STRING", list(ids))]
+    )
+    results = client.query(query, job_config=job_config).result()
+    return {row.id: row.fingerprint for row in results}
+
+
+def changed_rows(rows, fingerprints, key="id"):
+    """Keeps the rows that are new or whose content differs from their stored fingerprint.
+    Returns:
+        A tuple (rows, new_fingerprints) with the rows to write and the fingerprints to store
+        for them once they are written.
+    """
+    changed = []
+    new_fingerprints = {}
+    for row in rows:
+        row_fingerprint = fingerprint(row)
+        if fingerprints.get(row[key]) != row_fingerprint:
+            changed.append(row)
+            new_fingerprints[row[key]] = row_fingerprint
+    return changed, new_fingerprints
@@ -0,0 +1,45 @@
+# Selection of the events whose sales are synced, read from the events table
+
+from datetime import datetime, timezone
+
+import lazy_imports
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+# Event codes sent per sales report request
+DEFAULT_BATCH_SIZE = 10
+
+
+def load_active_event_codes(client, events_table_id, past, future, now=None):
+    """Returns the ids of the events whose start falls inside the active window.
+
+    The window runs from now - past (events that just finished can still get late sales)
+    to now + future (events on sale ahead of the date). Events without a parseable start
+    are left out.
+    Args:
+        client (bigquery.Client): The BigQuery client.
+        events_table_id (str): Fully qualified events table maintained by the events function.
+        past (timedelta): How long after its start an event is still synced.
+        future (timedelta): How far ahead of its start an event is already synced.
+    Returns:
+        A sorted list of event codes.
+    """
+    now = now or datetime.now(timezone.utc)
+    query = f"""
+        SELECT DISTINCT id FROM `{events_table_id}`
+        WHERE SAFE_CAST(starts AS TIMESTAMP) BETWEEN @window_start AND @window_end
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("window_start", "TIMESTAMP", now - past),
+            bigquery.ScalarQueryParameter("window_end", "TIMESTAMP", now + future)
+        ]
+    )
+    results = client.query(query, job_config=job_config).result()
+    return sorted(row.id for row in results if row.id)
+
+
+def batch_codes(codes, batch_size=DEFAULT_BATCH_SIZE):
+    """Splits event codes into lists of at most batch_size codes, one per report request."""
+    codes = list(codes)
+    return [codes[i:i + batch_size] for i in range(0, len(codes), max(1, batch_size))]
@@ -0,0 +1,109 @@
+# Clients, HTTP sessions and the API key, created once per instance and reused by warm invocations
+
+import functools
+import os
+import threading
+import time
+
+import api_scheduler
+import lazy_imports
+import response_cache
+
+# The client libraries and the session module are imported by the first call that needs them
+bigquery = lazy_imports.module("google.cloud.bigquery")
+secretmanager = lazy_imports.module("google.cloud.secretmanager")
+api_session = lazy_imports.module("api_session")
+
+SECRET_ID = "SEE_TICKETS_API_KEY"
+
+# How long a fetched API key is reused before Secret Manager is asked again
+API_KEY_TTL_SECONDS = int(os.environ.get("API_KEY_TTL_SECONDS", "3600"))
+
+# Keep-alive connections per host; should cover the number of concurrent page requests
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))
+
+# API pages whose validators and digest are kept for conditional requests
+HTTP_CACHE_MAX_ENTRIES = int(os.environ.get("HTTP_CACHE_MAX_ENTRIES", response_cache.DEFAULT_MAX_ENTRIES))
+
+_lock = threading.RLock()
+_bigquery_clients = {}
+_secret_client = None
+_api_keys = {}
+_sessions = {}
+_scheduler = None
+_http_cache = None
+
+
+def bigquery_client(project_id):
+    """Returns the shared BigQuery client for project_id."""
+    with _lock:
+        if project_id not in _bigquery_clients:
+            _bigquery_clients[project_id] = bigquery.Client(project=project_id)
+        return _bigquery_clients[project_id]
+
+
+def secret_client():
+    """Returns the shared Secret Manager client."""
+    global _secret_client
+    with _lock:
+        if _secret_client is None:
+            _secret_client = secretmanager.SecretManagerServiceClient()
+        return _secret_client
+
+
+def api_key(project_id, refresh=False):
+    """Returns the See Tickets API key, reading Secret Manager at most once per TTL.
+    Args:
+        project_id (str): Project holding the SEE_TICKETS_API_KEY secret.
+        refresh (bool): Ignore the cached key, e.g. after the API answered 401.
+    """
+    cached = _api_keys.get(project_id)
+    if cached and not refresh and time.monotonic() - cached[1] < API_KEY_TTL_SECONDS:
+        return cached[0]
+
+    secret_name = f"projects/{project_id}/secrets/{SECRET_ID}/versions/latest"
+    response = secret_client().access_secret_version(name=secret_name)
+    key = response.payload.data.decode("UTF-8")
+    _api_keys[project_id] = (key, time.monotonic())
+    return key
+
+
+def request_scheduler():
+    """Returns the rate limiter and retry policy shared by every See Tickets session."""
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = api_scheduler.RequestScheduler()
+        return _scheduler
+
+
+def see_tickets_session(project_id):
+    """Returns the shared, pooled HTTP session for See Tickets API calls."""
+    with _lock:
+        if project_id not in _sessions:
+            _sessions[project_id] = api_session.SeeTicketsSession(
+                functools.partial(api_key, project_id), request_scheduler(), HTTP_POOL_SIZE
+            )
+        return _sessions[project_id]
+
+
+def http_cache():
+    """Returns the conditional-request cache shared by the invocations of this instance."""
+    global _http_cache
+    with _lock:
+        if _http_cache is None:
+            _http_cache = response_cache.ResponseCache(HTTP_CACHE_MAX_ENTRIES)
+        return _http_cache
+
+
+def reset():
+    """Forgets the clients, sessions and API keys of this instance, e.g. in a forked worker process."""
+    global _lock, _secret_client, _scheduler, _http_cache
+    # A lock held by a thread of the parent process stays held in the child, so replace it
+    _lock = threading.RLock()
+    _bigquery_clients.clear()
+    _secret_client = None
+    _api_keys.clear()
+    _sessions.clear()
+    _scheduler = None
+    _http_cache = None
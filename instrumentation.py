@@ -0,0 +1,152 @@
+# Per-stage timing and volume counters for Cloud Function invocations
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import profiling
+
+# Size caps for the debug sample of an API payload that replaces the full dump
+LOG_SAMPLE_RECORDS = int(os.environ.get("LOG_SAMPLE_RECORDS", "3"))
+LOG_SAMPLE_CHARS = int(os.environ.get("LOG_SAMPLE_CHARS", "2000"))
+
+
+class Invocation:
+    """Collects wall time, row counts and bytes in/out per stage of one invocation.
+
+    Stage times are exclusive: when a stage runs inside another one on the same thread
+    (e.g. fetching while the insert stage pulls rows from a generator), the inner time is
+    only counted for the inner stage. Counters can be added from any thread.
+    """
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.started = time.perf_counter()
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, stage, seconds=0.0, rows=0, bytes_in=0, bytes_out=0, calls=0):
+        """Adds to the counters of a stage."""
+        with self._lock:
+            counters = self.stages.setdefault(
+                stage, {"seconds": 0.0, "calls": 0, "rows": 0, "bytes_in": 0, "bytes_out": 0}
+            )
+            counters["seconds"] += seconds
+            counters["calls"] += calls
+            counters["rows"] += rows
+            counters["bytes_in"] += bytes_in
+            counters["bytes_out"] += bytes_out
+
+    @contextmanager
+    def stage(self, name):
+        """Times the enclosed block as one call of the named stage."""
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        frame = {"child_seconds": 0.0}
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if stack:
+                stack[-1]["child_seconds"] += elapsed
+            self.add(name, seconds=elapsed - frame["child_seconds"], calls=1)
+
+    def timed_iter(self, iterable, name, rows=None):
+        """Wraps an iterable so the time spent producing each item counts towards a stage.
+
+        rows, if given, maps each item to the number of rows it adds to the stage (e.g. len
+        for batches).
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            if rows is not None:
+                self.add(name, rows=rows(item))
+            yield item
+
+    def summary(self, status=None):
+        """Returns the collected counters as a JSON-serializable dict."""
+        with self._lock:
+            stages = {
+                name: dict(counters, seconds=round(counters["seconds"], 6))
+                for name, counters in self.stages.items()
+            }
+        return {
+            "function": self.function_name,
+            "status": status,
+            "seconds": round(time.perf_counter() - self.started, 6),
+            "stages": stages,
+        }
+
+    def log(self, status=None):
+        """Emits the summary as one structured log line (parsed by Cloud Logging)."""
+        summary = self.summary(status)
+        print(json.dumps({
+            "severity": "INFO" if status is None or status < 400 else "ERROR",
+            "message": f"{self.function_name} finished with status {status} in {summary['seconds']:.3f}s",
+            **summary,
+        }))
+        return summary
+
+
+def wants_stats(request):
+    """True when the caller asked for the stage counters in the response (?stats=1)."""
+    args = getattr(request, "args", None) or {}
+    return str(args.get("stats", "")).lower() in ("1", "true", "yes")
+
+
+def instrumented(function_name):
+    """Decorates a handler(request, stats) so it runs with a fresh Invocation.
+
+    The summary is logged once per invocation, whatever path the handler returns from,
+    and appended to the response body as JSON when the request has ?stats=1. A request
+    with ?profile=1 or X-Profile: 1 is also profiled (see profiling.py); the report is
+    logged and appended to the body before the summary.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(request):
+            stats = Invocation(function_name)
+            status = 500
+            profiler = profiling.start(request, function_name)
+            report = None
+            try:
+                result = handler(request, stats)
+                body, status = result if isinstance(result, tuple) else (result, 200)
+            finally:
+                if profiler is not None:
+                    report = profiling.finish(profiler)
+                summary = stats.log(status)
+            if report is not None:
+                body = f"{body}\n{json.dumps(report)}"
+            if wants_stats(request):
+                body = f"{body}\n{json.dumps(summary)}"
+            return body, status
+        return wrapper
+    return decorator
+
+
+def sample_payload(response_json, max_records=LOG_SAMPLE_RECORDS, max_chars=LOG_SAMPLE_CHARS):
+    """Returns a size-capped debug rendering of an API payload: the first records and a count."""
+    data = response_json.get("data", []) if isinstance(response_json, dict) else []
+    sample = {
+        "records": len(data),
+        "sample": data[:max_records],
+        "keys": sorted(response_json) if isinstance(response_json, dict) else None,
+    }
+    text = json.dumps(sample, default=str)
+    if len(text) > max_chars:
+        text = text[:max_chars] + "...(truncated)"
+    return text
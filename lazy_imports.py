@@ -0,0 +1,45 @@
+# Deferred imports of the heavy client libraries
+#
+# google.cloud.bigquery, google.cloud.secretmanager and requests take several hundred
+# milliseconds to import together, and a cold start pays for every import at module level.
+# module() returns a stand-in that imports the real module on its first attribute access,
+# so an invocation only pays for the libraries on the code path it actually runs.
+
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Stands in for a module until one of its attributes is used, then forwards to it."""
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            # import_module holds the module's import lock, so concurrent first uses import it once
+            module = self.__dict__["_module"] = importlib.import_module(self.__name__)
+        return module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def module(name):
+    """Returns the module if it is already imported, else a LazyModule importing it on first use."""
+    return sys.modules.get(name) or LazyModule(name)
+
+
+def loaded(name):
+    """True when the real module has been imported, by a LazyModule or otherwise."""
+    return name in sys.modules
@@ -1,10 +1,11 @@
+import argparse
+import os
 import requests
 import json
 
-def fetch_all_records():
-    url = "https://clients-api.seetickets.com/v1/events/search"
+def fetch_all_records(url="https://clients-api.seetickets.com/v1/events/search", api_key="{{API_KEY}}"):
     headers = {
-        "Authorization": "Bearer {{API_KEY}}",
+        "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
 
@@ -17,11 +18,54 @@ def fetch_all_records():
         print(f"Failed to fetch records. Status code: {response.status_code}")
         return None
 
+def fetch_every_page(url, api_key, page_size):
+    """Fetches every page of the events search and returns the merged records."""
+    import see_tickets_api
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    records, pages = see_tickets_api.fetch_all_pages(url, headers, {}, page_size=page_size, method="GET")
+    print(f"Fetched {len(records)} events in {pages} pages.")
+    return records
+
+def write_records(records, path):
+    """Writes the transformed events to a .parquet file or a gzip-compressed NDJSON file."""
+    import bigquery_sink
+    import record_transform
+    import table_layout
+
+    rows = (record_transform.transform_event(record) for record in records)
+    with open(path, "wb") as file:
+        if path.endswith(".parquet"):
+            count = bigquery_sink.write_parquet(rows, table_layout.schema_fields(record_transform.EVENTS_SCHEMA), file)
+        else:
+            count = bigquery_sink.write_ndjson(rows, file)
+    print(f"Wrote {count} events to {path}.")
+
 def beautify_json(data):
     return json.dumps(data, indent=4, sort_keys=True)
 
 if __name__ == "__main__":
-    records = fetch_all_records()
-    if records:
-        pretty_records = beautify_json(records)
-        print(pretty_records)
+    parser = argparse.ArgumentParser(description="Print the events search, or save every event to a file.")
+    parser.add_argument("--url", default="https://clients-api.seetickets.com/v1/events/search")
+    parser.add_argument("--api-key", default=os.environ.get("SEE_TICKETS_API_KEY", "{{API_KEY}}"))
+    parser.add_argument("--out", help="Fetch every page and write the events to this .ndjson.gz or .parquet file")
+    parser.add_argument("--ids", help="Fetch every page and write the event ids, one per line, to this file "
+                                      "(for local_sales.py backfill --events-file)")
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.out or args.ids:
+        events = fetch_every_page(args.url, args.api_key, args.page_size)
+        if args.out:
+            write_records(events, args.out)
+        if args.ids:
+            with open(args.ids, "w") as f:
+                f.writelines(f"{event['id']}\n" for event in events if event.get("id"))
+    else:
+        records = fetch_all_records(args.url, args.api_key)
+        if records:
+            pretty_records = beautify_json(records)
+            print(pretty_records)
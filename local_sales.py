@@ -1,5 +1,10 @@
+import argparse
+import os
 import requests
 import json
+from datetime import date
+
+import see_tickets_api
 
 # Define the URL and headers
 url = "https://clients-api.seetickets.com/v1/reports/sales"
@@ -8,32 +13,95 @@ headers = {
     "Content-Type": "application/json"
 }
 
-# Define the payload
-payload = {
-    # "filteredBy": {
-    #     "salesStartDate": "2024-01-01T00:00:00Z",
-    #     "salesEndDate": "2024-12-31T23:59:59Z"
-    # },
-    # "limit": 100,
-    "offset": 0,
-    "search": {
-        "forSearchItemType": "EVENT",
-        "searchItemCodes": ['DF-2974218', 'DF-2974224', 'DF-2974228', 'DF-2974229', 'DF-2974230', 'DF-2974231', 'DF-2974360', 'DF-2974361', 'DF-2974362', 'DF-2974363']
+# Events whose sales are fetched
+event_codes = ['DF-2974218', 'DF-2974224', 'DF-2974228', 'DF-2974229', 'DF-2974230', 'DF-2974231', 'DF-2974360', 'DF-2974361', 'DF-2974362', 'DF-2974363']
+
+
+def print_first_page(url, headers):
+    """Sends one report request and pretty prints the response."""
+    # Define the payload
+    payload = {
+        # "filteredBy": {
+        #     "salesStartDate": "2024-01-01T00:00:00Z",
+        #     "salesEndDate": "2024-12-31T23:59:59Z"
+        # },
+        # "limit": 100,
+        "offset": 0,
+        "search": {
+            "forSearchItemType": "EVENT",
+            "searchItemCodes": event_codes
+        }
     }
-}
 
-# Convert the payload to a JSON string with indentation for beautification
-payload_json = json.dumps(payload, indent=4)
-
-# Make the POST request
-response = requests.post(url, headers=headers, data=payload_json)
-
-# Check if the response is in JSON format and pretty print it
-if response.headers.get('Content-Type') == 'application/json':
-    response_json = response.json()
-    pretty_response = json.dumps(response_json, indent=4)
-    print("Status Code:", response.status_code)
-    print("Response Body:", pretty_response)
-else:
-    print("Status Code:", response.status_code)
-    print("Response Body:", response.text)
+    # Convert the payload to a JSON string with indentation for beautification
+    payload_json = json.dumps(payload, indent=4)
+
+    # Make the POST request
+    response = requests.post(url, headers=headers, data=payload_json)
+
+    # Check if the response is in JSON format and pretty print it
+    if response.headers.get('Content-Type') == 'application/json':
+        response_json = response.json()
+        pretty_response = json.dumps(response_json, indent=4)
+        print("Status Code:", response.status_code)
+        print("Response Body:", pretty_response)
+    else:
+        print("Status Code:", response.status_code)
+        print("Response Body:", response.text)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the first page of the sales report, or backfill its history to local files."
+    )
+    parser.add_argument("--url", default=url, help="Sales report endpoint, e.g. a local mock server")
+    parser.add_argument("--api-key", default=os.environ.get("SEE_TICKETS_API_KEY"),
+                        help="API key (default: $SEE_TICKETS_API_KEY)")
+    commands = parser.add_subparsers(dest="command")
+
+    backfill = commands.add_parser("backfill", help="Fetch a date range in parallel into partition files")
+    backfill.add_argument("--start", type=date.fromisoformat, required=True, help="First day, YYYY-MM-DD")
+    backfill.add_argument("--end", type=date.fromisoformat, default=date.today(),
+                          help="Day after the last one, YYYY-MM-DD (default: today)")
+    backfill.add_argument("--out", default="backfill", help="Output directory (default: backfill)")
+    backfill.add_argument("--events", nargs="+", default=event_codes, help="Event codes (default: the ten above)")
+    backfill.add_argument("--events-file", help="File with one event code per line, e.g. from local_fetch_records.py --ids")
+    backfill.add_argument("--format", choices=("ndjson", "parquet"), default="ndjson")
+    backfill.add_argument("--unit-days", type=int, default=30, help="Days per work unit (default: 30)")
+    backfill.add_argument("--codes-per-unit", type=int, default=1, help="Event codes per work unit (default: 1)")
+    backfill.add_argument("--workers", type=int, default=8, help="Work units fetched at once (default: 8)")
+    backfill.add_argument("--processes", action="store_true", help="Use worker processes instead of threads")
+    backfill.add_argument("--page-size", type=int, default=see_tickets_api.DEFAULT_PAGE_SIZE)
+    backfill.add_argument("--page-workers", type=int, default=1, help="Pages of one unit fetched at once")
+    backfill.add_argument("--rate", type=float, default=0, help="Requests per second allowed, 0 for no limit")
+    backfill.add_argument("--project", help="Read the API key from Secret Manager in this project instead of --api-key")
+    args = parser.parse_args()
+
+    request_headers = dict(headers)
+    if args.api_key:
+        request_headers["Authorization"] = f"Bearer {args.api_key}"
+
+    if args.command != "backfill":
+        print_first_page(args.url, request_headers)
+        return
+
+    # Imported here so that printing a page only needs requests
+    import sales_backfill
+
+    codes = args.events
+    if args.events_file:
+        with open(args.events_file) as f:
+            codes = [line.strip() for line in f if line.strip()]
+
+    totals = sales_backfill.backfill(
+        codes, args.start, args.end, args.out, args.api_key or "{{API_KEY}}", url=args.url,
+        output_format=args.format, unit_days=args.unit_days, codes_per_unit=args.codes_per_unit,
+        workers=args.workers, processes=args.processes, page_size=args.page_size,
+        page_workers=args.page_workers, rate=args.rate, project_id=args.project
+    )
+    if totals["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+# Overlaps the fetch, transform and insert stages of a sync with threads and bounded queues
+#
+# Each stage of a sync is already a generator pulling from the one before it. prefetch runs
+# a stage in a background thread that keeps at most a few items ready in a queue, so page
+# N+1 is fetched while page N is transformed and page N-1 is written. A full queue blocks
+# the stage that filled it, which keeps memory bounded by the queue depths.
+
+import queue
+import threading
+
+# Items a stage may produce ahead of the stage consuming them
+DEFAULT_DEPTH = 2
+
+# How often a stage blocked on a full queue checks whether its consumer has stopped
+_POLL_SECONDS = 0.1
+
+_DONE = object()
+
+
+class _Failure:
+    """Carries an exception raised by a stage over to the thread consuming it."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(iterable, depth=DEFAULT_DEPTH, name="pipeline-stage"):
+    """Iterates over iterable in a background thread, at most depth items ahead of the caller.
+
+    An exception raised while producing an item is raised again in the caller, after the
+    items produced before it. If the caller stops early (an exception, a break or a time
+    budget), the producer is stopped before it produces another item.
+    Args:
+        iterable: The stage to run, e.g. a generator of batches.
+        depth (int): Size of the queue between the stage and the caller.
+        name (str): Name of the background thread.
+    """
+    items = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def put(item):
+        # Waits for room in the queue; returns False if the caller has stopped consuming
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            # Run the stage's own cleanup, e.g. shutting down its request pool
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class Pipeline:
+    """The overlapped stages of one sync, stopped together when the with block exits.
+
+    Stages are started with stage(), in order from the first to the last. When disabled,
+    stage() returns its argument unchanged and everything runs on the caller's thread.
+    """
+
+    def __init__(self, depth=DEFAULT_DEPTH, enabled=True, stats=None):
+        self.depth = depth
+        self.enabled = enabled
+        self.stats = stats
+        self.stages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # Stop the last stage first; each stage then stops the one it pulls from
+        for stage in reversed(self.stages):
+            stage.close()
+        return False
+
+    def stage(self, iterable, name):
+        """Runs iterable in its own thread and returns the iterator to consume it from.
+
+        With stats, the time the consumer spends waiting for an item counts towards the
+        "wait" stage, so the consumer's own stage times stay exclusive.
+        """
+        if not self.enabled:
+            return iterable
+        stage = prefetch(iterable, self.depth, name)
+        self.stages.append(stage)
+        if self.stats is None:
+            return stage
+        return self.stats.timed_iter(stage, "wait")
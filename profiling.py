@@ -0,0 +1,236 @@
+# Opt-in CPU and allocation profiling of single Cloud Function invocations
+#
+# A caller asks for a profile with ?profile=1 or an X-Profile: 1 header. The invocation then
+# runs under cProfile (one profiler per thread it starts, timing each thread's CPU time) and
+# tracemalloc. A compact report of the hottest functions and the largest allocation sites
+# near the memory peak is logged and appended to the response. ?profile=full also keeps the
+# whole cProfile output.
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# "request" profiles the invocations that ask for it, "off" ignores the switch
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "request")
+
+# Functions and allocation sites listed in the report
+PROFILE_TOP = int(os.environ.get("PROFILE_TOP", "15"))
+
+# Where ?profile=full writes the .prof file (read with pstats or snakeviz) and an optional
+# Cloud Storage bucket it is uploaded to, since /tmp goes away with the instance
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp")
+PROFILE_BUCKET = os.environ.get("PROFILE_BUCKET", "")
+
+# How often the allocation sampler checks whether memory reached a new peak, and the growth
+# over the last snapshot needed before it takes another one (snapshots are not free)
+PROFILE_SAMPLE_SECONDS = float(os.environ.get("PROFILE_SAMPLE_SECONDS", "0.5"))
+PROFILE_SNAPSHOT_GROWTH = 1.1
+
+# Stack frames kept per traced allocation
+TRACEMALLOC_FRAMES = 1
+
+# From Python 3.12 one cProfile.Profile sees every thread, so a per-thread CPU clock would mix
+# up the threads; it measures wall time instead and blocking calls show up as hot
+PER_THREAD_PROFILES = sys.version_info < (3, 12)
+PROFILE_TIMER = time.thread_time if PER_THREAD_PROFILES else time.perf_counter
+
+# tracemalloc and thread profiling hooks are process-wide, so only one invocation is profiled at a time
+_busy = threading.Lock()
+
+
+def requested(request):
+    """Returns "1" or "full" when the caller asked for a profile, None otherwise."""
+    if PROFILE_MODE != "request":
+        return None
+    args = getattr(request, "args", None) or {}
+    headers = getattr(request, "headers", None) or {}
+    value = str(args.get("profile") or headers.get("X-Profile") or "").lower()
+    if value == "full":
+        return "full"
+    return "1" if value in ("1", "true", "yes") else None
+
+
+class Profiler:
+    """cProfile and tracemalloc around one invocation, started and stopped once."""
+
+    def __init__(self, function_name, full=False, top=PROFILE_TOP):
+        self.function_name = function_name
+        self.full = full
+        self.top = top
+        self.profiles = []
+        self._profiles_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._peak_snapshot = None
+        self._peak_size = 0
+
+    def _profile_thread(self, frame, event, arg):
+        # Installed by threading.setprofile, so it runs once in every thread started while
+        # profiling; enabling a cProfile.Profile replaces it with that profiler
+        profile = cProfile.Profile(PROFILE_TIMER)
+        with self._profiles_lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def _sample(self):
+        # Keeps the snapshot taken closest to the memory peak
+        while not self._stop.wait(PROFILE_SAMPLE_SECONDS):
+            size = tracemalloc.get_traced_memory()[0]
+            if size > self._peak_size * PROFILE_SNAPSHOT_GROWTH:
+                self._peak_snapshot = tracemalloc.take_snapshot()
+                self._peak_size = size
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+        self._sampler.start()
+        if PER_THREAD_PROFILES:
+            threading.setprofile(self._profile_thread)
+        self.main = cProfile.Profile(PROFILE_TIMER)
+        self.started = time.perf_counter()
+        self.main.enable()
+
+    def stop(self):
+        """Stops profiling and returns the report as a JSON-serializable dict."""
+        self.main.disable()
+        seconds = time.perf_counter() - self.started
+        if PER_THREAD_PROFILES:
+            threading.setprofile(None)
+        self._stop.set()
+        self._sampler.join()
+
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        if self._peak_snapshot is None or current >= self._peak_size:
+            self._peak_snapshot, self._peak_size = snapshot, current
+        tracemalloc.stop()
+
+        # Profiles of threads still running are read as they are
+        stats = pstats.Stats(self.main)
+        with self._profiles_lock:
+            for profile in self.profiles:
+                profile.disable()
+                profile.create_stats()
+                if profile.stats:
+                    stats.add(profile)
+
+        report = {
+            "function": self.function_name,
+            "seconds": round(seconds, 6),
+            "threads": len(self.profiles) + 1,
+            "peak_bytes": peak,
+            "hot_functions": hot_functions(stats, self.top),
+            "allocation_sites": allocation_sites(self._peak_snapshot, self.top),
+            "allocation_snapshot_bytes": self._peak_size,
+        }
+        if self.full:
+            report["artifact"] = save_artifact(stats, self.function_name)
+        return report
+
+
+def _location(function):
+    filename, line, name = function
+    if filename == "~":
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def hot_functions(stats, top):
+    """Returns the top functions by own CPU time, with their cumulative time and call count."""
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:top]
+    return [
+        {
+            "function": _location(function),
+            "calls": calls,
+            "own_seconds": round(own, 6),
+            "cumulative_seconds": round(cumulative, 6)
+        }
+        for function, (_, calls, own, cumulative, _) in rows
+    ]
+
+
+def allocation_sites(snapshot, top):
+    """Returns the source lines holding the most memory in a tracemalloc snapshot."""
+    if snapshot is None:
+        return []
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    return [
+        {"site": f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+         "bytes": stat.size, "blocks": stat.count}
+        for stat in snapshot.statistics("lineno")[:top]
+    ]
+
+
+def save_artifact(stats, function_name):
+    """Writes the full profile to PROFILE_DIR, and uploads it to PROFILE_BUCKET if set.
+    Returns:
+        The path or gs:// URI of the profile, or the error that prevented writing it.
+    """
+    name = f"{function_name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.prof"
+    path = os.path.join(PROFILE_DIR, name)
+    try:
+        stats.dump_stats(path)
+        if not PROFILE_BUCKET:
+            return path
+        # Imported here so that google-cloud-storage is only needed when a bucket is configured
+        try:
+            from google.cloud import storage
+        except ImportError as e:
+            raise RuntimeError("PROFILE_BUCKET needs the google-cloud-storage package") from e
+        storage.Client().bucket(PROFILE_BUCKET).blob(name).upload_from_filename(path)
+        return f"gs://{PROFILE_BUCKET}/{name}"
+    except Exception as e:
+        print(f"Error saving profile: {e}")
+        return f"Error saving profile: {e}"
+
+
+def start(request, function_name):
+    """Starts a Profiler if the request asked for one and no other invocation is being profiled."""
+    mode = requested(request)
+    if mode is None:
+        return None
+    if not _busy.acquire(blocking=False):
+        print("Another invocation is being profiled, this one runs without profiling.")
+        return None
+    profiler = Profiler(function_name, full=mode == "full")
+    try:
+        profiler.start()
+    except Exception:
+        _busy.release()
+        raise
+    return profiler
+
+
+def finish(profiler):
+    """Stops the profiler, logs its report as one structured line and returns the report."""
+    try:
+        report = profiler.stop()
+    finally:
+        _busy.release()
+    print(json.dumps({
+        "severity": "INFO",
+        "message": f"{report['function']} profile: peak {report['peak_bytes'] / 1e6:.1f} MB traced",
+        "profile": report,
+    }))
+    return report
+
+
+def format_report(report):
+    """Renders a report as a short text table, e.g. for a terminal."""
+    out = io.StringIO()
+    out.write(f"{report['function']}: {report['seconds']:.3f}s in {report['threads']} threads, "
+              f"peak {report['peak_bytes'] / 1e6:.1f} MB traced\n")
+    out.write("  own s     cum s     calls  function\n")
+    for row in report["hot_functions"]:
+        out.write(f"  {row['own_seconds']:8.3f}  {row['cumulative_seconds']:8.3f}  {row['calls']:8}  {row['function']}\n")
+    out.write(f"  allocation sites near the peak ({report['allocation_snapshot_bytes'] / 1e6:.1f} MB):\n")
+    for row in report["allocation_sites"]:
+        out.write(f"  {row['bytes'] / 1e6:8.2f} MB {row['blocks']:9} blocks  {row['site']}\n")
+    if "artifact" in report:
+        out.write(f"  full profile: {report['artifact']}\n")
+    return out.getvalue()
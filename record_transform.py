@@ -0,0 +1,147 @@
+# Record transformers generated from the BigQuery table structure files
+
+import json
+import os
+from datetime import datetime, timezone
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Sales fields that the API nests under "location" instead of returning at the top level
+SALES_NESTED_FIELDS = {
+    "location": ("country", "countryIso", "postCode", "region1", "region2", "region3", "region4")
+}
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def load_schema(filename):
+    """Reads a table structure file (a list of name/type/mode fields) next to this module."""
+    with open(os.path.join(_HERE, filename)) as f:
+        return json.load(f)
+
+
+def to_float(value):
+    if value is None or isinstance(value, float):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def to_integer(value):
+    if value is None or isinstance(value, int):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def to_boolean(value):
+    if value is None or isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ("true", "1", "yes"):
+            return True
+        if lowered in ("false", "0", "no"):
+            return False
+        return value
+    return bool(value)
+
+
+def to_timestamp(value):
+    """Normalizes a date string to UTC "YYYY-MM-DDTHH:MM:SSZ" (with microseconds if present).
+
+    Values already in that shape are returned as they are. Unparseable values are kept so
+    that BigQuery reports them instead of the row silently losing its date.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str) and len(value) == 20 and value[10] == "T" and value[19] == "Z":
+        return value
+    try:
+        parsed = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return value
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    parsed = parsed.astimezone(timezone.utc)
+    if parsed.microsecond:
+        return parsed.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return parsed.strftime(TIMESTAMP_FORMAT)
+
+
+# Coercion applied per BigQuery type: (function, inline check for values that need no call).
+# STRING fields are copied as they are.
+COERCERS = {
+    "FLOAT": ("to_float", "_v.__class__ is float"),
+    "FLOAT64": ("to_float", "_v.__class__ is float"),
+    "INTEGER": ("to_integer", "_v.__class__ is int"),
+    "INT64": ("to_integer", "_v.__class__ is int"),
+    "BOOLEAN": ("to_boolean", "_v.__class__ is bool"),
+    "BOOL": ("to_boolean", "_v.__class__ is bool"),
+    # Only the "T" and the trailing "Z" are checked, to_timestamp returns malformed strings unchanged anyway
+    "TIMESTAMP": ("to_timestamp", "_v.__class__ is str and _v[10::9] == 'TZ'"),
+}
+
+
+def compile_transformer(schema, nested=None, name="transform", as_tuple=False):
+    """Generates a function mapping an API record to a row of the given schema.
+
+    The function body is a single dict literal built once at import, so each row costs
+    one lookup per field and the nested objects are fetched once per row. Every value is
+    coerced to the type declared in the schema, with an inline type check so that values
+    which already have the right type skip the coercion call.
+    Args:
+        schema (list): Fields as read by load_schema.
+        nested (dict): Parent key -> field names the API returns inside that object.
+        name (str): Name given to the generated function.
+        as_tuple (bool): Return the values as a tuple in schema order instead of a dict,
+            e.g. to append them to the columns of a column_batch.ColumnBatch.
+    Returns:
+        A function taking one API record and returning a JSON-serializable row dict.
+    """
+    nested = nested or {}
+    parent_of = {field: parent for parent, fields in nested.items() for field in fields}
+
+    lines = [f"def {name}(record):", "    get = record.get"]
+    for index, parent in enumerate(nested):
+        lines.append(f"    _n{index} = get({parent!r}) or _EMPTY")
+    parent_vars = {parent: f"_n{index}" for index, parent in enumerate(nested)}
+
+    lines.append("    return (" if as_tuple else "    return {")
+    for field in schema:
+        field_name = field["name"]
+        parent = parent_of.get(field_name)
+        getter = f"{parent_vars[parent]}.get({field_name!r})" if parent else f"get({field_name!r})"
+        if field["type"] in COERCERS:
+            # Values that already have the right type skip the function call. The type check
+            # comes first (binding _v) because most values are present and well typed
+            coercer, fast_path = COERCERS[field["type"]]
+            fast_path = fast_path.replace("_v", f"(_v := {getter})", 1)
+            value = f"(_v if {fast_path} or _v is None else {coercer}(_v))"
+        else:
+            value = getter
+        lines.append(f"        {value}," if as_tuple else f"        {field_name!r}: {value},")
+    lines.append("    )" if as_tuple else "    }")
+
+    namespace = {"_EMPTY": {}, **{coercer: globals()[coercer] for coercer, _ in COERCERS.values()}}
+    exec("\n".join(lines), namespace)
+    transformer = namespace[name]
+    transformer.__doc__ = f"Maps an API record to a row with the fields {[f['name'] for f in schema]}."
+    return transformer
+
+
+SALES_SCHEMA = load_schema("table_structure_for_bigquery.json")
+EVENTS_SCHEMA = load_schema("table_structure_for_bigquery_events_sales.json")
+
+transform_sale = compile_transformer(SALES_SCHEMA, nested=SALES_NESTED_FIELDS, name="transform_sale")
+transform_event = compile_transformer(EVENTS_SCHEMA, name="transform_event")
+
+# The same transformers returning value tuples, for column batches
+transform_sale_values = compile_transformer(
+    SALES_SCHEMA, nested=SALES_NESTED_FIELDS, name="transform_sale_values", as_tuple=True
+)
+transform_event_values = compile_transformer(EVENTS_SCHEMA, name="transform_event_values", as_tuple=True)
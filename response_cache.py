@@ -0,0 +1,138 @@
+# Conditional-request cache that lets a sync skip API pages that have not changed since the last run
+#
+# Each page request is keyed on method, URL and payload. The cache keeps the response's
+# ETag / Last-Modified validators, a digest of its body and its record count. A later
+# request for the same page sends If-None-Match / If-Modified-Since; a 304, or a 200 whose
+# body has the same digest, marks the page as unchanged and it is not parsed again.
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 4096
+
+
+class CacheEntry:
+    """What is remembered of one page: its validators, body digest, record count and reported total."""
+
+    def __init__(self, etag=None, last_modified=None, digest=None, count=None, total=None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.count = count
+        self.total = total
+
+
+class ResponseCache:
+    """Least recently used entries shared by the invocations of an instance."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def update(self, entries):
+        with self._lock:
+            for key, entry in entries.items():
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def request_key(method, url, payload):
+    """Identifies a page request independently of headers and payload key order."""
+    return f"{method} {url} {json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)}"
+
+
+def body_digest(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+class UnchangedPage(dict):
+    """Stands in for the JSON body of an unchanged page: no records, but its record count and total."""
+
+    def __init__(self, entry):
+        super().__init__(data=[])
+        if entry.total is not None:
+            self["meta"] = {"total": entry.total}
+        self.record_count = entry.count or 0
+
+
+def page_length(page):
+    """Number of records in a page, including the records of an unchanged page."""
+    return getattr(page, "record_count", None) or len(page.get("data", []))
+
+
+class CachedRequests:
+    """The cache as seen by one sync: lookups use the shared entries, while the entries of pages
+    it fetches are held back until commit(), once their rows are written."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.pending = {}
+        self.unchanged_pages = 0
+        self._lock = threading.Lock()
+
+    def request_headers(self, key):
+        """Returns the conditional headers for a page, empty if it was never fetched."""
+        entry = self.cache.get(key)
+        headers = {}
+        if entry is not None and entry.count is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def check(self, key, response, digest=True):
+        """Returns the cache entry if the response is for an unchanged page, else None.
+
+        A changed page has its new validators (and body digest, unless digest is False for
+        streamed bodies) held as pending.
+        """
+        entry = self.cache.get(key)
+        known = entry is not None and entry.count is not None
+        if response.status_code == 304 and known:
+            return self._unchanged(response, entry)
+        if response.status_code != 200:
+            return None
+
+        body = body_digest(response.content) if digest else None
+        if known and body is not None and body == entry.digest:
+            return self._unchanged(response, entry)
+
+        with self._lock:
+            self.pending[key] = CacheEntry(response.headers.get("ETag"), response.headers.get("Last-Modified"), body)
+        return None
+
+    def _unchanged(self, response, entry):
+        response.close()
+        with self._lock:
+            self.unchanged_pages += 1
+        return entry
+
+    def remember(self, key, count, total=None):
+        """Records the record count and total of a changed page once it is parsed."""
+        with self._lock:
+            entry = self.pending.get(key)
+            if entry is not None:
+                entry.count = count
+                entry.total = total
+
+    def commit(self):
+        """Makes the pages fetched so far count as unchanged for later syncs, once their rows are stored."""
+        with self._lock:
+            pending, self.pending = self.pending, {}
+        self.cache.update({key: entry for key, entry in pending.items() if entry.count is not None})
@@ -0,0 +1,183 @@
+# Parallel backfill of historical sales into local compressed NDJSON or Parquet partitions
+#
+# A date range and a list of event codes are split into work units, one report request
+# each (filteredBy.salesStartDate/salesEndDate). Every unit is written to its own file,
+# renamed into place once complete, so a rerun skips the units that are already on disk.
+
+import functools
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+import api_scheduler
+import api_session
+import bigquery_sink
+import gcp_resources
+import record_transform
+import see_tickets_api
+import table_layout
+
+FORMATS = {"ndjson": ".ndjson.gz", "parquet": ".parquet"}
+
+# Days covered by one work unit and event codes sent per unit
+DEFAULT_UNIT_DAYS = 30
+DEFAULT_CODES_PER_UNIT = 1
+DEFAULT_WORKERS = 8
+
+# Session of the current worker process, created by _init_worker
+_session = None
+
+
+class WorkUnit:
+    """The sales of some events between two days, start included and end excluded."""
+
+    def __init__(self, codes, start, end):
+        self.codes = list(codes)
+        self.start = start
+        self.end = end
+
+    @property
+    def name(self):
+        codes = "-".join(self.codes) if len(self.codes) == 1 else hashlib.sha1(
+            ",".join(sorted(self.codes)).encode("utf-8")).hexdigest()[:12]
+        return f"{self.start:%Y%m%d}-{self.end:%Y%m%d}/{codes}"
+
+    def path(self, out_dir, output_format):
+        return os.path.join(out_dir, self.name + FORMATS[output_format])
+
+    def payload(self):
+        # salesEndDate is inclusive, so stop one second before the next unit starts
+        last_second = f"{self.end - timedelta(days=1):%Y-%m-%d}T23:59:59Z"
+        return {
+            "filteredBy": {"salesStartDate": f"{self.start:%Y-%m-%d}T00:00:00Z", "salesEndDate": last_second},
+            "search": {"forSearchItemType": "EVENT", "searchItemCodes": self.codes}
+        }
+
+
+def plan_units(event_codes, start, end, unit_days=DEFAULT_UNIT_DAYS, codes_per_unit=DEFAULT_CODES_PER_UNIT):
+    """Splits [start, end) and the event codes into work units, newest date range first."""
+    ranges = []
+    day = start
+    while day < end:
+        ranges.append((day, min(day + timedelta(days=unit_days), end)))
+        day += timedelta(days=unit_days)
+    codes = list(event_codes)
+    groups = [codes[i:i + codes_per_unit] for i in range(0, len(codes), max(1, codes_per_unit))]
+    return [WorkUnit(group, range_start, range_end) for range_start, range_end in reversed(ranges) for group in groups]
+
+
+def _static_key(key, refresh=False):
+    return key
+
+
+def _init_worker(rate, pool_size, api_key, project_id):
+    global _session
+    # A forked worker must not share the parent's clients and connections
+    gcp_resources.reset()
+    if project_id:
+        # Read from Secret Manager and read again when the API answers 401, e.g. after a rotation
+        key = functools.partial(gcp_resources.api_key, project_id)
+    else:
+        key = functools.partial(_static_key, api_key)
+    _session = api_session.SeeTicketsSession(key, api_scheduler.RequestScheduler(rate=rate), pool_size)
+
+
+def run_unit(unit, url, out_dir, output_format, page_size, page_workers):
+    """Fetches one work unit and writes its rows to a new partition file.
+    Returns:
+        A tuple (unit, rows, bytes_written, seconds).
+    """
+    started = time.perf_counter()
+    # The session sets the Authorization header
+    headers = {"Content-Type": "application/json"}
+    records, _ = see_tickets_api.fetch_all_pages(
+        url, headers, unit.payload(), page_size=page_size, max_workers=page_workers, http=_session
+    )
+    rows = (record_transform.transform_sale(record) for record in records)
+
+    path = unit.path(out_dir, output_format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as file:
+            if output_format == "parquet":
+                count = bigquery_sink.write_parquet(
+                    rows, table_layout.schema_fields(record_transform.SALES_SCHEMA), file
+                )
+            else:
+                count = bigquery_sink.write_ndjson(rows, file)
+            written = file.tell()
+    except BaseException:
+        os.remove(temporary)
+        raise
+    # The rename marks the unit as done, a unit interrupted before it is fetched again
+    os.replace(temporary, path)
+    return unit, count, written, time.perf_counter() - started
+
+
+def backfill(event_codes, start, end, out_dir, api_key=None, url=see_tickets_api.SALES_URL, output_format="ndjson",
+             unit_days=DEFAULT_UNIT_DAYS, codes_per_unit=DEFAULT_CODES_PER_UNIT, workers=DEFAULT_WORKERS,
+             processes=False, page_size=see_tickets_api.DEFAULT_PAGE_SIZE, page_workers=1,
+             rate=api_scheduler.API_RATE_LIMIT, project_id=None):
+    """Fetches every work unit not on disk yet with a pool of workers and reports throughput.
+    Args:
+        api_key (str): API key used as is, when project_id is not given.
+        project_id (str): Read the API key from Secret Manager in this project, through
+            gcp_resources, so a key rotated during a long backfill is picked up on the next 401.
+        processes (bool): Use worker processes instead of threads, so transforming and
+            compressing use every core. Each process then gets an equal share of rate.
+        rate (float): Requests per second allowed by the API quota, 0 for no limit.
+    Returns:
+        A dict with the number of units done, skipped and failed, and the rows and bytes written.
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"Unknown output format {output_format!r}, expected one of {tuple(FORMATS)}")
+
+    units = plan_units(event_codes, start, end, unit_days, codes_per_unit)
+    pending = [unit for unit in units if not os.path.exists(unit.path(out_dir, output_format))]
+    totals = {"units": len(units), "skipped": len(units) - len(pending), "done": 0, "failed": 0,
+              "rows": 0, "bytes": 0}
+    print(f"{len(units)} work units, {totals['skipped']} already on disk, {len(pending)} to fetch "
+          f"with {workers} {'processes' if processes else 'threads'}.")
+
+    started = time.perf_counter()
+    pool_size = max(1, workers * page_workers)
+    if processes:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(rate / workers if rate else 0, page_workers, api_key, project_id)
+        )
+    else:
+        # Threads share one scheduler and session, so the rate applies to all of them at once
+        _init_worker(rate, pool_size, api_key, project_id)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    with executor:
+        futures = {
+            executor.submit(run_unit, unit, url, out_dir, output_format, page_size, page_workers): unit
+            for unit in pending
+        }
+        for future in as_completed(futures):
+            unit = futures[future]
+            try:
+                _, rows, written, seconds = future.result()
+            except Exception as e:
+                totals["failed"] += 1
+                print(f"Unit {unit.name} failed: {e}")
+                continue
+            totals["done"] += 1
+            totals["rows"] += rows
+            totals["bytes"] += written
+            elapsed = time.perf_counter() - started
+            print(f"[{totals['done'] + totals['failed']}/{len(pending)}] {unit.name}: {rows} rows in "
+                  f"{seconds:.1f}s, {totals['rows'] / elapsed:,.0f} rows/sec overall")
+
+    elapsed = time.perf_counter() - started
+    totals["seconds"] = elapsed
+    print(f"Wrote {totals['rows']} rows ({totals['bytes'] / 1e6:.1f} MB) from {totals['done']} units in "
+          f"{elapsed:.1f}s, {totals['rows'] / elapsed if elapsed else 0:,.0f} rows/sec.")
+    if totals["failed"]:
+        print(f"{totals['failed']} units failed, run the same command again to retry them.")
+    return totals
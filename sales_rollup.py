@@ -0,0 +1,220 @@
+# Daily sales totals per event, price and channel, aggregated in process and merged into a summary table
+
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import bigquery_sink
+import column_batch
+import lazy_imports
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+SUMMARY_TABLE = "sales_daily_summary"
+
+# Label set on the summary table while it misses totals and has to be rebuilt from the sales table
+REBUILD_LABEL = "needs_rebuild"
+
+# Columns a summary row is grouped by, and the sale columns summed into it
+GROUP_FIELDS = ("eventId", "priceId", "salesChannel")
+MEASURE_FIELDS = ("sold", "grossSales", "grossFace", "grossCost", "taxTotal")
+
+# Name and type of every column of the summary table
+SUMMARY_FIELDS = (
+    ("saleDate", "DATE"),
+    ("eventId", "STRING"),
+    ("priceId", "STRING"),
+    ("salesChannel", "STRING"),
+    ("sales", "INTEGER"),
+    ("sold", "INTEGER"),
+    ("grossSales", "FLOAT"),
+    ("grossFace", "FLOAT"),
+    ("grossCost", "FLOAT"),
+    ("taxTotal", "FLOAT"),
+    ("updatedAt", "TIMESTAMP")
+)
+
+
+def summary_schema():
+    """Returns the schema of the summary table as BigQuery SchemaFields."""
+    return [bigquery.SchemaField(name, field_type) for name, field_type in SUMMARY_FIELDS]
+
+
+def create_summary_table_if_not_exists(client, project_id, dataset_id, table_name=SUMMARY_TABLE):
+    """Creates the daily summary table, partitioned by month on saleDate, if it does not exist."""
+    table_ref = bigquery.Table(f"{project_id}.{dataset_id}.{table_name}", schema=summary_schema())
+    table_ref.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.MONTH, field="saleDate"
+    )
+    table_ref.clustering_fields = ["eventId", "priceId", "salesChannel"]
+    try:
+        client.create_table(table_ref)
+        print(f"Created table {table_name}")
+    except Exception as e:
+        if "Already Exists" in str(e):
+            print(f"Table {table_name} already exists.")
+        else:
+            raise e
+
+
+def _sale_day(value):
+    # Transformed dates are UTC "YYYY-MM-DDTHH:MM:SSZ" strings, so the day is their first 10 characters
+    if isinstance(value, str) and len(value) >= 10 and value[4] == "-" and value[7] == "-":
+        return value[:10]
+    return None
+
+
+class DailyRollup:
+    """Running totals of the sales rows added to it, one entry per day, event, price and channel."""
+
+    def __init__(self):
+        self.groups = {}
+        self.rows = 0
+        # Set when rows may have been written without being added, so the totals cannot be merged
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.groups)
+
+    def add(self, rows):
+        """Adds a batch of transformed sales rows, a list of dicts or a ColumnBatch, to the totals."""
+        if isinstance(rows, column_batch.ColumnBatch):
+            self._add_columns(rows)
+            return
+        groups = self.groups
+        for row in rows:
+            key = (_sale_day(row.get("date")), row.get("eventId"), row.get("priceId"), row.get("salesChannel"))
+            totals = groups.get(key)
+            if totals is None:
+                totals = groups[key] = [0, 0, 0.0, 0.0, 0.0, 0.0]
+            totals[0] += 1
+            for position, field in enumerate(MEASURE_FIELDS, 1):
+                value = row.get(field)
+                # Values the transformer could not coerce are left out of the sums
+                if value.__class__ in (int, float):
+                    totals[position] += value
+            self.rows += 1
+
+    def _add_columns(self, batch):
+        # Each row gets the index of its group, then every measure is summed per group straight
+        # from its typed array. Values the transformer could not coerce are 0 there, and so are
+        # integers beyond INT64, which BigQuery would reject anyway
+        keys = zip(map(_sale_day, batch.column("date")), *(batch.column(field) for field in GROUP_FIELDS))
+        indexes = {}
+        row_groups = [indexes.setdefault(key, len(indexes)) for key in keys]
+        group_totals = [self.groups.setdefault(key, [0, 0, 0.0, 0.0, 0.0, 0.0]) for key in indexes]
+
+        for group, count in Counter(row_groups).items():
+            group_totals[group][0] += count
+        for position, field in enumerate(MEASURE_FIELDS, 1):
+            sums = [0] * len(indexes)
+            for group, value in zip(row_groups, batch.numbers(field)):
+                sums[group] += value
+            for totals, value in zip(group_totals, sums):
+                totals[position] += value
+        self.rows += len(batch)
+
+    def update(self, other):
+        """Adds the totals of another rollup to these."""
+        for key, totals in other.groups.items():
+            own = self.groups.setdefault(key, [0, 0, 0.0, 0.0, 0.0, 0.0])
+            for position, value in enumerate(totals):
+                own[position] += value
+        self.rows += other.rows
+        self.dirty = self.dirty or other.dirty
+
+    def summary_rows(self):
+        """Returns the totals as rows of the summary table."""
+        return [
+            {
+                "saleDate": day, "eventId": event_id, "priceId": price_id, "salesChannel": channel,
+                "sales": totals[0], "sold": int(totals[1]),
+                **{field: totals[position] for position, field in enumerate(MEASURE_FIELDS[1:], 2)}
+            }
+            for (day, event_id, price_id, channel), totals in self.groups.items()
+        ]
+
+    def clear(self):
+        self.groups = {}
+        self.rows = 0
+        self.dirty = False
+
+
+def merge_summary(client, table_id, rollup, stats=None):
+    """Adds the totals of a rollup to the summary table with a single MERGE.
+
+    The totals are loaded into a short-lived staging table. Groups already in the summary
+    get the new totals added to theirs, new groups are inserted.
+    Returns:
+        The number of summary rows inserted or updated.
+    """
+    rows = rollup.summary_rows()
+    if not rows:
+        return 0
+
+    staging_id = f"{table_id}_staging_{uuid.uuid4().hex}"
+    try:
+        bigquery_sink.load_rows(
+            client, staging_id, rows, write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+            schema=summary_schema()[:-1], stats=stats
+        )
+        staging = client.get_table(staging_id)
+        staging.expires = datetime.now(timezone.utc) + bigquery_sink.STAGING_TABLE_EXPIRATION
+        client.update_table(staging, ["expires"])
+
+        group_match = " AND ".join(
+            f"T.`{field}` IS NOT DISTINCT FROM S.`{field}`" for field in ("saleDate",) + GROUP_FIELDS
+        )
+        totals = ("sales",) + MEASURE_FIELDS
+        merge_query = f"""
+            MERGE `{table_id}` T
+            USING `{staging_id}` S
+            ON {group_match}
+            WHEN MATCHED THEN
+                UPDATE SET {", ".join(f"`{field}` = IFNULL(T.`{field}`, 0) + S.`{field}`" for field in totals)},
+                    updatedAt = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED THEN
+                INSERT (saleDate, {", ".join(GROUP_FIELDS + totals)}, updatedAt)
+                VALUES (S.saleDate, {", ".join(f"S.{field}" for field in GROUP_FIELDS + totals)}, CURRENT_TIMESTAMP())
+        """
+        query_job = client.query(merge_query)
+        query_job.result()
+        return query_job.num_dml_affected_rows or 0
+    finally:
+        client.delete_table(staging_id, not_found_ok=True)
+
+
+def needs_rebuild(client, table_id):
+    """Returns True if the summary table is marked as missing totals."""
+    return (client.get_table(table_id).labels or {}).get(REBUILD_LABEL) == "true"
+
+
+def mark_for_rebuild(client, table_id, needed=True):
+    """Sets or removes the label marking the summary table as missing totals."""
+    table = client.get_table(table_id)
+    # A label set to None is removed, the other labels are kept
+    table.labels = {**(table.labels or {}), REBUILD_LABEL: "true" if needed else None}
+    client.update_table(table, ["labels"])
+
+
+def rebuild_summary(client, table_id, sales_table_id):
+    """Recomputes the whole summary from the sales table, e.g. after a run that failed part way.
+
+    The table is marked before the rebuild and unmarked after it, so a rebuild that fails is
+    retried by the next run that checks needs_rebuild.
+    """
+    mark_for_rebuild(client, table_id)
+    totals = ", ".join(
+        ["COUNT(*) AS sales"] + [f"SUM({field}) AS {field}" for field in MEASURE_FIELDS]
+    )
+    query = f"""
+        BEGIN TRANSACTION;
+        DELETE FROM `{table_id}` WHERE TRUE;
+        INSERT INTO `{table_id}` (saleDate, {", ".join(GROUP_FIELDS + ("sales",) + MEASURE_FIELDS)}, updatedAt)
+        SELECT DATE(SAFE_CAST(date AS TIMESTAMP)) AS saleDate, {", ".join(GROUP_FIELDS)}, {totals}, CURRENT_TIMESTAMP()
+        FROM `{sales_table_id}`
+        GROUP BY saleDate, {", ".join(GROUP_FIELDS)};
+        COMMIT TRANSACTION;
+    """
+    client.query(query).result()
+    mark_for_rebuild(client, table_id, needed=False)
@@ -0,0 +1,306 @@
+# Sharded fan-out of the sales sync across worker invocations of the same function
+#
+# A coordinator invocation splits the event codes into shards with a consistent hash ring,
+# optionally also by sale date range, and sends each shard to a worker: another invocation
+# of hello_http over HTTP, or a local worker process. Failed shards are sent again with
+# exponential backoff, and the per-shard results are summarized for the coordinator's response.
+# A worker that stopped at a checkpoint answers 202 and is sent again to resume from it.
+
+import bisect
+import hashlib
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
+import gcp_resources
+import lazy_imports
+
+requests = lazy_imports.module("requests")
+
+# Points each shard gets on the hash ring; more points spread the codes more evenly
+DEFAULT_REPLICAS = 64
+
+# Shards sent at once, attempts after the first one and the delay before the first retry
+DEFAULT_WORKERS = 8
+DEFAULT_RETRIES = 2
+RETRY_BASE_DELAY = 1.0
+
+# Seconds a worker invocation may take before the coordinator gives up on it
+DEFAULT_TIMEOUT = 600
+
+# Status of a worker that stopped at a checkpoint and left the rest of its shard to the next run
+PARTIAL_STATUS = 202
+
+# Handler run by local worker processes, set before they are forked
+_local_handler = None
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hash ring of shard numbers.
+
+    Each shard owns replicas points on the ring and an event code belongs to the shard of the
+    first point after the code's hash. Adding a shard only moves the codes it takes over,
+    so the shards keep their checkpoints and warm caches when the shard count changes.
+    """
+
+    def __init__(self, shards, replicas=DEFAULT_REPLICAS):
+        points = sorted((_hash(f"shard-{shard}#{replica}"), shard) for shard in range(shards) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def shard(self, key):
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.shards[index]
+
+
+class Shard:
+    """Event codes, and optionally a sale date filter, synced by one worker invocation."""
+
+    def __init__(self, shard_id, codes, filtered_by=None):
+        self.id = shard_id
+        self.codes = list(codes)
+        self.filtered_by = filtered_by
+
+    def to_json(self):
+        return {"id": self.id, "codes": self.codes, "filteredBy": self.filtered_by}
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(str(value["id"]), value["codes"], value.get("filteredBy"))
+
+
+class ShardResult:
+    """Outcome of the last attempt at a shard, with the rows inserted by all of its attempts."""
+
+    def __init__(self, shard, status, message, attempts, inserted=0):
+        self.shard = shard
+        self.status = status
+        self.message = message
+        self.attempts = attempts
+        self.inserted = inserted
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    @property
+    def partial(self):
+        return self.status == PARTIAL_STATUS
+
+
+def plan_shards(event_codes, shards, start=None, end=None, days=30, replicas=DEFAULT_REPLICAS):
+    """Splits the event codes into shards by consistent hashing.
+
+    With start and end dates, every group of codes is also split into sale date ranges of
+    the given number of days, each its own shard with a filteredBy for that range.
+    Returns:
+        A list of Shard, without the empty ones.
+    """
+    ring = HashRing(shards, replicas)
+    groups = {}
+    for code in event_codes:
+        groups.setdefault(ring.shard(code), []).append(code)
+
+    ranges = [(None, None)]
+    if start is not None and end is not None:
+        ranges = []
+        day = start
+        while day < end:
+            ranges.append((day, min(day + timedelta(days=days), end)))
+            day += timedelta(days=days)
+
+    planned = []
+    for number in sorted(groups):
+        for range_start, range_end in ranges:
+            if range_start is None:
+                planned.append(Shard(str(number), groups[number]))
+                continue
+            # salesEndDate is inclusive, so stop one second before the next range starts
+            filtered_by = {
+                "salesStartDate": f"{range_start:%Y-%m-%d}T00:00:00Z",
+                "salesEndDate": f"{range_end - timedelta(days=1):%Y-%m-%d}T23:59:59Z"
+            }
+            planned.append(Shard(f"{number}-{range_start:%Y%m%d}", groups[number], filtered_by))
+    return planned
+
+
+def request_shard(request):
+    """Returns the Shard a coordinator sent in the request body, or None for a regular invocation."""
+    body = request.get_json(silent=True) if hasattr(request, "get_json") else None
+    if isinstance(body, dict) and isinstance(body.get("shard"), dict):
+        return Shard.from_json(body["shard"])
+    return None
+
+
+class ShardRequest:
+    """The parts of flask.Request a worker invocation reads, for local worker processes."""
+
+    method = "POST"
+
+    def __init__(self, shard_json):
+        self.args = {}
+        self.headers = {}
+        self._body = {"shard": shard_json}
+
+    def get_json(self, silent=False, force=False):
+        return self._body
+
+
+class HttpBackend:
+    """Sends each shard to the function's URL, authenticated with an ID token for that URL."""
+
+    def __init__(self, url, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT):
+        if not url:
+            raise ValueError("The HTTP shard backend needs the function's URL")
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        self._token = None
+        self._token_lock = threading.Lock()
+
+    def __enter__(self):
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+        self.session.close()
+        return False
+
+    def _id_token(self):
+        with self._token_lock:
+            if self._token is None:
+                try:
+                    import google.auth.transport.requests
+                    import google.oauth2.id_token
+                except ImportError as e:
+                    raise RuntimeError("The HTTP shard backend needs the google-auth package") from e
+                self._token = google.oauth2.id_token.fetch_id_token(google.auth.transport.requests.Request(), self.url)
+            return self._token
+
+    def _post(self, shard):
+        response = self.session.post(
+            self.url, json={"shard": shard.to_json()}, headers={"Authorization": f"Bearer {self._id_token()}"},
+            timeout=self.timeout
+        )
+        return response.text, response.status_code
+
+    def submit(self, shard):
+        return self.executor.submit(self._post, shard)
+
+
+def _init_local_worker():
+    # Sessions and clients inherited from the coordinator must not share its connections
+    gcp_resources.reset()
+
+
+def _run_local(shard_json):
+    return _local_handler(ShardRequest(shard_json))
+
+
+class LocalBackend:
+    """Runs each shard in a worker process forked from this one, through the same handler.
+
+    Meant for exercising and benchmarking the sharding on one machine; forking needs Linux
+    or macOS.
+    """
+
+    def __init__(self, handler, processes=DEFAULT_WORKERS):
+        self.handler = handler
+        self.processes = processes
+
+    def __enter__(self):
+        global _local_handler
+        _local_handler = self.handler
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.processes, mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_local_worker
+        )
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+        return False
+
+    def submit(self, shard):
+        return self.executor.submit(_run_local, shard.to_json())
+
+
+def dispatch(shards, backend, retries=DEFAULT_RETRIES):
+    """Runs every shard on the backend and sends the unfinished ones again, up to retries times.
+
+    A shard fails when its worker answers with a 4xx/5xx status or cannot be reached. It is
+    partial when the worker stopped at a checkpoint; it is then sent again right away to resume
+    from there, while failed shards are retried with backoff.
+    Returns:
+        A list of ShardResult in the order of shards.
+    """
+    results = {}
+    inserted = {}
+    pending = list(shards)
+    with backend:
+        for attempt in range(retries + 1):
+            if attempt:
+                failed = sum(not results[shard.id].ok for shard in pending)
+                delay = RETRY_BASE_DELAY * 2 ** (attempt - 1) if failed else 0
+                print(f"Sending {len(pending)} shards again ({failed} failed, {len(pending) - failed} "
+                      f"stopped at a checkpoint) in {delay:.0f}s.")
+                time.sleep(delay)
+
+            futures = {backend.submit(shard): shard for shard in pending}
+            unfinished = []
+            for future in as_completed(futures):
+                shard = futures[future]
+                try:
+                    message, status = future.result()
+                except Exception as e:
+                    message, status = f"{type(e).__name__}: {e}", 500
+                message = message.strip()
+                # Rows a partial attempt inserted stay inserted, so they are added up over the attempts
+                if status < 400:
+                    inserted[shard.id] = inserted.get(shard.id, 0) + inserted_rows(message)
+                results[shard.id] = result = ShardResult(
+                    shard, status, message, attempt + 1, inserted.get(shard.id, 0)
+                )
+                print(f"Shard {shard.id} ({len(shard.codes)} events): {status} {result.message}")
+                if not result.ok or result.partial:
+                    unfinished.append(shard)
+            pending = unfinished
+            if not pending:
+                break
+    return [results[shard.id] for shard in shards]
+
+
+def inserted_rows(message):
+    """Reads the row count out of a worker's response text, 0 if it reports none."""
+    match = re.search(r"nserted (\d+)", message)
+    return int(match.group(1)) if match else 0
+
+
+def summarize(results):
+    """Returns the coordinator's (message, status) for the shard results.
+
+    The status is 500 if a shard failed, else 202 if a shard is still incomplete, else 200.
+    """
+    failed = [result for result in results if not result.ok]
+    incomplete = [result for result in results if result.partial]
+    rows = sum(result.inserted for result in results)
+    synced = len(results) - len(failed) - len(incomplete)
+    message = f"Synced {synced} of {len(results)} shards, inserted {rows} new rows."
+    if incomplete:
+        message += (f" Incomplete shards, resumed by the next run: "
+                    f"{', '.join(result.shard.id for result in incomplete)}.")
+    if failed:
+        message += f" Failed shards: {', '.join(result.shard.id for result in failed)}."
+        return message, 500
+    if incomplete:
+        return message, PARTIAL_STATUS
+    return message, 200
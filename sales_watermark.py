@@ -0,0 +1,158 @@
+# Per-event high-water marks for incremental sales syncs
+
+from datetime import datetime, timedelta, timezone
+
+import lazy_imports
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+WATERMARK_TABLE = "sales_watermarks"
+
+# Format used by filteredBy.salesStartDate / salesEndDate
+API_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def create_watermark_table_if_not_exists(client, project_id, dataset_id, table_name=WATERMARK_TABLE):
+    """Creates the table holding one high-water mark per event code if it does not exist."""
+    schema = [
+        bigquery.SchemaField("eventCode", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("highWaterMark", "TIMESTAMP"),
+        bigquery.SchemaField("updatedAt", "TIMESTAMP")
+    ]
+
+    table_ref = bigquery.Table(f"{project_id}.{dataset_id}.{table_name}", schema=schema)
+    try:
+        client.create_table(table_ref)
+        print(f"Created table {table_name}")
+    except Exception as e:
+        if "Already Exists" in str(e):
+            print(f"Table {table_name} already exists.")
+        else:
+            raise e
+
+
+def parse_sale_date(value):
+    """Parses an API date string into an aware UTC datetime, or returns None."""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def load_watermarks(client, table_id, event_codes):
+    """Returns a dict of event code -> high-water mark for the given codes."""
+    query = f"SELECT eventCode, highWaterMark FROM `{table_id}` WHERE eventCode IN UNNEST(@codes)"
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("codes", "STRING", list(event_codes))]
+    )
+    results = client.query(query, job_config=job_config).result()
+    return {row.eventCode: row.highWaterMark for row in results if row.highWaterMark is not None}
+
+
+def plan_requests(event_codes, watermarks, overlap, now=None):
+    """Groups event codes that share a sales start date into one request each.
+
+    Codes without a watermark are fetched from the beginning of their history. Codes with
+    a watermark are fetched from (watermark - overlap) up to now, so late-arriving sales
+    inside the overlap window are picked up again and filtered out by deduplication.
+    Returns:
+        A list of (codes, filtered_by) tuples; filtered_by is None for a full fetch.
+    """
+    now = now or datetime.now(timezone.utc)
+    groups = {}
+    for code in event_codes:
+        mark = watermarks.get(code)
+        start = (mark - overlap).strftime(API_DATE_FORMAT) if mark else None
+        groups.setdefault(start, []).append(code)
+
+    plan = []
+    for start, codes in groups.items():
+        if start is None:
+            plan.append((codes, None))
+        else:
+            plan.append((codes, {"salesStartDate": start, "salesEndDate": now.strftime(API_DATE_FORMAT)}))
+    return plan
+
+
+class WatermarkTracker:
+    """Accumulates the latest and the earliest pending sale date per requested event code across batches."""
+
+    def __init__(self):
+        self.latest = {}
+        self.earliest_pending = {}
+        self.unmatched = 0
+
+    def observe(self, records, codes):
+        """Records the sale dates of a batch of API records fetched for the given event codes.
+
+        Marks are kept per requested code. In a report of a single code every record belongs
+        to it. In a report of several codes a record is attributed by its eventId, which has
+        to be one of the codes; records whose eventId is not are counted in unmatched and
+        move no mark, so their events are fetched again instead of skipped.
+        """
+        single = codes[0] if len(codes) == 1 else None
+        requested = set(codes)
+        for record in records:
+            event_id = single or record.get("eventId")
+            if event_id not in requested:
+                self.unmatched += 1
+                continue
+            sale_date = parse_sale_date(record.get("date"))
+            if sale_date is None:
+                continue
+            if event_id not in self.latest or sale_date > self.latest[event_id]:
+                self.latest[event_id] = sale_date
+            if record.get("isPending") and (
+                    event_id not in self.earliest_pending or sale_date < self.earliest_pending[event_id]):
+                self.earliest_pending[event_id] = sale_date
+
+    def advance(self, watermarks):
+        """Computes the new high-water mark for every event observed so far.
+
+        The mark moves to the latest sale date of the event, but is held back at the earliest
+        pending sale so that it keeps being fetched until it settles. A mark never moves
+        backwards.
+        """
+        new_marks = {}
+        for event_id, mark in self.latest.items():
+            if event_id in self.earliest_pending:
+                mark = min(mark, self.earliest_pending[event_id])
+            previous = watermarks.get(event_id)
+            if previous is not None and previous >= mark:
+                continue
+            new_marks[event_id] = mark
+        return new_marks
+
+
+def save_watermarks(client, table_id, marks):
+    """Upserts the given event code -> high-water mark pairs with a single MERGE."""
+    if not marks:
+        return
+
+    query = f"""
+        MERGE `{table_id}` T
+        USING UNNEST(@marks) S
+        ON T.eventCode = S.eventCode
+        WHEN MATCHED THEN
+            UPDATE SET highWaterMark = S.highWaterMark, updatedAt = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (eventCode, highWaterMark, updatedAt) VALUES (S.eventCode, S.highWaterMark, CURRENT_TIMESTAMP())
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ArrayQueryParameter("marks", "STRUCT", [
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("eventCode", "STRING", code),
+                    bigquery.ScalarQueryParameter("highWaterMark", "TIMESTAMP", mark)
+                )
+                for code, mark in marks.items()
+            ])
+        ]
+    )
+    client.query(query, job_config=job_config).result()
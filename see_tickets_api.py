@@ -0,0 +1,383 @@
+# Shared helpers for calling the See Tickets clients API
+
+import codecs
+import itertools
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import lazy_imports
+import response_cache
+
+requests = lazy_imports.module("requests")
+
+SALES_URL = "https://clients-api.seetickets.com/v1/reports/sales"
+EVENTS_URL = "https://clients-api.seetickets.com/v1/events/search"
+
+# Page size sent as "limit" and the number of pages fetched at the same time
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MAX_WORKERS = 8
+
+# Records handed to the sink at a time and bytes read per network chunk when streaming
+DEFAULT_BATCH_SIZE = 5000
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class SeeTicketsAPIError(Exception):
+    """Raised when the See Tickets API answers with a non-200 status code."""
+
+    def __init__(self, status_code, text):
+        super().__init__(f"{status_code} {text}")
+        self.status_code = status_code
+        self.text = text
+
+
+def extract_total(response_json):
+    """Returns the total number of records reported by a page, or None if the API did not say."""
+    for container in (response_json, response_json.get("meta") or {}, response_json.get("pagination") or {}):
+        for key in ("total", "totalCount", "totalRecords"):
+            value = container.get(key)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def _page_stride(first_page, total, page_size):
+    """Returns the offset step between the pages that follow first_page, 0 if there are none.
+
+    The API may cap limit below page_size, so with a total the step is the number of
+    records the first page actually held. Only without a total does a page shorter than
+    page_size mark the end of the report.
+    """
+    length = response_cache.page_length(first_page)
+    if total is None:
+        return page_size if length >= page_size else 0
+    return min(length, page_size)
+
+
+def fetch_page(url, headers, payload, offset, limit, method="POST", http=requests, stats=None, cache=None):
+    """Fetches a single page of results starting at offset.
+    Args:
+        url (str): The API endpoint.
+        headers (dict): Request headers, including the Authorization header.
+        payload (dict): The request payload; offset and limit are overridden.
+        offset (int): Index of the first record of the page.
+        limit (int): Maximum number of records in the page.
+        method (str): "POST" sends the payload as a JSON body, "GET" as query parameters.
+        http: Object exposing requests-style post/get, e.g. the requests module or a Session.
+        stats (instrumentation.Invocation): Optional collector for bytes received and parse time.
+        cache (response_cache.CachedRequests): Optional cache; the request is then conditional.
+    Returns:
+        The parsed JSON body of the page, or a response_cache.UnchangedPage without records if
+        the cache knows the page and it has not changed.
+    """
+    key = None
+    if cache is not None:
+        key = response_cache.request_key(method, url, dict(payload, offset=offset, limit=limit))
+        headers = dict(headers, **cache.request_headers(key))
+
+    response = _request_page(url, headers, payload, offset, limit, method, http)
+
+    if cache is not None:
+        entry = cache.check(key, response)
+        if entry is not None:
+            return response_cache.UnchangedPage(entry)
+
+    if response.status_code != 200:
+        raise SeeTicketsAPIError(response.status_code, response.text)
+
+    start = time.perf_counter()
+    page = response.json()
+    if stats is not None:
+        stats.add("parse", seconds=time.perf_counter() - start, bytes_in=len(response.content),
+                  rows=len(page.get("data", [])), calls=1)
+    if cache is not None:
+        cache.remember(key, len(page.get("data", [])), extract_total(page))
+    return page
+
+
+def _request_page(url, headers, payload, offset, limit, method, http, stream=False):
+    page_payload = dict(payload, offset=offset, limit=limit)
+
+    if method == "GET":
+        return http.get(url, headers=headers, params=page_payload, stream=stream)
+    return http.post(url, headers=headers, data=json.dumps(page_payload), stream=stream)
+
+
+def fetch_all_pages(url, headers, payload, page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                    method="POST", http=requests, stats=None, cache=None):
+    """Fetches every page of a report concurrently and merges the records in offset order.
+
+    The first page is fetched on its own to learn the total and the page length the API
+    actually serves. The remaining offsets are then split into pages of that length and
+    fetched with at most max_workers requests in flight. If the API does not report a
+    total, pages of page_size are fetched in windows of max_workers until a short page
+    marks the end of the report. With a cache, the records of unchanged pages are left out.
+    Returns:
+        A tuple (records, pages) with the merged records and the number of pages fetched.
+    """
+    first_page = fetch_page(url, headers, payload, 0, page_size, method, http, stats, cache)
+    records = list(first_page.get("data", []))
+    pages = 1
+
+    total = extract_total(first_page)
+    stride = _page_stride(first_page, total, page_size)
+    if not stride:
+        return records, pages
+
+    def fetch(offset):
+        return fetch_page(url, headers, payload, offset, page_size, method, http, stats, cache)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if total is not None:
+            # executor.map yields results in submission order, so the merge stays ordered
+            offsets = range(stride, total, stride)
+            for page in executor.map(fetch, offsets):
+                records.extend(page.get("data", []))
+                pages += 1
+            return records, pages
+
+        offset = page_size
+        while True:
+            offsets = range(offset, offset + page_size * max_workers, page_size)
+            done = False
+            for page in executor.map(fetch, offsets):
+                if done:
+                    continue
+                records.extend(page.get("data", []))
+                pages += 1
+                if response_cache.page_length(page) < page_size:
+                    done = True
+            if done:
+                return records, pages
+            offset += page_size * max_workers
+
+
+def iter_pages(url, headers, payload, page_size=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+               method="POST", http=requests, stats=None, cache=None):
+    """Yields the records of every page, in order, as soon as each page has arrived.
+
+    Up to max_workers page requests are in flight, and a new one is only sent when the
+    caller takes a page. A caller that transforms or writes page N while pages N+1 onwards
+    are fetched therefore holds at most max_workers pages in memory.
+    """
+    first_page = fetch_page(url, headers, payload, 0, page_size, method, http, stats, cache)
+    if first_page.get("data"):
+        yield first_page["data"]
+
+    total = extract_total(first_page)
+    stride = _page_stride(first_page, total, page_size)
+    if not stride:
+        return
+    if total is None:
+        # Without a total, request pages until a short one marks the end of the report
+        offsets = itertools.count(page_size, page_size)
+    else:
+        offsets = iter(range(stride, total, stride))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+
+        def submit():
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(executor.submit(
+                    fetch_page, url, headers, payload, offset, page_size, method, http, stats, cache
+                ))
+
+        for _ in range(max_workers):
+            submit()
+        try:
+            while pending:
+                page = pending.popleft().result()
+                if page.get("data"):
+                    yield page["data"]
+                if total is None and response_cache.page_length(page) < page_size:
+                    return
+                submit()
+        finally:
+            # Pages requested past the end of the report, or left behind by a caller that stopped early
+            for future in pending:
+                future.cancel()
+
+
+def iter_page_windows(url, headers, payload, start_offset=0, page_size=DEFAULT_PAGE_SIZE,
+                      max_workers=DEFAULT_MAX_WORKERS, method="POST", http=requests, stats=None, cache=None):
+    """Yields a report in windows of max_workers pages, each fetched concurrently.
+
+    Used by checkpointed runs: once a window has been written, the offset that follows
+    it is a safe point to resume from. The page at start_offset is fetched first, on its
+    own, to learn the total and the page length the API serves; it is part of the first window.
+    Yields:
+        Tuples (next_offset, records, done), where next_offset is the offset of the first
+        record after the window and done is True for the last window of the report.
+    """
+    def fetch(page_offset):
+        return fetch_page(url, headers, payload, page_offset, page_size, method, http, stats, cache)
+
+    first_page = fetch(start_offset)
+    records = list(first_page.get("data", []))
+    offset = start_offset + response_cache.page_length(first_page)
+    total = extract_total(first_page)
+    stride = _page_stride(first_page, total, page_size)
+    if not stride or (total is not None and offset >= total):
+        yield offset, records, True
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            end = offset + stride * max_workers
+            offsets = range(offset, end if total is None else min(end, total), stride)
+            for page_offset, page in zip(offsets, executor.map(fetch, offsets)):
+                records.extend(page.get("data", []))
+                length = response_cache.page_length(page)
+                offset = page_offset + length
+                # Without a total a short page ends the report; pages after it are empty
+                if not length or (offset >= total if total is not None else length < page_size):
+                    yield offset, records, True
+                    return
+            yield offset, records, False
+            records = []
+
+
+def iter_json_array(chunks, key="data", rest=None):
+    """Yields the elements of the array stored under key in a top-level JSON object.
+
+    The body is parsed incrementally from an iterable of bytes or str chunks, so only the
+    element being decoded and the unread part of the current chunk are held in memory.
+    Other top-level values are decoded and discarded, or stored by name in rest if it is
+    given, in which case the object is parsed up to its closing brace.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    state = {"buffer": "", "pos": 0, "eof": False}
+
+    def read_more():
+        if state["eof"]:
+            return False
+        chunk = next(chunks, None)
+        if chunk is None:
+            state["eof"] = True
+            text = utf8.decode(b"", final=True)
+        else:
+            text = utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+        # Drop what has been consumed so the buffer does not grow with the body
+        state["buffer"] = state["buffer"][state["pos"]:] + text
+        state["pos"] = 0
+        return True
+
+    def peek():
+        # Returns the next non-whitespace character without consuming it, or "" at the end
+        while True:
+            buffer, pos = state["buffer"], state["pos"]
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not read_more():
+                return ""
+
+    def decode_value():
+        peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(state["buffer"], state["pos"])
+                # A number at the very end of the buffer may continue in the next chunk
+                if end < len(state["buffer"]) or state["eof"]:
+                    state["pos"] = end
+                    return value
+            except json.JSONDecodeError:
+                if state["eof"]:
+                    raise
+            read_more()
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError(f"Expected {char!r} in JSON body at offset {state['pos']}")
+        state["pos"] += 1
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        name = decode_value()
+        expect(":")
+        if name == key and peek() == "[":
+            state["pos"] += 1
+            if peek() != "]":
+                while True:
+                    yield decode_value()
+                    if peek() == "]":
+                        break
+                    expect(",")
+            state["pos"] += 1
+            if rest is None:
+                return
+        else:
+            value = decode_value()
+            if rest is not None:
+                rest[name] = value
+        if peek() == "}":
+            return
+        expect(",")
+
+
+def iter_response_array(response, key="data", rest=None, stats=None):
+    """Yields the elements of the array under key in the JSON body of a streamed response.
+
+    Once the array is parsed, the rest of the body is read and dropped. A body read to the
+    end lets urllib3 put the keep-alive connection back into the session's pool; closing
+    it half-read would drop the connection.
+    """
+    chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    if stats is not None:
+        chunks = count_bytes(chunks, stats, "fetch")
+    yield from iter_json_array(chunks, key, rest)
+    for _ in chunks:
+        pass
+
+
+def iter_records(url, headers, payload, page_size=DEFAULT_PAGE_SIZE, method="POST", http=requests, stats=None):
+    """Yields every record of a report, streaming each page instead of buffering it.
+
+    Pages are requested one after another with stream=True and parsed incrementally. Each
+    page starts after the records actually received, so a server capping limit below
+    page_size is followed page by page until the reported total is reached. Without a
+    total, a page of fewer than page_size records ends the report.
+    """
+    offset = 0
+    while True:
+        count = 0
+        rest = {}
+        with _request_page(url, headers, payload, offset, page_size, method, http, stream=True) as response:
+            if response.status_code != 200:
+                raise SeeTicketsAPIError(response.status_code, response.text)
+            for record in iter_response_array(response, rest=rest, stats=stats):
+                count += 1
+                yield record
+        offset += count
+        total = extract_total(rest)
+        if not count or (offset >= total if total is not None else count < page_size):
+            return
+
+
+def iter_batches(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Groups an iterable of records into lists of at most batch_size records."""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_bytes(chunks, stats, stage):
+    """Passes chunks through while adding their size to a stage's bytes_in counter."""
+    for chunk in chunks:
+        stats.add(stage, bytes_in=len(chunk))
+        yield chunk
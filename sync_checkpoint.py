@@ -0,0 +1,147 @@
+# Per-report checkpoints that let a sync resume where a timed-out invocation stopped
+
+import json
+import uuid
+
+import lazy_imports
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+CHECKPOINT_TABLE = "sync_checkpoints"
+
+
+def create_checkpoint_table_if_not_exists(client, project_id, dataset_id, table_name=CHECKPOINT_TABLE):
+    """Creates the table holding one checkpoint per function and report if it does not exist."""
+    schema = [
+        bigquery.SchemaField("functionName", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("reportKey", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("eventCodes", "STRING", mode="REPEATED"),
+        bigquery.SchemaField("filteredBy", "STRING"),
+        bigquery.SchemaField("nextOffset", "INTEGER"),
+        bigquery.SchemaField("batchId", "STRING"),
+        bigquery.SchemaField("completed", "BOOLEAN"),
+        bigquery.SchemaField("updatedAt", "TIMESTAMP")
+    ]
+
+    table_ref = bigquery.Table(f"{project_id}.{dataset_id}.{table_name}", schema=schema)
+    try:
+        client.create_table(table_ref)
+        print(f"Created table {table_name}")
+    except Exception as e:
+        if "Already Exists" in str(e):
+            print(f"Table {table_name} already exists.")
+        else:
+            raise e
+
+
+def report_key(codes):
+    """Identifies a report by its event codes, independent of their order."""
+    return ",".join(sorted(codes))
+
+
+class Checkpoint:
+    """Progress of one report: the offset to resume from and the filter it was started with."""
+
+    def __init__(self, codes, filtered_by=None, next_offset=0, batch_id=None, completed=False):
+        self.codes = list(codes)
+        self.filtered_by = filtered_by
+        self.next_offset = next_offset
+        self.batch_id = batch_id
+        self.completed = completed
+
+    @property
+    def key(self):
+        return report_key(self.codes)
+
+    def advance(self, next_offset):
+        """Moves the checkpoint past a written batch and gives that batch a new id."""
+        self.next_offset = next_offset
+        self.batch_id = uuid.uuid4().hex
+
+
+def load_pending(client, table_id, function_name):
+    """Returns a dict of report key -> Checkpoint for the reports a previous run left unfinished."""
+    query = f"""
+        SELECT reportKey, eventCodes, filteredBy, nextOffset, batchId
+        FROM `{table_id}`
+        WHERE functionName = @function_name AND NOT completed
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("function_name", "STRING", function_name)]
+    )
+    results = client.query(query, job_config=job_config).result()
+    return {
+        row.reportKey: Checkpoint(
+            row.eventCodes, json.loads(row.filteredBy) if row.filteredBy else None, row.nextOffset or 0, row.batchId
+        )
+        for row in results
+    }
+
+
+def delete_pending(client, table_id, function_prefix, keep):
+    """Deletes the unfinished checkpoints of the functions named function_prefix*, except those in keep.
+
+    A sharded sync names its checkpoints after the shard ids, which change with the shard count
+    or date ranges. The checkpoints of shards that are no longer planned would never be resumed.
+    Returns:
+        The number of checkpoints deleted.
+    """
+    query = f"""
+        DELETE FROM `{table_id}`
+        WHERE STARTS_WITH(functionName, @function_prefix) AND functionName NOT IN UNNEST(@keep) AND NOT completed
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("function_prefix", "STRING", function_prefix),
+            bigquery.ArrayQueryParameter("keep", "STRING", list(keep))
+        ]
+    )
+    query_job = client.query(query, job_config=job_config)
+    query_job.result()
+    return query_job.num_dml_affected_rows or 0
+
+
+def resume_plan(request_plan, pending):
+    """Merges a request plan with unfinished checkpoints.
+
+    Reports that were started before keep their original filteredBy and resume at their
+    offset, so the pages they still need line up with the ones already written.
+    Unfinished reports that are no longer planned are resumed first.
+    Returns:
+        A list of Checkpoint, one per report to run.
+    """
+    planned = {report_key(codes): (codes, filtered_by) for codes, filtered_by in request_plan}
+    checkpoints = [checkpoint for key, checkpoint in pending.items() if key not in planned]
+    for key, (codes, filtered_by) in planned.items():
+        checkpoints.append(pending.get(key) or Checkpoint(codes, filtered_by))
+    return checkpoints
+
+
+def save_checkpoint(client, table_id, function_name, checkpoint):
+    """Upserts the checkpoint of one report with a single MERGE."""
+    query = f"""
+        MERGE `{table_id}` T
+        USING (SELECT @function_name AS functionName, @report_key AS reportKey) S
+        ON T.functionName = S.functionName AND T.reportKey = S.reportKey
+        WHEN MATCHED THEN
+            UPDATE SET eventCodes = @event_codes, filteredBy = @filtered_by, nextOffset = @next_offset,
+                batchId = @batch_id, completed = @completed, updatedAt = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (functionName, reportKey, eventCodes, filteredBy, nextOffset, batchId, completed, updatedAt)
+            VALUES (@function_name, @report_key, @event_codes, @filtered_by, @next_offset, @batch_id, @completed,
+                CURRENT_TIMESTAMP())
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("function_name", "STRING", function_name),
+            bigquery.ScalarQueryParameter("report_key", "STRING", checkpoint.key),
+            bigquery.ArrayQueryParameter("event_codes", "STRING", checkpoint.codes),
+            bigquery.ScalarQueryParameter(
+                "filtered_by", "STRING", json.dumps(checkpoint.filtered_by) if checkpoint.filtered_by else None
+            ),
+            bigquery.ScalarQueryParameter("next_offset", "INT64", checkpoint.next_offset),
+            bigquery.ScalarQueryParameter("batch_id", "STRING", checkpoint.batch_id),
+            bigquery.ScalarQueryParameter("completed", "BOOL", checkpoint.completed)
+        ]
+    )
+    client.query(query, job_config=job_config).result()
@@ -0,0 +1,205 @@
+# Schemas, partitioning and clustering of the sales and events tables, and partition-pruned key lookups
+
+from datetime import date, timedelta
+
+import lazy_imports
+import record_transform
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+# Sales are partitioned by the day of the sale and clustered so that lookups by event and key
+# only read the matching blocks
+SALES_PARTITION_FIELD = "date"
+SALES_PARTITION_TYPE = "DAY"
+SALES_CLUSTERING_FIELDS = ["eventId", "uniqueCode"]
+
+# The events table is small, so monthly partitions on the start avoid thousands of tiny ones
+EVENTS_PARTITION_FIELD = "starts"
+EVENTS_PARTITION_TYPE = "MONTH"
+EVENTS_CLUSTERING_FIELDS = ["id"]
+
+# Days after a batch's last day whose keys are read in the same query, so that a report
+# streamed in date order needs one lookup per window instead of one per batch
+PARTITION_LOOKAHEAD_DAYS = 31
+
+# Above this many separate day ranges a lookup reads the span from the first to the last day
+MAX_FILTER_RANGES = 50
+
+# Stands for a value that is not a timestamp; its partition is unknown
+UNKNOWN_DAY = "unknown"
+
+
+def schema_fields(fields):
+    """Returns the bigquery.SchemaField list of a table structure file as read by record_transform."""
+    return [bigquery.SchemaField(f["name"], f["type"], mode=f.get("mode", "NULLABLE")) for f in fields]
+
+
+def create_table_if_not_exists(client, table_id, fields, partition_field, partition_type, clustering_fields):
+    """Creates a time-partitioned, clustered table if it does not exist.
+
+    Tables created before partitioning keep their layout; a warning is printed for them,
+    since BigQuery cannot partition an existing table in place.
+    """
+    table_ref = bigquery.Table(table_id, schema=schema_fields(fields))
+    table_ref.time_partitioning = bigquery.TimePartitioning(type_=partition_type, field=partition_field)
+    table_ref.clustering_fields = clustering_fields
+    try:
+        client.create_table(table_ref)
+        print(f"Created table {table_id} partitioned on {partition_field}, clustered on {clustering_fields}")
+    except Exception as e:
+        if "Already Exists" in str(e):
+            print(f"Table {table_id} already exists.")
+            if not is_partitioned_on(client.get_table(table_id), partition_field):
+                print(f"Table {table_id} is not partitioned on {partition_field}; its key lookups scan the "
+                      f"whole table until it is recreated.")
+        else:
+            raise e
+
+
+def create_sales_table_if_not_exists(client, table_id):
+    """Creates a sales table (sales or warehouse_sales) partitioned on the sale date."""
+    create_table_if_not_exists(
+        client, table_id, record_transform.SALES_SCHEMA, SALES_PARTITION_FIELD, SALES_PARTITION_TYPE,
+        SALES_CLUSTERING_FIELDS
+    )
+
+
+def create_events_table_if_not_exists(client, table_id):
+    """Creates the events table partitioned on the event start."""
+    create_table_if_not_exists(
+        client, table_id, record_transform.EVENTS_SCHEMA, EVENTS_PARTITION_FIELD, EVENTS_PARTITION_TYPE,
+        EVENTS_CLUSTERING_FIELDS
+    )
+
+
+def is_partitioned_on(table, field):
+    """True when table is time-partitioned on the TIMESTAMP column field."""
+    partitioning = getattr(table, "time_partitioning", None)
+    if partitioning is None or partitioning.field != field:
+        return False
+    return any(column.name == field and column.field_type == "TIMESTAMP" for column in table.schema)
+
+
+def partition_days(values):
+    """Returns the set of UTC days of timestamp values, with None for missing values and
+    UNKNOWN_DAY for values that are not timestamps."""
+    days = set()
+    for value in values:
+        if value is None:
+            days.add(None)
+            continue
+        normalized = record_transform.to_timestamp(value)
+        try:
+            days.add(date.fromisoformat(normalized[:10]))
+        except (TypeError, ValueError):
+            days.add(UNKNOWN_DAY)
+    return days
+
+
+def partition_filter(column, days):
+    """Returns a SQL condition selecting the partitions of days, or None if they cannot be bounded.
+
+    Consecutive days are merged into one range of constant TIMESTAMP bounds, which BigQuery
+    uses to prune partitions.
+    """
+    if not days or UNKNOWN_DAY in days:
+        return None
+
+    ranges = []
+    for day in sorted(day for day in days if day is not None):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + timedelta(days=1)
+        else:
+            ranges.append([day, day + timedelta(days=1)])
+    if len(ranges) > MAX_FILTER_RANGES:
+        ranges = [[ranges[0][0], ranges[-1][1]]]
+
+    conditions = [
+        f'({column} >= TIMESTAMP("{start.isoformat()}") AND {column} < TIMESTAMP("{end.isoformat()}"))'
+        for start, end in ranges
+    ]
+    if None in days:
+        conditions.append(f"{column} IS NULL")
+    return "(" + " OR ".join(conditions) + ")"
+
+
+class PartitionedKeys:
+    """Existing keys of a partitioned table, read only for the days the incoming batches cover.
+
+    Used in place of a set of every key: load() is called with the days of each batch
+    before it is filtered, and reads the keys of the days not read yet.
+    """
+
+    def __init__(self, client, table_id, key, partition_field, cluster_field=None, cluster_values=None):
+        self.client = client
+        self.table_id = table_id
+        self.key = key
+        self.partition_field = partition_field
+        self.cluster_field = cluster_field
+        self.cluster_values = list(cluster_values) if cluster_values is not None else None
+        self.keys = set()
+        self.loaded_days = set()
+        self.complete = False
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def check_cluster_values(self, values):
+        """Drops the cluster filter when values holds one it does not cover.
+
+        The filter assumes a row's cluster column is one of the requested values, e.g. that
+        a sale's eventId is the event code it was searched by. Once a batch shows otherwise,
+        the days are read again for every value, so no existing key is missed.
+        """
+        if self.cluster_values is None:
+            return
+        covered = set(self.cluster_values)
+        uncovered = {value for value in values if value not in covered}
+        if uncovered:
+            print(f"{self.cluster_field} values {sorted(map(str, uncovered))[:5]} were not requested, "
+                  f"reading the keys of every {self.cluster_field}.")
+            self.cluster_values = None
+            self.loaded_days = set()
+            self.complete = False
+
+    def load(self, days):
+        """Reads the keys stored on days not read before.
+        Returns:
+            The number of keys read.
+        """
+        missing = set(days) - self.loaded_days
+        if self.complete or not missing:
+            return 0
+
+        # Read ahead of the batch, the next batches of a report usually continue from its last day
+        dated = [day for day in missing if day not in (None, UNKNOWN_DAY)]
+        if dated:
+            end = max(dated) + timedelta(days=PARTITION_LOOKAHEAD_DAYS)
+            span = (min(dated) + timedelta(days=offset) for offset in range((end - min(dated)).days + 1))
+            missing |= {day for day in span if day not in self.loaded_days}
+
+        conditions = []
+        condition = partition_filter(self.partition_field, missing)
+        if condition is None:
+            self.complete = True
+        else:
+            conditions.append(condition)
+
+        parameters = []
+        if self.cluster_values is not None:
+            conditions.append(f"{self.cluster_field} IN UNNEST(@cluster_values)")
+            parameters.append(bigquery.ArrayQueryParameter("cluster_values", "STRING", self.cluster_values))
+
+        query = f"SELECT {self.key} FROM `{self.table_id}`"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        results = self.client.query(query, job_config=bigquery.QueryJobConfig(query_parameters=parameters)).result()
+
+        before = len(self.keys)
+        self.keys.update(getattr(row, self.key) for row in results)
+        self.loaded_days |= missing
+        return len(self.keys) - before
+
@@ -0,0 +1,183 @@
+# Snapshot of the rows last loaded into warehouse_sales, used to write only what changed
+#
+# The snapshot file is a 24-byte header (magic, last-modified time of the table right after
+# the snapshot was taken, row count), the 64-bit row hashes as native int64 and the
+# uniqueCodes they belong to, newline-separated, both sorted by uniqueCode. A run diffs the
+# new fetch against it and applies the inserts, updates and deletes instead of a full reload.
+
+import array
+import bisect
+import os
+import struct
+
+import bigquery_sink
+import column_batch
+import event_fingerprints
+import lazy_imports
+
+bigquery = lazy_imports.module("google.cloud.bigquery")
+
+MAGIC = b"WHSNAP01"
+HEADER = struct.Struct("=8sqq")
+
+KEY = "uniqueCode"
+
+# uniqueCodes per DELETE statement, keeping the query parameters well below the request size limit
+DELETE_BATCH_SIZE = 10000
+
+
+def table_version(table):
+    """Returns the last-modified time of a table in microseconds, 0 if unknown.
+
+    Every load job and DML statement changes it, so a snapshot taken at another version
+    no longer describes the table, e.g. after another instance applied its own diff.
+    """
+    modified = getattr(table, "modified", None)
+    return int(modified.timestamp() * 1000000) if modified else 0
+
+
+class Snapshot:
+    """Sorted uniqueCodes and row hashes of the rows a table held at one version."""
+
+    def __init__(self, codes=(), hashes=(), version=0):
+        self.codes = list(codes)
+        self.hashes = array.array("q", hashes)
+        self.version = version
+
+    def __len__(self):
+        return len(self.codes)
+
+    @classmethod
+    def load(cls, path):
+        """Reads a snapshot file. Raises ValueError if the file is not a snapshot."""
+        with open(path, "rb") as file:
+            data = file.read()
+        if len(data) < HEADER.size:
+            raise ValueError(f"{path} is not a warehouse snapshot")
+        magic, version, count = HEADER.unpack_from(data)
+        codes_start = HEADER.size + 8 * count
+        if magic != MAGIC or len(data) < codes_start:
+            raise ValueError(f"{path} is not a warehouse snapshot")
+        snapshot = cls(version=version)
+        snapshot.hashes.frombytes(data[HEADER.size:codes_start])
+        snapshot.codes = data[codes_start:].decode("utf-8").split("\n") if count else []
+        if len(snapshot.codes) != count:
+            raise ValueError(f"{path} is not a warehouse snapshot")
+        return snapshot
+
+    def get(self, code):
+        """Returns the row hash stored for a uniqueCode, or None if it was not in the table."""
+        position = bisect.bisect_left(self.codes, code)
+        if position < len(self.codes) and self.codes[position] == code:
+            return self.hashes[position]
+        return None
+
+    def save(self, path):
+        """Writes the snapshot next to path, then renames it over path."""
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(HEADER.pack(MAGIC, self.version, len(self.codes)))
+            self.hashes.tofile(file)
+            file.write("\n".join(self.codes).encode("utf-8"))
+        os.replace(temporary, path)
+
+
+def open_snapshot(path, table):
+    """Returns the snapshot of table's current version, or None if there is none to diff against."""
+    try:
+        snapshot = Snapshot.load(path)
+    except (OSError, ValueError) as e:
+        print(f"Warehouse snapshot {path} not usable: {e}")
+        return None
+    if not snapshot.version or snapshot.version != table_version(table):
+        print("Warehouse table changed since the snapshot was taken.")
+        return None
+    return snapshot
+
+
+class SnapshotDiff:
+    """Compares fetched rows with a snapshot, keeping the changed rows and the new row hashes.
+
+    Only the inserted and updated rows are held; unchanged rows are dropped as soon as
+    they are hashed, so memory tracks the churn plus 8 bytes and a uniqueCode per row.
+    """
+
+    def __init__(self, snapshot=None):
+        self.snapshot = snapshot or Snapshot()
+        self.seen = {}
+        # uniqueCode -> last fetched row, one per key so the MERGE never sees a key twice
+        self.changed = {}
+        self.inserts = 0
+        self.updates = 0
+
+    def add(self, rows):
+        """Hashes a batch of rows (dicts or a ColumnBatch) and keeps the new and changed ones."""
+        for row in column_batch.iter_row_dicts([rows]):
+            self.track(row)
+
+    def track(self, row):
+        """Records the hash of one row; returns True if it is new or changed.
+
+        A uniqueCode fetched more than once with different content is kept with its last row.
+        """
+        code = row[KEY]
+        row_hash = event_fingerprints.fingerprint(row)
+        if self.seen.get(code) == row_hash:
+            return False
+        self.seen[code] = row_hash
+
+        previous = self.snapshot.get(code)
+        if code in self.changed:
+            # The earlier row of this uniqueCode is already counted, this one replaces it
+            if previous == row_hash:
+                del self.changed[code]
+                self.updates -= 1
+                return False
+            self.changed[code] = row
+            return True
+        if previous == row_hash:
+            return False
+        if previous is None:
+            self.inserts += 1
+        else:
+            self.updates += 1
+        self.changed[code] = row
+        return True
+
+    def tracked(self, rows):
+        """Yields every row while recording its hash, e.g. for a full reload."""
+        for row in rows:
+            self.track(row)
+            yield row
+        # A full reload writes every row, they do not need to be held for an apply
+        self.changed = {}
+
+    def deleted(self):
+        """Returns the uniqueCodes of the snapshot that were not fetched again."""
+        return [code for code in self.snapshot.codes if code not in self.seen]
+
+    def new_snapshot(self, version):
+        codes = sorted(self.seen)
+        return Snapshot(codes, (self.seen[code] for code in codes), version)
+
+
+def apply(client, table_id, diff, stats=None):
+    """Upserts the new and changed rows of a diff with one MERGE and deletes the rows that are gone.
+
+    The MERGE reads every partition: an updated sale may have a new date, and its old row
+    has to match wherever it is stored, or the sale would be inserted a second time.
+    Returns:
+        The number of rows deleted.
+    """
+    if diff.changed:
+        bigquery_sink.merge_rows(client, table_id, list(diff.changed.values()), KEY, stats=stats, update=True)
+
+    deleted = diff.deleted()
+    for start in range(0, len(deleted), DELETE_BATCH_SIZE):
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[bigquery.ArrayQueryParameter("codes", "STRING", deleted[start:start + DELETE_BATCH_SIZE])]
+        )
+        client.query(
+            f"DELETE FROM `{table_id}` WHERE `{KEY}` IN UNNEST(@codes)", job_config=job_config
+        ).result()
+    return len(deleted)